@@ -4,11 +4,15 @@ to add standard headers to FITS files from the FAI 50cm Maksutov telescope.
 """
 
 import base64
+import concurrent.futures.process
 import csv
 import os
 import re
+import shutil
+import subprocess
 import sys
 import tempfile
+import time
 import warnings
 # Suppress all warnings
 warnings.filterwarnings("ignore")
@@ -28,6 +32,18 @@ from gavo.helpers import fitstricks
 from gavo import api
 from gavo.helpers import anet
 
+from plate_timing import PlateTimer, timed
+import crossmatch_plates
+import header_sidecars
+import plate_catalogs
+import plate_io
+import plate_quality
+import platesolve
+import refcat
+import solve_policy
+import tiled_extract
+import wcs_index
+
 
 ##################################################
 #_______________SOME INITIAL DATA________________#
@@ -251,6 +267,23 @@ FILTERS_ENG = {  #CHECK ON + and (10x10)
 }
 
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~PLATE ID~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def get_plate_id(src_name):
+  """
+  returns the logbook ID of a plate from its file name (the part after
+  the last underscore, with a cyrillic с replaced by c).
+
+  >>> get_plate_id("data/lambda-Ori_209-10.02.1958_20m_11-1964.fit")
+  '11-1964'
+  >>> get_plate_id("data/Moon_12.03.1961_1m_с-34.fit")
+  'c-34'
+  """
+  return src_name.split(".")[-2].split("_")[-1].lower().replace("с","c")
+
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~OBJECT NAME~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -972,6 +1005,7 @@ def get_object_altitude(dec,phi,hour_angle):
   """
   return 90 - np.arccos(np.sin(phi*u.degree)*np.sin(dec*u.degree)+np.cos(phi*u.degree)*np.cos(dec*u.degree)*np.cos(hour_angle*u.degree)).to_value("degree")
 
+@timed("sun_set_rise")
 def sun_set_rise_time(date,observatory):
   """
   Returns sunset and sunrise time for observational point
@@ -1021,6 +1055,7 @@ def sun_set_rise_time(date,observatory):
 #~~~~~~~~~~~~~~~~~DATE-TIME UT~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+@timed("delta_real")
 def get_delta_real(date):
 
   """
@@ -1447,6 +1482,15 @@ def run_tests(*args):
 #~~~~~~~~~~~~~~~~~HEADER CLASS~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+class _SeedVerified(Exception):
+  """raised from within anet's run when the seed WCS fits the sources,
+  so that anet does not solve the plate again.
+  """
+  def __init__(self, cards):
+    Exception.__init__(self, "Seed WCS verified")
+    self.cards = cards
+
+
 class PAHeaderAdder(api.AnetHeaderProcessor):
   indexPath = "/usr/share/astrometry" #path to indexes
   sp_total_timelimit = 180 #maximum time for field solving
@@ -1454,6 +1498,7 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
   sp_upper_pix = 6 #the largest permissible pixel size in arcsecs
   sp_endob = 100 # last object to be processed
   sp_indices = ["index-41[01]*.fits"]# The file names from anet’s index directory you want to have used
+  dataDir = "/var/gavo/inputs/astroplates/maksutov_50_telescope/data" # where annotated plates are written
 
   sourceExtractorControl = """
     DETECT_MINAREA   20
@@ -1467,14 +1512,95 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     super().__init__(*args, **kwargs)  # Вызов конструктора родительского класса
     self.fits_file = None  # Добавление своей переменной
     self.fits_name = None  # Добавление своей переменной
+    self.solve_decision = None
+    self.src_name = None
+    self.seed = None
 
   @staticmethod
   def addOptions(optParser):
     api.AnetHeaderProcessor.addOptions(optParser)
     optParser.add_option("--test", help="Run unit tests, then exit",
       action="callback", callback=run_tests)
+    optParser.add_option("--anet-tmpdir", help="Put anet's working"
+      " directories here (preferably a tmpfs like /dev/shm)",
+      dest="anetTmpDir", default=None)
+    optParser.add_option("--copy-input", help="Let anet copy the plate"
+      " into its working directory rather than linking it",
+      action="store_true", dest="copyInput", default=False)
+    optParser.add_option("--timing-log", help="Append per-plate stage"
+      " timings to this JSON lines file (default: timing.jsonl in the"
+      " resource directory); summarize with bin/plate_timing.py",
+      dest="timingLog", default=None)
+    optParser.add_option("--solve-all", help="Run anet on all plates"
+      " except calibration frames, ignoring the solvability policy",
+      action="store_true", dest="solveAll", default=False)
+    optParser.add_option("--no-timing", help="Do not write stage timings",
+      action="store_false", dest="recordTimings", default=True)
+    optParser.add_option("--tiled-extract", help="Run SExtractor on"
+      " tiles of the plate in parallel and solve the merged catalog",
+      action="store_true", dest="tiledExtract", default=False)
+    optParser.add_option("--tile-size", help="Tile size in pixels for"
+      " --tiled-extract", type="int", dest="tileSize", default=4096)
+    optParser.add_option("--extract-workers", help="Number of SExtractor"
+      " processes for --tiled-extract (default: number of CPUs)",
+      type="int", dest="extractWorkers", default=None)
+    optParser.add_option("--wcs-index", help="sqlite file of solved"
+      " plates used to seed solves from neighbouring plates (default:"
+      " wcs_index.sqlite in the resource directory)",
+      dest="wcsIndex", default=None)
+    optParser.add_option("--catalog-dir", help="Keep the extraction"
+      " catalogs of solved plates here (default: catalogs in the"
+      " resource directory); bin/refine_sip.py uses them",
+      dest="catalogDir", default=None)
+    optParser.add_option("--headers-dir", help="Write header sidecars"
+      " for the import here (default: headers in the resource"
+      " directory; q.rd expects them there)",
+      dest="headersDir", default=None)
+    optParser.add_option("--sources-dir", help="Write the source tables"
+      " with world coordinates for the sources table here (default:"
+      " sources in the resource directory)",
+      dest="sourcesDir", default=None)
+    optParser.add_option("--refcat", help="Local reference catalog (FITS"
+      " table or CSV with RA, DEC, MAG) to match plate sources against"
+      " for the XM_* cards", dest="refcat", default=None)
+    optParser.add_option("--no-quality", help="Do not compute the plate"
+      " quality (Q*) cards", action="store_false", dest="measureQuality",
+      default=True)
+    optParser.add_option("--read-ahead", help="Number of upcoming plates"
+      " to read into the page cache while the current one is processed"
+      " (0 to switch off)", type="int", dest="readAhead", default=2)
+    optParser.add_option("--write-behind", help="Number of finished"
+      " plates that may wait for being written in the background"
+      " (0 to write synchronously)", type="int", dest="writeBehind",
+      default=2)
+    optParser.add_option("--no-seed", help="Always solve blind, do not"
+      " start from solved neighbours", action="store_false",
+      dest="seedSolves", default=True)
 
   def _createAuxiliaries(self, dd):
+    timing_log = None
+    if self.opts.recordTimings:
+      timing_log = self.opts.timingLog or os.path.join(
+        dd.rd.resdir, "timing.jsonl")
+    self.timer = PlateTimer(timing_log)
+    self.catalog_dir = self.opts.catalogDir or os.path.join(
+      dd.rd.resdir, "catalogs")
+    os.makedirs(self.catalog_dir, exist_ok=True)
+    self.headers_dir = self.opts.headersDir or os.path.join(
+      dd.rd.resdir, "headers")
+    os.makedirs(self.headers_dir, exist_ok=True)
+    self.sources_dir = self.opts.sourcesDir or os.path.join(
+      dd.rd.resdir, "sources")
+    os.makedirs(self.sources_dir, exist_ok=True)
+    self.writer = plate_io.WriteBehind(self.opts.writeBehind)
+    self.ref_index = None
+    if self.opts.refcat:
+      self.ref_index = refcat.RefIndex.from_file(self.opts.refcat)
+    self.wcs_index = None
+    if self.opts.seedSolves:
+      self.wcs_index = wcs_index.WCSIndex(self.opts.wcsIndex
+        or os.path.join(dd.rd.resdir, "wcs_index.sqlite"))
+
     log_path = os.path.join(dd.rd.resdir, "/var/gavo/inputs/logbook_archival", "logbook.csv")
     with open(log_path, "r", encoding="utf-8") as f:
       rdr = csv.DictReader(f, delimiter=",")
@@ -1504,31 +1630,266 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     os.rename("foo.xyls", inName)
 
   def _shouldRunAnet(self, srcName, header):
-    #try:
-    if "-st" in srcName or "Cal" in srcName:
+    meta = self.platemeta.get(get_plate_id(srcName))
+    exptimes = None
+    if meta and meta.get("EXPTIME") and meta["EXPTIME"].strip():
+      try:
+        exptimes = parse_exposure_times(meta["EXPTIME"])
+      except ValueError:
+        pass
+
+    with self.timer.stage("policy"):
+      if self.opts.solveAll:
+        self.solve_decision = solve_policy.decide(srcName, None,
+          default_timelimit=self.sp_total_timelimit)
+      else:
+        self.solve_decision = solve_policy.decide(srcName, meta, exptimes,
+          plate_io.plate_hdu(self.fits_file).section,
+          self.sp_total_timelimit)
+    self.timer.note(solve_policy=self.solve_decision.action,
+      policy_reason=self.solve_decision.reason)
+    if self.solve_decision.action=="skip":
+      print(f"Not solving {srcName}: {self.solve_decision.reason}")
       return False
-    else:
-      return True #findme
-    #except gavo.helpers.processing.CannotComputeHeader as e:
-        # Handle CannotComputeHeader exception (astrometry failure)
-        #print(f"Astrometry failed for {srcName}: {e}")
-        # Optionally, log the error or take other actions if needed.
+    return True
 
-    #except Exception as e:
-        # Handle other exceptions that may occur during astrometry or header modification
-    #    print(f"An error occurred for {srcName}: {e}")
-        # Optionally, log the error or take other actions if needed.
+  def getPrimaryHeader(self, srcName):
+    # the image header also of tile-compressed plates, whose primary
+    # HDU is empty
+    return plate_io.read_plate_header(srcName)
 
   def _isProcessed(self, srcName):
-    hdr = self.getPrimaryHeader(srcName)
-    self.fits_file = fits.open(srcName)
+    with self.timer.stage("open"):
+      # the image header also of tile-compressed plates
+      hdr = plate_io.read_plate_header(srcName)
+      self.fits_file = fits.open(srcName)
     if "/" in srcName: 
       self.fits_name = srcName.split("/")[-1].replace("–","-").encode("utf-8").decode("utf-8") 
       print(self.fits_name)
-    return "RA-ORIG" in hdr and "A_ORDER" in hdr
+    if "RA-ORIG" in hdr and "A_ORDER" in hdr:
+      self.timer.note(skipped="already processed")
+      return True
+    return False
+
+  def _indexKey(self, srcName):
+    """returns (night, object, ra, dec) of srcName for the WCS index
+    from the logbook, or None if the night is unknown.
+    """
+    meta = self.platemeta.get(get_plate_id(srcName))
+    if not meta or not (meta.get("DATE-OBS") or "").strip():
+      return None
+    try:
+      night = get_date_cards(meta["DATE-OBS"])["DATEORIG"]
+    except (ValueError, IndexError):
+      return None
+    try:
+      ra = ra_to_deg(meta["RA"].split(";")[0])
+      dec = dec_to_deg(meta["DEC"].split(";")[0])
+    except (ValueError, AttributeError, KeyError):
+      ra = dec = None
+    obj = None
+    if meta.get("OBJECT"):
+      # the first target, as in OBJECT of the plate headers
+      obj = get_object_cards(meta["OBJECT"])["OBJECT"]
+    return night, obj, ra, dec
+
+  def _solveAnet(self, srcName):
+    if self.solve_decision.action=="quick":
+      self.sp_total_timelimit = self.solve_decision.timelimit
+    plate = os.path.basename(srcName)
+    key = self.seed = None
+    if self.wcs_index:
+      key = self._indexKey(srcName)
+      if key:
+        self.seed = self.wcs_index.find_neighbour(*key, exclude=plate)
+
+    try:
+      with self.timer.stage("solve"):
+        wcs = None
+        if self.opts.tiledExtract:
+          try:
+            wcs = self._solveFromCatalog(srcName, self.seed)
+          except (EnvironmentError, subprocess.CalledProcessError,
+              concurrent.futures.process.BrokenProcessPool) as ex:
+            # e.g., SExtractor missing or crashing on a tile
+            print(f"Tiled extraction failed ({ex}), falling back to anet")
+            self.timer.note(tiled_extract_error=str(ex))
+            wcs = self._solveWithAnet(srcName)
+        else:
+          wcs = self._solveWithAnet(srcName)
+    finally:
+      self.__dict__.pop("sp_total_timelimit", None)
+
+    if wcs and key:
+      self.wcs_index.record(plate, *key, wcs)
+    return wcs
+
+  def _solveWithAnet(self, srcName):
+    handoff = None
+    try:
+      with plate_io.zero_copy_handoff(anet, srcName, self.opts.anetTmpDir,
+          not self.opts.copyInput) as handoff:
+        return super()._solveAnet(srcName)
+    except _SeedVerified as ex:
+      return ex.cards
+    finally:
+      if handoff:
+        self.timer.note(handoff=handoff.method)
+
+  def _solveFromCatalog(self, srcName, seed=None):
+    """returns WCS cards for srcName from a tiled SExtractor run and
+    solve-field on the merged catalog, or None if it does not solve
+    (--tiled-extract).
+
+    With a seed (plate, header) from the WCS index, the neighbour's
+    WCS is verified first.  The tile runs use sourceExtractorControl
+    but not anet's own SExtractor setup, so the source lists differ
+    somewhat from anet's.
+    """
+    work_dir = tempfile.mkdtemp(prefix="tiled", dir=self.opts.anetTmpDir)
+    try:
+      height, width = plate_io.plate_hdu(self.fits_file).shape
+      cat = tiled_extract.extract(srcName, self.sourceExtractorControl,
+        self.opts.tileSize, workers=self.opts.extractWorkers,
+        tmp_dir=work_dir)
+      xyls = os.path.join(work_dir, "out.xyls")
+      tiled_extract.write_catalog(cat, xyls, width, height)
+      self.objectFilter(xyls)
+      self.timer.note(sources=len(cat))
+
+      if seed:
+        wcs = platesolve.verify_xyls(xyls, width, height, work_dir,
+          self.indexPath, self.sp_indices, seed[1], objs=self.sp_endob)
+        self.timer.note(seed=seed[0], seeded=wcs is not None)
+        if wcs:
+          return wcs.cards
+
+      wcs = platesolve.solve_xyls(xyls, width, height, work_dir,
+        self.indexPath, self.sp_indices, self.sp_lower_pix,
+        self.sp_upper_pix, self.sp_total_timelimit, objs=self.sp_endob)
+      return wcs.cards if wcs else None
+    finally:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  def objectFilter(self, inName):
+    """is called by anet between SExtractor and the solver; we keep
+    the catalog for refine_sip.py and tell the two apart in the timing
+    log.
+
+    Verified seeds end anet's run by raising _SeedVerified from here,
+    which _solveWithAnet catches.  This relies on anet (i.e.,
+    getWCSFieldsFor in gavo.helpers.anet) letting exceptions other than
+    its own pass and restoring the working directory and removing its
+    temporary files in finally clauses, as it does for failed solves;
+    check this when updating DaCHS.
+    """
+    self.timer.mark("sextractor")
+    shutil.copy(inName, plate_io.catalog_path(self.catalog_dir,
+      self.src_name))
+    if self.seed and not self.opts.tiledExtract:
+      self._verifySeed(inName)
+
+  def _verifySeed(self, xyls):
+    """raises _SeedVerified if the WCS of the seed neighbour fits anet's
+    source list xyls; anet then goes on with a blind solve.
+    """
+    height, width = plate_io.plate_hdu(self.fits_file).shape
+    work_dir = tempfile.mkdtemp(prefix="seed", dir=self.opts.anetTmpDir)
+    try:
+      wcs = platesolve.verify_xyls(os.path.abspath(xyls), width, height,
+        work_dir, self.indexPath, self.sp_indices, self.seed[1],
+        objs=self.sp_endob)
+    finally:
+      shutil.rmtree(work_dir, ignore_errors=True)
+    self.timer.note(seed=self.seed[0], seeded=wcs is not None)
+    if wcs:
+      raise _SeedVerified(wcs.cards)
+
+  def iterIdentifiers(self):
+    return plate_io.read_ahead(super().iterIdentifiers(),
+      self.opts.readAhead)
+
+  def processAll(self):
+    try:
+      return super().processAll()
+    finally:
+      self.writer.close()
+
+  def _writePlate(self, hdul, destName, record):
+    """writes a finished plate and its sidecar and then the plate's
+    timing record, with the write time and, if writing failed, marked
+    as failed.
+
+    This is how a tile-compressed plate goes through _setPlateHeader
+    (the end of _mungeHeader) and _writePlate:
+
+    >>> import types
+    >>> d = tempfile.mkdtemp()
+    >>> src = os.path.join(d, "src.fit")
+    >>> fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(
+    ...   np.arange(300*200, dtype=np.int16).reshape(300, 200)%4000)]
+    ...   ).writeto(src)
+    >>> proc = PAHeaderAdder.__new__(PAHeaderAdder)
+    >>> proc.opts = types.SimpleNamespace(measureQuality=True)
+    >>> proc.timer, proc.headers_dir = PlateTimer(None), d
+    >>> proc.dataDir, proc.fits_name = d, "dest.fit"
+    >>> proc.timer.start_plate("src.fit")
+    >>> proc.fits_file = fits.open(src)
+    >>> hdr = proc.getPrimaryHeader(src)
+    >>> hdr["OBJECT"] = "M 42"
+    >>> proc._setPlateHeader(hdr)
+    >>> record = proc.timer.plate_record("ok")
+    >>> proc._writePlate(*proc.pending_write, record)
+    >>> record["status"], "write" in record["stages"]
+    ('ok', True)
+    >>> with fits.open(os.path.join(d, "dest.fit"), checksum=True) as hdul:
+    ...   hdu = plate_io.plate_hdu(hdul)
+    ...   print(len(hdul), hdu.header["OBJECT"], "QBACK" in hdu.header,
+    ...     hdu.data[1, 2], hdu.header["DATAHASH"]==plate_io.data_hash(hdu))
+    2 M 42 True 202 True
+    >>> header_sidecars.read_header(os.path.join(d, "dest.fit"), d)["OBJECT"]
+    'M 42'
+    >>> shutil.rmtree(d)
+    """
+    t0 = time.perf_counter()
+    try:
+      plate_io.write_with_checksums(hdul, destName, output_verify="fix",
+        overwrite=True)
+      header_sidecars.write_sidecar(plate_io.plate_hdu(hdul).header,
+        self.headers_dir, destName)
+    except Exception as ex:
+      print(f"Writing {destName} failed: {ex}")
+      if record is not None:
+        record.update(status="failed", write_error=str(ex))
+      raise
+    finally:
+      hdul.close()
+      if record is not None:
+        record["stages"]["write"] = round(time.perf_counter()-t0, 6)
+      self.timer.write_record(record)
+
+  def process(self, srcName):
+    self.src_name = srcName
+    self.pending_write = None
+    self.timer.start_plate(os.path.basename(srcName))
+    status = "failed"
+    try:
+      res = super().process(srcName)
+      # plates processed before only get a record to show up as such
+      status = "skipped" if "skipped" in self.timer.notes else "ok"
+      return res
+    finally:
+      # the record of a plate to be written is completed by _writePlate
+      record = self.timer.plate_record(status)
+      if self.pending_write and status=="ok":
+        self.writer.submit(self._writePlate, *self.pending_write, record)
+      else:
+        if self.pending_write:
+          self.pending_write[0].close()
+        self.timer.write_record(record)
 
   def _mungeHeader(self, srcName, hdr):
-    plateid = srcName.split(".")[-2].split("_")[-1].lower().replace("с","c")
+    plateid = get_plate_id(srcName)
     print(plateid)
     data = self.platemeta[plateid]
     
@@ -1573,14 +1934,15 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
     #~~~~~~~~~SIMBAD-QUERY~~~~~~~~~
     ra_simbad = []
     dec_simbad = []
-    for obj in obj_name.replace(",",";").split(";"):
-      simbad_table = Simbad.query_object(obj)
-      if simbad_table:#if object data there is in Simbad
-        ra_simbad.append(":".join(simbad_table["RA"].data[0].split(" ")))
-        dec_simbad.append(":".join(simbad_table["DEC"].data[0].split(" ")))
-      else:#if not
-        ra_simbad.append(None)
-        dec_simbad.append(None)
+    with self.timer.stage("simbad"):
+      for obj in obj_name.replace(",",";").split(";"):
+        simbad_table = Simbad.query_object(obj)
+        if simbad_table:#if object data there is in Simbad
+          ra_simbad.append(":".join(simbad_table["RA"].data[0].split(" ")))
+          dec_simbad.append(":".join(simbad_table["DEC"].data[0].split(" ")))
+        else:#if not
+          ra_simbad.append(None)
+          dec_simbad.append(None)
 
     ra_simbad = [ra_s for ra_s in ra_simbad if str(ra_s) != 'nan']
     dec_simbad = [dec_s for dec_s in dec_simbad if str(dec_s) != 'nan']
@@ -1821,10 +2183,12 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
       variable_arguments.update(get_objtype_cards(objtype))
       
     if obj_name:
-      object_name = obj_name.split(";")[0]
+      # OBJECT is passed explicitly below; OBJECT1..N list all targets
+      object_cards = get_object_cards(obj_name)
+      object_name = object_cards.pop("OBJECT")
+      variable_arguments.update(object_cards)
     else:
       object_name = None
-    #  variable_arguments.update(get_object_cards(obj_name))
 
     if tms_lst:
       variable_arguments.update(get_time_start_cards(tms_lst, time_format))
@@ -1858,47 +2222,75 @@ class PAHeaderAdder(api.AnetHeaderProcessor):
         date_obs_edit=date_obs_edit.fits
 
 
-    new_hdr = fitstricks.makeHeaderFromTemplate(
-      fitstricks.WFPDB_TEMPLATE,
-      originalHeader = hdr,
-      OBJECT = object_name,
-      DATE_OBS = date_obs_edit,
-      RA_ORIG = ra_edit[0],
-      DEC_ORIG = dec_edit[0],
-      RA_DEG = ra_deg,
-      DEC_DEG = dec_deg,
-      OBSERVER = observer_edit,
-      OBSERVAT = "Fesenkov Astrophysical Institute",
-      SITELONG = 43.17667,
-      SITELAT = 76.96611,
-      SITEELEV = 1450,
-      TELESCOP = telescope_edit,
-      NUMEXP = numexp,
-      SCANAUTH = "Shomshekova S., Umirbayeva A., Moshkina S.",
-      ORIGIN = "Contant",
-      FOCLEN = foclen,
-      FOCUS = focus,
-      METHOD = method_edit,
-      PLATESZ1 = plate_size[0],
-      PLATESZ2 = plate_size[1],
-      FIELD = field,
-      OTA_DIAM = mirror_diameter,
-      SCANERS1 = 1200,
-      SCANERS2 = 1200,
-      PRE_PROC = "Cleaning from dust with a squirrel brush and from contamination from the glass (not an emulsion) with paper napkins",
-      PID = plate_id,
-      NOTES = notes,
-      PLATNOTE = platenotes,
-      SCANNOTE = scannotes,
-      OBSNOTE = obsnotes,
-      EMULSION = emulsion_edit,
-      DETNAME = "Photographic plate",
-      SKYCOND = skycond,
-      FILENAME = self.fits_name.replace('.fit',''),
-      **variable_arguments)
-    self.fits_file[0].header = new_hdr
-    self.fits_file.writeto("/var/gavo/inputs/astroplates/maksutov_50_telescope/data/"+self.fits_name, output_verify="fix",overwrite=True) 
+    with self.timer.stage("header"):
+      new_hdr = fitstricks.makeHeaderFromTemplate(
+        fitstricks.WFPDB_TEMPLATE,
+        originalHeader = hdr,
+        OBJECT = object_name,
+        DATE_OBS = date_obs_edit,
+        RA_ORIG = ra_edit[0],
+        DEC_ORIG = dec_edit[0],
+        RA_DEG = ra_deg,
+        DEC_DEG = dec_deg,
+        OBSERVER = observer_edit,
+        OBSERVAT = "Fesenkov Astrophysical Institute",
+        SITELONG = 43.17667,
+        SITELAT = 76.96611,
+        SITEELEV = 1450,
+        TELESCOP = telescope_edit,
+        NUMEXP = numexp,
+        SCANAUTH = "Shomshekova S., Umirbayeva A., Moshkina S.",
+        ORIGIN = "Contant",
+        FOCLEN = foclen,
+        FOCUS = focus,
+        METHOD = method_edit,
+        PLATESZ1 = plate_size[0],
+        PLATESZ2 = plate_size[1],
+        FIELD = field,
+        OTA_DIAM = mirror_diameter,
+        SCANERS1 = 1200,
+        SCANERS2 = 1200,
+        PRE_PROC = "Cleaning from dust with a squirrel brush and from contamination from the glass (not an emulsion) with paper napkins",
+        PID = plate_id,
+        NOTES = notes,
+        PLATNOTE = platenotes,
+        SCANNOTE = scannotes,
+        OBSNOTE = obsnotes,
+        EMULSION = emulsion_edit,
+        DETNAME = "Photographic plate",
+        SKYCOND = skycond,
+        FILENAME = self.fits_name.replace('.fit',''),
+        **variable_arguments)
+    catalog = plate_io.catalog_path(self.catalog_dir, srcName)
+    if "CRVAL1" in new_hdr and os.path.exists(catalog):
+      with self.timer.stage("sources"):
+        sources = plate_catalogs.write_sources(catalog, new_hdr,
+          new_hdr["FILENAME"],
+          plate_catalogs.source_path(self.sources_dir, srcName))
+      self.timer.note(sources=len(sources.data))
+      if self.ref_index:
+        with self.timer.stage("crossmatch"):
+          new_hdr.update(crossmatch_plates.match_stats(sources.data,
+            self.ref_index))
+
+    self._setPlateHeader(new_hdr)
     return new_hdr
 
+  def _setPlateHeader(self, new_hdr):
+    """adds the quality cards to new_hdr, makes it the header of the
+    plate image (also of tile-compressed plates) and leaves the plate
+    for process to write.
+    """
+    if self.opts.measureQuality:
+      # the data is loaded here once and then written out from memory
+      with self.timer.stage("quality"):
+        new_hdr.update(plate_quality.quality_cards(plate_quality.measure(
+          plate_io.plate_hdu(self.fits_file).data)))
+
+    plate_io.set_plate_header(self.fits_file, new_hdr)
+    # written (in the background) by process once the plate is done
+    self.pending_write = (self.fits_file,
+      os.path.join(self.dataDir, self.fits_name))
+
 if __name__=="__main__":
   api.procmain(PAHeaderAdder, "maksutov_50_telescope/q", "import")
@@ -0,0 +1,602 @@
+"""
+Offline benchmarks for the plate pipeline.
+
+This generates synthetic logbook rows in the formats the parsers of
+annotate_fits.py understand and synthetic uint16 plates with star fields,
+then times the parsers, neg2pos conversion, header building, the FITS
+write path and, where the binaries are installed, SExtractor and
+solve-field.
+
+It needs numpy and astropy; gavo, astroquery, astroplan and transliterate
+are replaced by minimal stand-ins if they cannot be imported (results
+then carry "standins": true, and the header building numbers are not
+comparable to a DaCHS installation).  Nothing here touches the network.
+
+Results are appended to bench_results.jsonl together with the current
+git commit; use --compare REV to see how the current tree does relative
+to an earlier run.
+
+  python bin/bench_plates.py [--plate-size 14000] [--rows 20000]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+from astropy.io import fits
+
+import plate_io
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BIN_DIR)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~STAND-INS~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _standin_api():
+  api = types.ModuleType("gavo.api")
+
+  def dmsToDeg(dmsLiteral, sepChar=None):
+    parts = dmsLiteral.strip().split(sepChar)
+    sign = -1 if parts[0].startswith("-") else 1
+    parts = [abs(float(p)) for p in parts]+[0, 0]
+    return sign*(parts[0]+parts[1]/60.+parts[2]/3600.)
+
+  def _sexa(val, sepChar, secondFracs):
+    val = abs(val)
+    d = int(val)
+    m = int((val-d)*60)
+    s = round(((val-d)*60-m)*60, secondFracs)
+    if s>=60:
+      s, m = 0, m+1
+    if m>=60:
+      m, d = 0, d+1
+    sec = f"{s:0{3+secondFracs if secondFracs else 2}.{secondFracs}f}"
+    return f"{d:02d}{sepChar}{m:02d}{sepChar}{sec}"
+
+  def hoursToHms(hours, sepChar=":", secondFracs=0):
+    return _sexa(hours, sepChar, secondFracs)
+
+  def degToHms(deg, sepChar=" ", secondFracs=3):
+    return _sexa(deg/15., sepChar, secondFracs)
+
+  def degToDms(deg, sepChar=" ", secondFracs=2, preserveLeading=False,
+      truncate=False):
+    return ("-" if deg<0 else "+")+_sexa(deg, sepChar, secondFracs)
+
+  api.dmsToDeg, api.hoursToHms = dmsToDeg, hoursToHms
+  api.degToHms, api.degToDms = degToHms, degToDms
+  api.AnetHeaderProcessor = type("AnetHeaderProcessor", (), {})
+  api.pyfits = fits
+  return api
+
+
+def _standin_fitstricks():
+  fitstricks = types.ModuleType("gavo.helpers.fitstricks")
+  fitstricks.WFPDB_TEMPLATE = None
+
+  def makeHeaderFromTemplate(template, originalHeader=None, **values):
+    hdr = originalHeader.copy() if originalHeader is not None else fits.Header()
+    for key, val in values.items():
+      if val is not None:
+        hdr[key.replace("_", "-")] = val
+    return hdr
+
+  fitstricks.makeHeaderFromTemplate = makeHeaderFromTemplate
+  return fitstricks
+
+
+def install_standins():
+  """
+  puts stand-ins for the non-scientific dependencies of annotate_fits
+  into sys.modules where the real modules are missing.
+
+  Returns the names of the modules replaced.
+  """
+  replaced = []
+
+  try:
+    import gavo.api, gavo.helpers.fitstricks, gavo.helpers.anet
+  except ImportError:
+    gavo = types.ModuleType("gavo")
+    helpers = types.ModuleType("gavo.helpers")
+    gavo.api, gavo.helpers = _standin_api(), helpers
+    helpers.fitstricks = _standin_fitstricks()
+    helpers.anet = types.ModuleType("gavo.helpers.anet")
+    sys.modules.update({"gavo": gavo, "gavo.api": gavo.api,
+      "gavo.helpers": helpers, "gavo.helpers.fitstricks": helpers.fitstricks,
+      "gavo.helpers.anet": helpers.anet})
+    replaced.append("gavo")
+
+  try:
+    import astroquery.simbad
+  except ImportError:
+    simbad = types.ModuleType("astroquery.simbad")
+    simbad.Simbad = type("Simbad", (), {
+      "query_object": staticmethod(lambda name: None)})
+    sys.modules.update({"astroquery": types.ModuleType("astroquery"),
+      "astroquery.simbad": simbad})
+    replaced.append("astroquery")
+
+  try:
+    import astroplan.observer
+  except ImportError:
+    observer = types.ModuleType("astroplan.observer")
+    class Observer:
+      def __init__(self, name=None, location=None):
+        self.name, self.location = name, location
+    observer.Observer = Observer
+    sys.modules.update({"astroplan": types.ModuleType("astroplan"),
+      "astroplan.observer": observer})
+    replaced.append("astroplan")
+
+  try:
+    import transliterate
+  except ImportError:
+    translit = types.ModuleType("transliterate")
+    translit.translit = lambda s, lang, reversed=False: s
+    sys.modules["transliterate"] = translit
+    replaced.append("transliterate")
+
+  return replaced
+
+
+def import_pipeline():
+  """
+  returns the annotate_fits and neg2pos modules, using stand-ins as
+  necessary, and the list of replaced dependencies.
+  """
+  replaced = install_standins()
+  for path in [BIN_DIR, REPO_DIR]:
+    if path not in sys.path:
+      sys.path.insert(0, path)
+  import annotate_fits
+  import neg2pos
+  return annotate_fits, neg2pos, replaced
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~SYNTHETIC LOGBOOK~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _fake_ra(rnd):
+  h, m, s = rnd.randrange(24), rnd.randrange(60), rnd.randrange(60)
+  return rnd.choice([
+    f"{h:02d} {m:02d} {s:02d}", f"{h:02d} {m:02d}", f"{h:02d}h{m:02d}m",
+    f"{h:02d}h{m:02d}m{s:02d}s", f"{h:02d}:{m:02d}:{s:02d}",
+    f"{h}h{m}.{rnd.randrange(10)}m"])
+
+def _fake_dec(rnd):
+  sign = rnd.choice(["", "-", "+"])
+  d, m, s = rnd.randrange(90), rnd.randrange(60), rnd.randrange(60)
+  return rnd.choice([
+    f"{sign}{d}.{m:02d}", f"{sign}{d:02d} {m:02d} {s:02d}",
+    f"{sign}{d:02d} {m:02d}", f"{sign}{d:02d}:{m:02d}:{s:02d}"])
+
+def _fake_exposure(rnd):
+  def one():
+    return rnd.choice([f"{rnd.randrange(1, 5)}h", f"{rnd.randrange(1, 5)}h30m",
+      f"1h{rnd.randrange(60)}m{rnd.randrange(60)}s", f"{rnd.randrange(1, 60)}m",
+      f"{rnd.randrange(1, 60)}.5m", f"1m{rnd.randrange(60)}s",
+      f"{rnd.randrange(1, 60)}s", f"{rnd.randrange(1, 60)} m"])
+  return ";".join(one() for _ in range(rnd.choice([1, 1, 1, 2, 3])))
+
+def _fake_time(rnd):
+  def one():
+    h, m, s = rnd.randrange(24), rnd.randrange(60), rnd.randrange(60)
+    return rnd.choice([f"{h}.h{rnd.randrange(10)}", f"{h}h{m}m{s}s",
+      f"{h}h{m}", f"{h}h{m}m", f"{h}h{m}m{s}", f"{h} h{m}m"])
+  return ";".join(one() for _ in range(rnd.choice([1, 1, 2])))
+
+def _fake_date(rnd):
+  def one():
+    y, mo, d = rnd.randrange(1950, 2000), rnd.randrange(1, 13), rnd.randrange(1, 28)
+    return rnd.choice([f"{d:02d}.{mo:02d}.{y}", f"{d}.{mo}.{y%100:02d}",
+      f"{d}-{d+1}.{mo:02d}.{y}", f"{d}-{d+1}.{mo:02d}.{y%100:02d}",
+      f"{d}.{mo:02d}-{d+1}.{mo:02d}.{y}", f"31.12.{y}-01.01.{(y+1)%100:02d}"])
+  return ";".join(one() for _ in range(rnd.choice([1, 1, 2])))
+
+def _fake_filter(rnd, filter_names):
+  names = [rnd.choice(filter_names) for _ in range(rnd.choice([1, 1, 2]))]
+  noisy = []
+  for name in names:
+    if rnd.random()<0.3:
+      name = " ".join(name)
+    if rnd.random()<0.3:
+      name = name.upper()
+    noisy.append(name)
+  return rnd.choice([";", ",", "+"]).join(noisy)
+
+
+def make_logbook_rows(n, filter_names, seed=1):
+  """
+  returns n dicts resembling rows of logbook.csv, with values drawn
+  from the formats the parsers in annotate_fits accept.
+  """
+  rnd = random.Random(seed)
+  return [{
+      "ID": f"{rnd.randrange(1, 3000)}-{rnd.randrange(1950, 2000)}",
+      "RA": _fake_ra(rnd),
+      "DEC": _fake_dec(rnd),
+      "EXPTIME": _fake_exposure(rnd),
+      "TMS-LT": _fake_time(rnd),
+      "DATE-OBS": _fake_date(rnd),
+      "FILTER": _fake_filter(rnd, filter_names),
+    } for _ in range(n)]
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~SYNTHETIC PLATES~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def make_plate(path, size, n_stars=20000, fwhm=4., seed=1, chunk_rows=512):
+  """
+  writes a size x size uint16 plate with a noisy background and
+  n_stars gaussian stars to path.
+
+  The data is generated in row chunks and streamed out, so this works
+  for realistic (14k x 14k) sizes without holding the plate in memory.
+  """
+  rng = np.random.default_rng(seed)
+  sigma = fwhm/2.3548
+  half = int(4*sigma)+1
+  xs = rng.uniform(0, size, n_stars)
+  ys = rng.uniform(0, size, n_stars)
+  amps = 20000*rng.power(0.3, n_stars)+200
+  order = np.argsort(ys)
+  xs, ys, amps = xs[order], ys[order], amps[order]
+
+  hdr = fits.Header()
+  hdr["SIMPLE"] = True
+  hdr["BITPIX"] = 16
+  hdr["NAXIS"] = 2
+  hdr["NAXIS1"] = size
+  hdr["NAXIS2"] = size
+  hdr["BZERO"] = 32768
+  hdr["BSCALE"] = 1
+  hdr["OBJECT"] = "synthetic"
+  out = fits.StreamingHDU(path, hdr)
+
+  offsets = np.arange(-half, half+1)
+  for row0 in range(0, size, chunk_rows):
+    row1 = min(row0+chunk_rows, size)
+    chunk = rng.normal(3000, 60, (row1-row0, size))
+    lo, hi = np.searchsorted(ys, [row0-half, row1+half])
+    for x, y, amp in zip(xs[lo:hi], ys[lo:hi], amps[lo:hi]):
+      yy = np.floor(y).astype(int)+offsets
+      xx = np.floor(x).astype(int)+offsets
+      yy = yy[(yy>=row0)&(yy<row1)]
+      xx = xx[(xx>=0)&(xx<size)]
+      if not len(yy) or not len(xx):
+        continue
+      stamp = amp*np.exp(-((xx[None,:]-x)**2+(yy[:,None]-y)**2)/(2*sigma**2))
+      chunk[yy[0]-row0:yy[-1]-row0+1, xx[0]:xx[-1]+1] += stamp
+    # BITPIX=16 with BZERO=32768: StreamingHDU wants the on-disk int16
+    out.write((np.clip(chunk, 0, 65535).astype(np.uint16)^0x8000
+      ).view(np.int16))
+  out.close()
+  return path
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~BENCHMARKS~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def timeit(func, repeat=1):
+  """
+  returns the best wall clock time of repeat calls of func.
+  """
+  best = None
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    func()
+    elapsed = time.perf_counter()-t0
+    if best is None or elapsed<best:
+      best = elapsed
+  return best
+
+
+def _run_parser(func, values):
+  failures = 0
+  for val in values:
+    try:
+      func(val)
+    except (ValueError, KeyError, IndexError, TypeError):
+      failures += 1
+  return failures
+
+
+def bench_parsers(af, rows, repeat):
+  def normalize_filters(raw):
+    return [af.FILTERS_ENG["".join(filt.split()).lower()]
+      for filt in raw.replace(" ","").replace(".","").replace(",",";"
+        ).replace("+",";").split(";")]
+
+  parsers = [
+    ("parse.ra", af.reformat_ra, "RA"),
+    ("parse.dec", af.reformat_dec, "DEC"),
+    ("parse.exposure", af.get_exposure_cards, "EXPTIME"),
+    ("parse.time", af.reformat_time, "TMS-LT"),
+    ("parse.date", af.get_date_cards, "DATE-OBS"),
+    ("parse.filter", normalize_filters, "FILTER"),
+  ]
+  for name, func, column in parsers:
+    values = [row[column] for row in rows]
+    failures = _run_parser(func, values)
+    secs = timeit(lambda: _run_parser(func, values), repeat)
+    yield {"bench": name, "n": len(values), "seconds": secs,
+      "failures": failures}
+
+
+def bench_header(af, rows, repeat):
+  from gavo.helpers import fitstricks
+  template = fits.Header()
+  template["SIMPLE"] = True
+  template["BITPIX"] = 16
+  template["NAXIS"] = 2
+  template["NAXIS1"] = 14000
+  template["NAXIS2"] = 14000
+
+  def build_all():
+    for row in rows:
+      fitstricks.makeHeaderFromTemplate(
+        fitstricks.WFPDB_TEMPLATE,
+        originalHeader=template,
+        OBJECT="lam Ori",
+        OBSERVAT="Fesenkov Astrophysical Institute",
+        SITELONG=43.17667, SITELAT=76.96611, SITEELEV=1450,
+        PID=row["ID"],
+        DETNAME="Photographic plate")
+
+  yield {"bench": "header.build", "n": len(rows),
+    "seconds": timeit(build_all, repeat)}
+
+
+def bench_plate_io(plate_path, neg2pos, work_dir, repeat):
+  size = os.path.getsize(plate_path)
+
+  def write_like_writePlate(src, dest):
+    with fits.open(src) as hdul:
+      hdul[0].header["OBJECT"] = "lam Ori"
+      plate_io.write_with_checksums(hdul, dest, output_verify="fix",
+        overwrite=True)
+  yield {"bench": "fits.write", "n": 1, "bytes": size,
+    "seconds": timeit(lambda: write_like_writePlate(plate_path,
+      os.path.join(work_dir, "out.fit")), repeat)}
+
+  # annotate_fits.py writes plates back onto the (memory-mapped) file
+  # they were read from
+  in_place = os.path.join(work_dir, "in_place.fit")
+  shutil.copy(plate_path, in_place)
+  with fits.open(plate_path) as hdul:
+    expected = plate_io.data_hash(plate_io.plate_hdu(hdul))
+  seconds = timeit(lambda: write_like_writePlate(in_place, in_place), repeat)
+  with fits.open(in_place) as hdul:
+    if plate_io.data_hash(plate_io.plate_hdu(hdul))!=expected:
+      raise AssertionError("Writing a plate onto itself changed its data")
+  yield {"bench": "fits.rewrite", "n": 1, "bytes": size,
+    "seconds": seconds}
+
+  def convert():
+    conv_dir = os.path.join(work_dir, "converted")
+    os.makedirs(conv_dir, exist_ok=True)
+    target = os.path.join(conv_dir, "plate.fit")
+    shutil.copy(plate_path, target)
+    owd = os.getcwd()
+    os.chdir(conv_dir)
+    try:
+      t0 = time.perf_counter()
+      neg2pos.convert_one(target)
+      return time.perf_counter()-t0
+    finally:
+      os.chdir(owd)
+  yield {"bench": "neg2pos.convert", "n": 1, "bytes": size,
+    "seconds": min(convert() for _ in range(repeat))}
+
+
+def find_executable(*names):
+  for name in names:
+    path = shutil.which(name)
+    if path:
+      return path
+  return None
+
+
+def bench_sextractor(plate_path, work_dir, repeat):
+  sex = find_executable("source-extractor", "sex")
+  if not sex:
+    return
+  params = os.path.join(BIN_DIR, "default.param")
+
+  def run():
+    subprocess.run([sex, plate_path,
+      "-PARAMETERS_NAME", params,
+      "-CATALOG_NAME", os.path.join(work_dir, "bench.xyls"),
+      "-CATALOG_TYPE", "FITS_1.0",
+      "-DETECT_MINAREA", "20", "-DETECT_THRESH", "5",
+      "-SEEING_FWHM", "1.2", "-FILTER", "N",
+      "-VERBOSE_TYPE", "QUIET"], check=True, cwd=work_dir)
+  yield {"bench": "sextractor", "n": 1, "seconds": timeit(run, repeat)}
+
+
+def bench_solve(plate_path, work_dir, timelimit):
+  solver = find_executable("solve-field")
+  if not solver:
+    return
+
+  t0 = time.perf_counter()
+  proc = subprocess.run([solver, "--overwrite", "--no-plots",
+    "--dir", work_dir, "--cpulimit", str(timelimit),
+    "--scale-units", "arcsecperpix", "--scale-low", "3", "--scale-high", "6",
+    plate_path], cwd=work_dir, stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL)
+  solved = os.path.exists(os.path.join(work_dir,
+    os.path.splitext(os.path.basename(plate_path))[0]+".solved"))
+  yield {"bench": "solve-field", "n": 1,
+    "seconds": time.perf_counter()-t0, "solved": solved,
+    "returncode": proc.returncode}
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~RESULTS~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def git_revision():
+  """
+  returns the current commit and whether the work tree has changes.
+  """
+  try:
+    rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+      cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    dirty = bool(subprocess.run(["git", "status", "--porcelain",
+      "--untracked-files=no"], cwd=REPO_DIR, capture_output=True,
+      text=True).stdout.strip())
+    return rev, dirty
+  except (OSError, subprocess.CalledProcessError):
+    return None, None
+
+
+def store_results(results, dest, **context):
+  """
+  appends results to the JSON lines file dest, each annotated with the
+  commit and context.
+  """
+  rev, dirty = git_revision()
+  stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+  with open(dest, "a", encoding="utf-8") as f:
+    for res in results:
+      rec = {"commit": rev, "dirty": dirty, "date": stamp,
+        "host": platform.node()}
+      rec.update(context)
+      rec.update(res)
+      f.write(json.dumps(rec)+"\n")
+
+
+def load_results(path):
+  if not os.path.exists(path):
+    return []
+  with open(path, encoding="utf-8") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def latest_by_bench(records, commit=None):
+  """
+  returns a dict bench name -> most recent record (of commit, if given).
+
+  >>> recs = [{"commit": "a", "bench": "x", "seconds": 2},
+  ...   {"commit": "b", "bench": "x", "seconds": 1}]
+  >>> latest_by_bench(recs)["x"]["seconds"]
+  1
+  >>> latest_by_bench(recs, "a")["x"]["seconds"]
+  2
+  """
+  res = {}
+  for rec in records:
+    if commit is None or rec.get("commit")==commit:
+      res[rec["bench"]] = rec
+  return res
+
+
+def format_comparison(current, reference):
+  lines = [f"{'bench':<20}{'now [s]':>12}{'ref [s]':>12}{'ratio':>8}"]
+  for name, rec in current.items():
+    ref = reference.get(name)
+    ref_secs = ref["seconds"] if ref else None
+    ratio = rec["seconds"]/ref_secs if ref_secs else None
+    lines.append(f"{name:<20}{rec['seconds']:>12.4f}"
+      +(f"{ref_secs:>12.4f}{ratio:>8.2f}" if ref else f"{'-':>12}{'-':>8}"))
+  return "\n".join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Offline benchmarks for the plate pipeline")
+  parser.add_argument("--rows", type=int, default=20000,
+    help="number of synthetic logbook rows")
+  parser.add_argument("--plate-size", type=int, default=14000,
+    help="width and height of the synthetic plate in pixels")
+  parser.add_argument("--stars", type=int, default=20000,
+    help="number of stars injected into the synthetic plate")
+  parser.add_argument("--plate", help="benchmark this (real) plate"
+    " instead of a synthetic one; needed for meaningful solve timings")
+  parser.add_argument("--repeat", type=int, default=3,
+    help="repetitions per benchmark (the best one is reported)")
+  parser.add_argument("--solve-timelimit", type=int, default=180,
+    help="cpu limit for solve-field")
+  parser.add_argument("--only", action="append", default=[],
+    help="only run benchmark groups with this prefix (parse, header,"
+    " fits, neg2pos, sextractor, solve-field); may be repeated")
+  parser.add_argument("--results", default="bench_results.jsonl",
+    help="where to append results")
+  parser.add_argument("--compare", metavar="REV",
+    help="compare with the latest results stored for this commit")
+  parser.add_argument("--tmp-dir", default=None,
+    help="directory for the synthetic plate and outputs")
+  args = parser.parse_args()
+
+  af, neg2pos, replaced = import_pipeline()
+  if replaced:
+    print("Using stand-ins for: "+", ".join(replaced))
+
+  def wanted(name):
+    return not args.only or any(name.startswith(p) for p in args.only)
+
+  results = []
+  def report(gen):
+    for res in gen:
+      if wanted(res["bench"]):
+        print(f"{res['bench']:<20}{res['seconds']:>10.4f} s"
+          f"  (n={res['n']}"+(f", {res['failures']} failed)"
+            if res.get("failures") else ")"))
+        results.append(res)
+
+  rows = make_logbook_rows(args.rows,
+    [k for k in af.FILTERS_ENG if k])
+  if wanted("parse"):
+    report(bench_parsers(af, rows, args.repeat))
+  if wanted("header"):
+    report(bench_header(af, rows, args.repeat))
+
+  work_dir = tempfile.mkdtemp(prefix="platebench", dir=args.tmp_dir)
+  plate_path = args.plate
+  try:
+    if not plate_path and any(wanted(n)
+        for n in ["fits", "neg2pos", "sextractor", "solve-field"]):
+      plate_path = os.path.join(work_dir, "synthetic.fit")
+      t0 = time.perf_counter()
+      make_plate(plate_path, args.plate_size, args.stars)
+      print(f"(synthetic plate generated in {time.perf_counter()-t0:.1f} s)")
+
+    if plate_path:
+      report(bench_plate_io(plate_path, neg2pos, work_dir, args.repeat))
+      report(bench_sextractor(plate_path, work_dir, args.repeat))
+      if args.plate:
+        report(bench_solve(plate_path, work_dir, args.solve_timelimit))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  store_results(results, args.results,
+    standins=bool(replaced), rows=args.rows,
+    plate_size=args.plate_size if plate_path and not args.plate else None,
+    plate=args.plate)
+
+  if args.compare:
+    reference = latest_by_bench(load_results(args.results), args.compare)
+    print()
+    print(format_comparison(
+      dict((r["bench"], r) for r in results), reference))
+
+
+if __name__=="__main__":
+  main()
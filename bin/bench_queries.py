@@ -0,0 +1,325 @@
+"""
+Query benchmarks for the main table.
+
+This fills a scratch table shaped like the main table of q.rd (plate
+centre, pgsphere coverage polygon, dateObs, exptime, telescope) with
+synthetic plates, many of them repeated pointings at popular targets,
+and times the kinds of queries imagecore and the cal core run: spatial,
+temporal, spatial plus temporal, and the calibration search by date,
+exposure and telescope.
+
+Every kind is timed first with only the GIST index on coverage (what
+the //siap#pgs mixin gives) and then again after each of the tuning
+steps in TUNING_STEPS (indexes on dateObs, exptime and telescope,
+clustering the table on the HEALPix index of the plate centres), which
+are applied one after the other, so each step's gain shows on its own.
+q.rd declares the steps that paid off in such a run, which is only the
+dateObs index.
+
+Each kind runs --queries random parameter sets after a warm-up pass;
+the median latency goes, as in bench_plates.py, to bench_results.jsonl
+with the current commit.
+
+It needs psycopg2 and a database with pgsphere (1.2 or later for
+healpix_nest); the scratch schema is dropped at the end unless --keep
+is given.  Where pgsphere is not installed, --geometry builtin uses
+PostgreSQL's planar polygons (degrees as plane coordinates, with the
+same kind of GIST index) for the coverage and clusters on cells of
+0.1 degrees instead of HEALPix; the non-spatial conditions and their
+indexes are the same in both modes.
+
+  python bin/bench_queries.py --dsn "dbname=gavo" [--rows 200000]
+"""
+
+import argparse
+import io
+import random
+import statistics
+import time
+
+import numpy as np
+import psycopg2
+
+import bench_plates
+
+SCHEMA = "bench_queries"
+TELESCOPES = ["Maksutov 50cm", "Maksutov 50cm (prism)", "Schmidt"]
+# 1950-01-01 to 1990-01-01
+MJD_RANGE = (33282., 47892.)
+FIELD = 5.
+
+BASELINE_INDEXES = [
+  "CREATE INDEX ON {table} USING GIST (coverage)",
+]
+# candidate tuning, applied (and timed) one step after the other
+TUNING_STEPS = [
+  ("dateobs", ["CREATE INDEX ON {table} (dateObs)"]),
+  ("exptime", ["CREATE INDEX ON {table} (exptime)"]),
+  ("telescope", ["CREATE INDEX ON {table} (telescope)"]),
+  ("cluster", ["CREATE INDEX main_healpix ON {table} (({cluster_key}))",
+    "CLUSTER {table} USING main_healpix"]),
+]
+
+# the spatial parts of the table and the queries (see --geometry)
+GEOMETRIES = {
+  "pgsphere": {
+    "type": "SPOLY",
+    "spatial": "coverage && scircle(spoint(RADIANS(%(ra)s),"
+      " RADIANS(%(dec)s)), RADIANS(%(radius)s))",
+    "cluster_key": "healpix_nest(10, spoint(RADIANS(centerAlpha),"
+      " RADIANS(centerDelta)))"},
+  "builtin": {
+    "type": "POLYGON",
+    "spatial": "coverage && polygon(12, circle(point(%(ra)s, %(dec)s),"
+      " %(radius)s))",
+    "cluster_key": "floor(centerDelta*10)*3600+floor(centerAlpha*10)"},
+}
+
+_SPATIAL = "{spatial}"
+_TEMPORAL = "dateObs BETWEEN %(mjd_min)s AND %(mjd_max)s"
+_EXPOSURE = "exptime BETWEEN %(exp_min)s AND %(exp_max)s"
+_TELESCOPE = "telescope=%(telescope)s"
+QUERIES = {
+  "spatial": [_SPATIAL],
+  "temporal": [_TEMPORAL],
+  "spatial+temporal": [_SPATIAL, _TEMPORAL],
+  "cal": [_TEMPORAL, _EXPOSURE, _TELESCOPE],
+}
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~SYNTHETIC PLATES~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def box_polygon(ra, dec, field=FIELD, geometry="pgsphere"):
+  """
+  returns a polygon literal of geometry for the square field centred on
+  ra, dec (degrees).
+
+  >>> box_polygon(10., 20., 2.)
+  '{(8.93582d,19.00000d),(11.06418d,19.00000d),(11.06418d,21.00000d),(8.93582d,21.00000d)}'
+  >>> box_polygon(10., 20., 2., "builtin")
+  '((8.93582,19.00000),(11.06418,19.00000),(11.06418,21.00000),(8.93582,21.00000))'
+  """
+  half = field/2
+  half_ra = half/max(np.cos(np.radians(dec)), 0.2)
+  dec_min, dec_max = max(dec-half, -89.9), min(dec+half, 89.9)
+  corners = [(ra-half_ra, dec_min), (ra+half_ra, dec_min),
+    (ra+half_ra, dec_max), (ra-half_ra, dec_max)]
+  if geometry=="builtin":
+    return "("+",".join(f"({a:.5f},{d:.5f})" for a, d in corners)+")"
+  return "{"+",".join(f"({a%360:.5f}d,{d:.5f}d)" for a, d in corners)+"}"
+
+
+def make_plates(n, field=FIELD, seed=1, geometry="pgsphere"):
+  """
+  returns n synthetic plates as (accref, ra, dec, polygon, mjd, exptime,
+  telescope) tuples.
+
+  Half of the plates are repeated pointings at n/50 targets (so spatial
+  queries find stacks of plates), the rest are spread over the sky
+  visible from Almaty; plates are taken in nights of a few each.
+  """
+  rnd = np.random.default_rng(seed)
+  n_targets = max(1, n//50)
+  target_ra = rnd.uniform(0, 360, n_targets)
+  target_dec = np.degrees(np.arcsin(rnd.uniform(-0.5, 1, n_targets)))
+  on_target = rnd.random(n)<0.5
+  target = rnd.integers(0, n_targets, n)
+  ra = np.where(on_target, target_ra[target]+rnd.normal(0, 0.2, n),
+    rnd.uniform(0, 360, n))%360
+  dec = np.where(on_target, target_dec[target]+rnd.normal(0, 0.2, n),
+    np.degrees(np.arcsin(rnd.uniform(-0.5, 1, n))))
+  dec = np.clip(dec, -89.9, 89.9)
+  nights = rnd.uniform(*MJD_RANGE, n//4+1).round()
+  mjd = nights[rnd.integers(0, len(nights), n)]+rnd.uniform(0.6, 0.95, n)
+  exptime = np.exp(rnd.uniform(np.log(30), np.log(7200), n)).round()
+  telescope = rnd.choice(len(TELESCOPES), n, p=[0.8, 0.15, 0.05])
+  return [(f"bench/{i:07d}.fit", float(ra[i]), float(dec[i]),
+      box_polygon(ra[i], dec[i], field, geometry), float(mjd[i]),
+      float(exptime[i]),
+      TELESCOPES[telescope[i]])
+    for i in range(n)]
+
+
+def query_params(rnd, plates):
+  """
+  returns a parameter dict for the queries in QUERIES, centred on a
+  random plate so that spatial queries find something.
+  """
+  _, ra, dec, _, mjd, exptime, telescope = rnd.choice(plates)
+  return {"ra": ra, "dec": dec, "radius": 0.5,
+    "mjd_min": mjd-365, "mjd_max": mjd+365,
+    "exp_min": exptime/2, "exp_max": exptime*2, "telescope": telescope}
+
+
+def fill_table(cursor, table, plates, geometry="pgsphere"):
+  cursor.execute(f"CREATE TABLE {table} (accref TEXT, centerAlpha DOUBLE"
+    " PRECISION, centerDelta DOUBLE PRECISION, coverage"
+    f" {GEOMETRIES[geometry]['type']}, dateObs DOUBLE PRECISION,"
+    " exptime REAL, telescope TEXT)")
+  buf = io.StringIO()
+  for plate in plates:
+    buf.write("\t".join(str(val) for val in plate)+"\n")
+  buf.seek(0)
+  cursor.copy_expert(f"COPY {table} FROM STDIN", buf)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~BENCHMARKS~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def query_sql(table, conditions, geometry="pgsphere"):
+  """
+  returns the SELECT statement for conditions on table.
+
+  >>> query_sql("s.main", QUERIES["cal"])
+  'SELECT accref, centerAlpha, centerDelta, dateObs FROM s.main WHERE dateObs BETWEEN %(mjd_min)s AND %(mjd_max)s AND exptime BETWEEN %(exp_min)s AND %(exp_max)s AND telescope=%(telescope)s'
+  >>> query_sql("s.main", QUERIES["spatial"], "builtin")[-67:]
+  'coverage && polygon(12, circle(point(%(ra)s, %(dec)s), %(radius)s))'
+  """
+  return (f"SELECT accref, centerAlpha, centerDelta, dateObs FROM {table}"
+    " WHERE "+" AND ".join(cond.format(**GEOMETRIES[geometry])
+      for cond in conditions))
+
+
+def bench_kind(cursor, table, kind, param_sets, geometry="pgsphere"):
+  """
+  returns a result record for the queries of kind with param_sets.
+  """
+  sql = query_sql(table, QUERIES[kind], geometry)
+  for params in param_sets:
+    cursor.execute(sql, params)
+    cursor.fetchall()
+  latencies, n_rows = [], 0
+  for params in param_sets:
+    t0 = time.perf_counter()
+    cursor.execute(sql, params)
+    n_rows += len(cursor.fetchall())
+    latencies.append(time.perf_counter()-t0)
+  latencies.sort()
+  return {"bench": f"query-{kind}", "seconds": statistics.median(latencies),
+    "p95": latencies[int(0.95*(len(latencies)-1))], "n": len(latencies),
+    "rows": n_rows/len(latencies)}
+
+
+def explain(cursor, table, kind, params, geometry="pgsphere"):
+  cursor.execute("EXPLAIN "+query_sql(table, QUERIES[kind], geometry),
+    params)
+  return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def bench_variant(cursor, table, variant, param_sets, show_plans,
+    geometry="pgsphere"):
+  results = []
+  for kind in QUERIES:
+    res = bench_kind(cursor, table, kind, param_sets, geometry)
+    res["bench"] += "-"+variant
+    print(f"{res['bench']:<36}{res['seconds']*1000:>9.2f} ms"
+      f"  (p95 {res['p95']*1000:.2f} ms, {res['rows']:.1f} rows)")
+    if show_plans:
+      print(explain(cursor, table, kind, param_sets[0], geometry))
+    results.append(res)
+  return results
+
+
+def format_steps(variants):
+  """
+  returns a table of the median latencies (ms) of each query kind in
+  variants, a list of (variant, results of bench_variant).
+
+  >>> print(format_steps([
+  ...   ("baseline", [{"bench": "query-cal-baseline", "seconds": 0.002}]),
+  ...   ("+dateobs", [{"bench": "query-cal-+dateobs", "seconds": 0.001}])]))
+  kind (median ms)                 baseline   +dateobs
+  cal                                  2.00       1.00
+  """
+  lines = [f"{'kind (median ms)':<30}"+"".join(f"{variant:>11}"
+    for variant, _ in variants)]
+  for i, res in enumerate(variants[0][1]):
+    kind = res["bench"][len("query-"):-len("-"+variants[0][0])]
+    lines.append(f"{kind:<30}"+"".join(
+      f"{results[i]['seconds']*1000:>11.2f}" for _, results in variants))
+  return "\n".join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Benchmark main table queries with and without tuning")
+  parser.add_argument("--dsn", default="dbname=gavo",
+    help="libpq connection string of a database with pgsphere")
+  parser.add_argument("--rows", type=int, default=200000,
+    help="number of synthetic plates")
+  parser.add_argument("--queries", type=int, default=50,
+    help="parameter sets per query kind")
+  parser.add_argument("--field", type=float, default=FIELD,
+    help="edge of the synthetic plates in degrees")
+  parser.add_argument("--geometry", choices=sorted(GEOMETRIES),
+    default="pgsphere", help="how coverage is stored and queried"
+    " (builtin where pgsphere is not installed)")
+  parser.add_argument("--explain", action="store_true",
+    help="print the query plans")
+  parser.add_argument("--keep", action="store_true",
+    help="keep the scratch schema "+SCHEMA)
+  parser.add_argument("--results", default="bench_results.jsonl",
+    help="where to append results")
+  parser.add_argument("--compare", metavar="REV",
+    help="compare with the latest results stored for this commit")
+  args = parser.parse_args()
+
+  table = SCHEMA+".main"
+  plates = make_plates(args.rows, args.field, geometry=args.geometry)
+  rnd = random.Random(2)
+  param_sets = [query_params(rnd, plates) for _ in range(args.queries)]
+
+  conn = psycopg2.connect(args.dsn)
+  conn.autocommit = True
+  cursor = conn.cursor()
+  try:
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    t0 = time.perf_counter()
+    fill_table(cursor, table, plates, args.geometry)
+    for statement in BASELINE_INDEXES:
+      cursor.execute(statement.format(table=table))
+    cursor.execute(f"ANALYZE {table}")
+    print(f"({args.rows} plates loaded in {time.perf_counter()-t0:.1f} s)")
+    variants = [("baseline", bench_variant(cursor, table, "baseline",
+      param_sets, args.explain, args.geometry))]
+
+    for step, statements in TUNING_STEPS:
+      t0 = time.perf_counter()
+      for statement in statements:
+        cursor.execute(statement.format(table=table,
+          cluster_key=GEOMETRIES[args.geometry]["cluster_key"]))
+      cursor.execute(f"ANALYZE {table}")
+      print(f"(+{step} took {time.perf_counter()-t0:.1f} s)")
+      variants.append(("+"+step, bench_variant(cursor, table, "+"+step,
+        param_sets, args.explain, args.geometry)))
+  finally:
+    if not args.keep:
+      cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    conn.close()
+
+  results = [res for _, variant_results in variants
+    for res in variant_results]
+  bench_plates.store_results(results, args.results, rows=args.rows,
+    queries=args.queries, field=args.field, geometry=args.geometry)
+
+  print()
+  print(format_steps(variants))
+  print()
+  (last, tuned), (_, baseline) = variants[-1], variants[0]
+  print(bench_plates.format_comparison(
+    dict((r["bench"][:-len(last)-1], r) for r in tuned),
+    dict((r["bench"][:-len("-baseline")], r) for r in baseline)))
+  if args.compare:
+    reference = bench_plates.latest_by_bench(
+      bench_plates.load_results(args.results), args.compare)
+    print()
+    print(bench_plates.format_comparison(
+      dict((r["bench"], r) for r in results), reference))
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,316 @@
+"""
+A HiPS (hierarchical progressive survey) of the solved plates.
+
+Every tile of the deepest order is filled by sampling, for each of its
+512x512 HEALPix pixels, the nearest plate pixel (through the plate's
+WCS, SIP included), taking each sky pixel from the plate on which it is
+closest to the centre.  Plates are read through HDU sections, so only
+the rows (or, for compressed plates, the tiles) under a HiPS tile are
+read.  The lower orders are 2x2 averages of their children.  Tiles are
+written as FITS (uint16, 0 is blank) and PNG; they are rendered tile
+by tile in a process pool.
+
+hips/plates.json records for each plate its content key (DATAHASH) and
+the deepest-order tiles it touches; a rerun only renders the tiles of
+new, changed and removed plates and their parents.  The static hips
+service of q.rd serves the directory.
+
+  python bin/build_hips.py data/*.fit [--workers 8]
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import functools
+import json
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import healpix
+import make_previews
+import plate_io
+import platesolve
+
+HIPS_DIR = "hips"
+# log2 of the tile width; tiles are 512x512
+TILE_ORDER = 9
+TILE_WIDTH = 1<<TILE_ORDER
+# the deepest order is chosen for HiPS pixels no larger than the plate
+# pixels, but not beyond this
+MAX_ORDER = 12
+
+
+def tile_path(hips_dir, order, npix, ext):
+  """
+  returns the path of a HiPS tile.
+
+  >>> tile_path("hips", 3, 12345, "fits")
+  'hips/Norder3/Dir10000/Npix12345.fits'
+  """
+  return os.path.join(hips_dir, f"Norder{order}",
+    f"Dir{npix//10000*10000}", f"Npix{npix}.{ext}")
+
+
+def tile_radec(order, npix):
+  """
+  returns RA and Dec arrays (degrees) of the pixel centres of a tile,
+  in the layout of a FITS tile.
+
+  Tile pixel [row, col] is the HEALPix pixel of order order+TILE_ORDER
+  with ix = TILE_WIDTH-1-row and iy = col within the tile.
+  """
+  ix0, iy0, face = healpix.nest_to_xyf(order, npix)
+  rows, cols = np.mgrid[:TILE_WIDTH, :TILE_WIDTH]
+  nside = 1<<(order+TILE_ORDER)
+  ix = ix0*TILE_WIDTH+TILE_WIDTH-1-rows
+  iy = iy0*TILE_WIDTH+cols
+  return healpix.face_to_radec((ix+0.5)/nside, (iy+0.5)/nside,
+    np.full(ix.shape, face))
+
+
+def deepest_order(scales):
+  """
+  returns the tile order at which HiPS pixels are no larger than the
+  median of the plate scales (arcsec/pixel).
+
+  >>> deepest_order([2.0, 2.1, 1.9])
+  8
+  """
+  scale = float(np.median(scales))
+  for order in range(MAX_ORDER+1):
+    if healpix.pixel_size(order+TILE_ORDER)<=scale:
+      return order
+  return MAX_ORDER
+
+
+def render_tile(order, npix, plates):
+  """
+  returns the uint16 pixels of a deepest-order tile from the plates
+  (paths) overlapping it; 0 marks pixels no plate covers.
+  """
+  ra, dec = tile_radec(order, npix)
+  result = np.zeros(ra.shape, dtype=np.uint16)
+  best = np.full(ra.shape, np.inf)
+  for path in plates:
+    plate_wcs, width, height = healpix.plate_wcs(path)
+    x, y = plate_wcs.all_world2pix(ra, dec, 0, quiet=True)
+    x, y = np.round(x), np.round(y)
+    # distance from the plate centre in units of the plate size
+    dist = ((x-width/2)/width)**2+((y-height/2)/height)**2
+    use = ((x>=0) & (x<width) & (y>=0) & (y<height) & (dist<best))
+    if not use.any():
+      continue
+    x, y = x[use].astype(int), y[use].astype(int)
+    x0, y0 = x.min(), y.min()
+    with fits.open(path) as hdul:
+      pixels = plate_io.plate_hdu(hdul).section[
+        y0:y.max()+1, x0:x.max()+1]
+    result[use] = np.clip(pixels[y-y0, x-x0], 1, 65535)
+    best[use] = dist[use]
+  return result
+
+
+def combine_children(children):
+  """
+  returns the parent tile of the four child tiles (nested order; None
+  for missing children), averaging 2x2 pixels and ignoring blanks.
+
+  >>> c = np.full((4, 4), 10, dtype=np.uint16)
+  >>> c[0, 0] = 0
+  >>> combine_children([c, None, None, None])[2:, :2].tolist()
+  [[10, 10], [10, 10]]
+  """
+  width = next(c for c in children if c is not None).shape[0]
+  half = width//2
+  parent = np.zeros((width, width), dtype=np.uint16)
+  for index, child in enumerate(children):
+    if child is None:
+      continue
+    blocks = child.reshape(half, 2, half, 2)
+    counts = (blocks>0).sum(axis=(1, 3))
+    sums = blocks.sum(axis=(1, 3), dtype=np.int64)
+    means = np.where(counts, sums//np.maximum(counts, 1), 0)
+    # the x bit of the child index selects the upper ix (lower rows)
+    row0 = 0 if index&1 else half
+    col0 = half if index&2 else 0
+    parent[row0:row0+half, col0:col0+half] = means
+  return parent
+
+
+def read_tile(hips_dir, order, npix):
+  path = tile_path(hips_dir, order, npix, "fits")
+  if not os.path.exists(path):
+    return None
+  return fits.getdata(path)
+
+
+def write_tile(hips_dir, order, npix, pixels, cut):
+  """
+  writes pixels as the FITS and PNG versions of a tile, or removes the
+  tile if it is all blank.
+  """
+  paths = [tile_path(hips_dir, order, npix, ext) for ext in ("fits", "png")]
+  if not pixels.any():
+    for path in paths:
+      if os.path.exists(path):
+        os.unlink(path)
+    return
+  os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+  fits.PrimaryHDU(pixels).writeto(paths[0], overwrite=True)
+  low, high = cut
+  scaled = np.clip((pixels.astype(np.float32)-low)/(high-low), 0, 1)
+  scaled[pixels==0] = 0
+  # PNG tiles are flipped with respect to FITS tiles
+  make_previews.write_png((scaled[::-1]*255+0.5).astype(np.uint8), paths[1])
+
+
+def build_deepest(hips_dir, order, npix, plates, cut):
+  write_tile(hips_dir, order, npix, render_tile(order, npix, plates), cut)
+  return npix
+
+
+def build_parent(hips_dir, order, npix, cut):
+  children = [read_tile(hips_dir, order+1, 4*npix+i) for i in range(4)]
+  if any(c is not None for c in children):
+    pixels = combine_children(children)
+  else:
+    pixels = np.zeros((TILE_WIDTH, TILE_WIDTH), dtype=np.uint16)
+  write_tile(hips_dir, order, npix, pixels, cut)
+  return npix
+
+
+def pixel_cut(plates):
+  """
+  returns the display range for the PNG tiles from the quality cards
+  of the plates (median background minus two sigma to the median
+  dynamic range).
+  """
+  headers = [plate_io.read_plate_header(path) for path in plates]
+  back = np.median([h.get("QBACK", 0) for h in headers])
+  noise = np.median([h.get("QNOISE", 0) for h in headers])
+  dynamic = np.median([h.get("QDYNRNG", 65535) for h in headers])
+  low = max(back-2*noise, 0)
+  return low, max(min(back+dynamic, 65535), low+1)
+
+
+def write_properties(hips_dir, order, cut, plates, creator_did):
+  headers = [plate_io.read_plate_header(path) for path in plates]
+  props = [
+    ("creator_did", creator_did),
+    ("obs_title", "FAI 50 cm Meniskus Maksutov telescope plates"),
+    ("obs_description",
+      "Photographic plates of the FAI 50 cm Maksutov telescope"),
+    ("dataproduct_type", "image"),
+    ("hips_version", "1.4"),
+    ("hips_release_date",
+      datetime.datetime.now(datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%MZ")),
+    ("hips_status", "public master clonableOnce"),
+    ("hips_tile_format", "fits png"),
+    ("hips_tile_width", str(TILE_WIDTH)),
+    ("hips_order", str(order)),
+    ("hips_order_min", "0"),
+    ("hips_frame", "equatorial"),
+    ("hips_pixel_bitpix", "16"),
+    ("hips_pixel_cut", f"{cut[0]:g} {cut[1]:g}"),
+    ("hips_initial_ra", f"{np.median([h['CRVAL1'] for h in headers]):.4f}"),
+    ("hips_initial_dec", f"{np.median([h['CRVAL2'] for h in headers]):.4f}"),
+    ("hips_initial_fov", "10"),
+    ("data_pixel_bitpix", "16"),
+    ("obs_regime", "Optical"),
+  ]
+  with open(os.path.join(hips_dir, "properties"), "w") as f:
+    f.write("".join(f"{key:<20}= {val}\n" for key, val in props))
+
+
+def read_properties(hips_dir):
+  props = {}
+  path = os.path.join(hips_dir, "properties")
+  if os.path.exists(path):
+    with open(path) as f:
+      for line in f:
+        if "=" in line and not line.startswith("#"):
+          key, val = line.split("=", 1)
+          props[key.strip()] = val.strip()
+  return props
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Build or update a HiPS of the solved plates")
+  parser.add_argument("plates", nargs="+",
+    help="all plate FITS files of the collection (unsolved ones are skipped)")
+  parser.add_argument("--hips-dir", default=HIPS_DIR,
+    help="where the HiPS goes (q.rd serves hips/ statically)")
+  parser.add_argument("--order", type=int, default=None,
+    help="deepest tile order (default: from the plate scales; fixed once"
+      " the HiPS exists)")
+  parser.add_argument("--cut", type=float, nargs=2, default=None,
+    help="pixel values mapped to black and white in PNG tiles")
+  parser.add_argument("--creator-did",
+    default="ivo://fai.kz/maksutov_50_telescope/hips",
+    help="IVOA identifier of the HiPS")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of tiles rendered in parallel")
+  args = parser.parse_args()
+
+  os.makedirs(args.hips_dir, exist_ok=True)
+  solved = [path for path in args.plates
+    if "CRVAL1" in plate_io.read_plate_header(path)]
+  if not solved:
+    parser.error("No solved plates given")
+  props = read_properties(args.hips_dir)
+  order = int(props.get("hips_order", args.order if args.order is not None
+    else deepest_order([platesolve.pixel_scale(
+      plate_io.read_plate_header(path)) for path in solved])))
+  cut = args.cut or ([float(v) for v in props["hips_pixel_cut"].split()]
+    if "hips_pixel_cut" in props else pixel_cut(solved))
+
+  state_path = os.path.join(args.hips_dir, "plates.json")
+  state = {}
+  if os.path.exists(state_path):
+    with open(state_path) as f:
+      state = json.load(f)
+
+  changed = set()
+  new_state = {}
+  for path in solved:
+    key = plate_io.content_key(path)
+    previous = state.get(path)
+    if previous and previous["key"]==key:
+      new_state[path] = previous
+    else:
+      new_state[path] = {"key": key, "tiles": healpix.plate_tiles(path, order)}
+      changed.update(new_state[path]["tiles"])
+    if previous and previous["key"]!=key:
+      changed.update(previous["tiles"])
+  for path in set(state)-set(new_state):
+    changed.update(state[path]["tiles"])
+
+  tile_plates = {}
+  for path, entry in new_state.items():
+    for npix in entry["tiles"]:
+      tile_plates.setdefault(npix, []).append(path)
+
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    list(pool.map(functools.partial(build_deepest, args.hips_dir, order),
+      sorted(changed), [tile_plates.get(npix, []) for npix in sorted(changed)],
+      [cut]*len(changed)))
+    affected = changed
+    for parent_order in range(order-1, -1, -1):
+      affected = sorted(set(npix>>2 for npix in affected))
+      list(pool.map(functools.partial(build_parent, args.hips_dir,
+        parent_order), affected, [cut]*len(affected)))
+
+  with open(state_path+".tmp", "w") as f:
+    json.dump(new_state, f)
+  os.replace(state_path+".tmp", state_path)
+  write_properties(args.hips_dir, order, cut, solved, args.creator_did)
+  print(f"order {order}: {len(changed)} tiles rendered for"
+    f" {len(solved)} solved plates")
+
+
+if __name__=="__main__":
+  main()
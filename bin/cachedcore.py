@@ -0,0 +1,221 @@
+"""
+A response cache in front of imagecore.
+
+The SIAP and form services send the same queries (position, size,
+format, object) again and again.  q.rd wraps the core of these services
+(imagecore, a plain dbCore on the main table) into a CachingCore when
+the RD is loaded; it keeps the result tables of recent queries in
+memory, keyed on the service, the input keys of the renderer, the
+output-relevant query metadata and the normalized query parameters.
+The cache is a least recently used one bounded by the number of
+entries and the total number of rows it holds.
+
+Cached results expire after TTL seconds.  Before that, they are
+dropped when the modification time of import_state/main.stamp (written
+by the import of the main table) or import_state/objects.stamp
+(written by make_objects) changes.  The stamps make new imports visible
+at once; the TTL bounds how long changes that bypass them (partial
+imports, manual SQL fixes) stay hidden.  Each request gets its own
+copy of the cached table, so renderers adding to its rows or metadata
+do not change what later requests see.  Each server process has its
+own cache.
+
+q.rd installs the cache with
+
+  <execute on="loaded" title="install response cache">
+
+calling install(rd, service_ids).
+"""
+
+import collections
+import os
+import threading
+import time
+
+from gavo import rsc
+
+MAX_ENTRIES = 256
+MAX_ROWS = 200000
+# seconds after which a cached result is computed again
+TTL = 600
+STAMP_PATHS = [os.path.join("import_state", "main.stamp"),
+  os.path.join("import_state", "objects.stamp")]
+# query metadata that changes the result table
+META_KEYS = ("format", "dbLimit", "verbosity", "columnSet",
+  "additionalFields")
+
+
+def _freeze(value):
+  if isinstance(value, (list, tuple)):
+    value = [v for v in value if v is not None and v!=""]
+    if len(value)==1:
+      return _freeze(value[0])
+    return tuple(_freeze(v) for v in value)
+  if isinstance(value, (set, frozenset)):
+    return tuple(sorted(str(v) for v in value))
+  if isinstance(value, str):
+    return value.strip()
+  return value
+
+
+def normalize_args(args):
+  """
+  returns a hashable form of the core arguments args: keys sorted,
+  empty values dropped, strings stripped, single-element lists
+  unwrapped.
+
+  >>> normalize_args({"SIZE": ["0.1"], "POS": " 84.4,9.3", "FORMAT": None,
+  ...   "object": ["M 42", "", "NGC 1976"]})
+  (('POS', '84.4,9.3'), ('SIZE', '0.1'), ('object', ('M 42', 'NGC 1976')))
+  """
+  frozen = ((key, _freeze(value)) for key, value in args.items())
+  return tuple(sorted((key, value) for key, value in frozen
+    if value is not None and value!="" and value!=()))
+
+
+def stamp_generation(stamp_paths):
+  """
+  returns the modification times of the stamps at stamp_paths in ns,
+  None for those that do not exist.
+
+  >>> import shutil, tempfile
+  >>> d = tempfile.mkdtemp()
+  >>> stamp = os.path.join(d, "main.stamp")
+  >>> before = stamp_generation([stamp])
+  >>> open(stamp, "w").close()
+  >>> before, stamp_generation([stamp])==before
+  ((None,), False)
+  >>> shutil.rmtree(d)
+  """
+  generation = []
+  for stamp_path in stamp_paths:
+    try:
+      generation.append(os.stat(stamp_path).st_mtime_ns)
+    except OSError:
+      generation.append(None)
+  return tuple(generation)
+
+
+def copy_table(table):
+  """
+  returns a table with the definition, metadata and (copied) rows of
+  table.
+  """
+  res = rsc.TableForDef(table.tableDef,
+    rows=[row.copy() for row in table.rows])
+  res.copyMetaFrom(table)
+  return res
+
+
+class ResponseCache:
+  """
+  an LRU cache bounded by the number of entries and their total size
+  (as computed by size), emptied whenever the generation passed in
+  changes; entries older than ttl seconds (by clock) are dropped.
+
+  >>> now = [0]
+  >>> cache = ResponseCache(max_entries=3, max_rows=4, ttl=10,
+  ...   clock=lambda: now[0])
+  >>> cache.put("a", [1], 0); cache.put("b", [2, 3], 0)
+  >>> cache.get("a", 0)
+  [1]
+  >>> cache.put("c", [4, 5], 0)
+  >>> cache.get("b", 0) is None, cache.get("a", 0)
+  (True, [1])
+  >>> cache.get("a", 1) is None
+  True
+  >>> cache.put("a", [1], 1); now[0] = 5; cache.put("d", [6], 1)
+  >>> now[0] = 12; cache.get("a", 1) is None, cache.get("d", 1)
+  (True, [6])
+  >>> cache.n_rows
+  1
+  """
+  def __init__(self, max_entries=MAX_ENTRIES, max_rows=MAX_ROWS, size=len,
+      ttl=TTL, clock=time.monotonic):
+    self.max_entries, self.max_rows, self.size = max_entries, max_rows, size
+    self.ttl, self.clock = ttl, clock
+    self.entries = collections.OrderedDict()
+    self.n_rows = 0
+    self.generation = None
+    self.lock = threading.Lock()
+
+  def _check_generation(self, generation):
+    if generation!=self.generation:
+      self.entries.clear()
+      self.n_rows = 0
+      self.generation = generation
+
+  def get(self, key, generation):
+    with self.lock:
+      self._check_generation(generation)
+      if key not in self.entries:
+        return None
+      value, size, stored = self.entries[key]
+      if self.clock()-stored>self.ttl:
+        del self.entries[key]
+        self.n_rows -= size
+        return None
+      self.entries.move_to_end(key)
+      return value
+
+  def put(self, key, value, generation):
+    size = self.size(value)
+    if size>self.max_rows:
+      return
+    with self.lock:
+      self._check_generation(generation)
+      if key in self.entries:
+        self.n_rows -= self.entries.pop(key)[1]
+      self.entries[key] = (value, size, self.clock())
+      self.n_rows += size
+      while (len(self.entries)>self.max_entries
+          or self.n_rows>self.max_rows):
+        self.n_rows -= self.entries.popitem(last=False)[1][1]
+
+
+_CACHE = ResponseCache(size=lambda entry: len(entry[0].rows)+1)
+
+
+class CachingCore:
+  """
+  a stand-in for the core of a service answering repeated queries from
+  memory; everything but running queries is left to the wrapped core.
+  """
+  def __init__(self, core):
+    self.core = core
+
+  def __getattr__(self, name):
+    return getattr(self.core, name)
+
+  def adaptForRenderer(self, *args, **kwargs):
+    return CachingCore(self.core.adaptForRenderer(*args, **kwargs))
+
+  def run(self, service, inputTable, queryMeta):
+    key = (service.id,
+      tuple(inputKey.name for inputKey in self.core.inputTable.inputKeys),
+      tuple(_freeze(queryMeta.get(name)) for name in META_KEYS),
+      normalize_args(inputTable.args))
+    generation = stamp_generation(
+      [os.path.join(self.core.rd.resdir, path) for path in STAMP_PATHS])
+
+    cached = _CACHE.get(key, generation)
+    if cached is not None:
+      res, overflow = cached
+      if overflow:
+        queryMeta["Overflow"] = overflow
+      return copy_table(res)
+
+    res = self.core.run(service, inputTable, queryMeta)
+    _CACHE.put(key, (copy_table(res), queryMeta.get("Overflow")), generation)
+    return res
+
+
+def install(rd, service_ids):
+  """
+  puts the response cache in front of the cores of the services with
+  service_ids in rd.
+  """
+  for service_id in service_ids:
+    service = rd.getById(service_id)
+    if not isinstance(service.core, CachingCore):
+      service.core = CachingCore(service.core)
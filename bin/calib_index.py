@@ -0,0 +1,215 @@
+"""
+Associating science plates with their calibration plates.
+
+The calibration frames are indexed by telescope, and within a
+telescope sorted by observation date; the frames for a science plate
+are found by bisecting on its date and ranking the few frames around
+it by date difference and exposure time mismatch.  The index itself is
+kept in calib_index.json and only frames with a new content key are
+read again.
+
+The result is calib_links.csv (science accref, calibration accref,
+rank, date difference, exposure ratio), which "dachs imp q
+import_calib_links" loads into the calib_links table.  With --stack,
+the matched frames of each plate are also combined into a master (see
+calib_stack.py, which caches them by input set).
+
+  python bin/calib_index.py data/*.fit [--stack 5]
+"""
+
+import argparse
+import bisect
+import csv
+import datetime
+import glob
+import json
+import math
+import os
+
+import calib_stack
+import import_manifest
+import plate_io
+
+INDEX_PATH = "calib_index.json"
+LINKS_PATH = "calib_links.csv"
+MJD_ZERO = datetime.datetime(1858, 11, 17)
+N_LINKS = 3
+# frames considered on either side of the bisection point
+WINDOW = 8
+# a factor of e in exposure time counts as much as this many days
+EXPTIME_DAYS = 30.
+
+
+def normalize_telescope(telescope):
+  """
+  returns telescope in the form used as index key.
+
+  >>> normalize_telescope(" Maksutov  50cm ")
+  'MAKSUTOV 50CM'
+  """
+  return " ".join((telescope or "").upper().split())
+
+
+def observation_mjd(header):
+  """
+  returns the MJD of the observation in header (DATE-OBS, or the
+  logbook night DATEORIG), or None.
+
+  >>> observation_mjd({"DATE-OBS": "1958-02-10T20:00:00"})
+  36244.833333
+  >>> observation_mjd({"DATEORIG": "10.02.1958"})
+  36244.0
+  """
+  date = None
+  if header.get("DATE-OBS"):
+    try:
+      date = datetime.datetime.fromisoformat(header["DATE-OBS"])
+    except ValueError:
+      pass
+  if date is None and header.get("DATEORIG"):
+    try:
+      date = datetime.datetime.strptime(header["DATEORIG"], "%d.%m.%Y")
+    except ValueError:
+      pass
+  if date is None:
+    return None
+  return round((date-MJD_ZERO).total_seconds()/86400, 6)
+
+
+def frame_entry(path):
+  header = plate_io.read_plate_header(path)
+  exptime = header.get("EXPTIME")
+  try:
+    exptime = float(exptime)
+  except (TypeError, ValueError):
+    exptime = None
+  return {"mjd": observation_mjd(header), "exptime": exptime,
+    "telescope": normalize_telescope(header.get("TELESCOP")),
+    "key": plate_io.content_key(path)}
+
+
+def mismatch(entry, mjd, exptime):
+  """
+  returns how badly a frame described by entry fits an observation at
+  mjd with exptime (days, with exposure mismatch converted by
+  EXPTIME_DAYS).
+
+  >>> mismatch({"mjd": 10., "exptime": 600.}, 12., 600.)
+  2.0
+  >>> round(mismatch({"mjd": 10., "exptime": 600.}, 10., 1800.), 3)
+  32.958
+  """
+  distance = abs(entry["mjd"]-mjd)
+  if exptime and entry["exptime"]:
+    distance += abs(math.log(exptime/entry["exptime"]))*EXPTIME_DAYS
+  return distance
+
+
+class CalibIndex:
+  """
+  calibration frames grouped by telescope and sorted by date.
+
+  frames maps frame paths to entries as made by frame_entry.
+
+  >>> idx = CalibIndex({
+  ...   "a": {"mjd": 1., "exptime": 60., "telescope": "T"},
+  ...   "b": {"mjd": 5., "exptime": 60., "telescope": "T"},
+  ...   "c": {"mjd": 9., "exptime": 600., "telescope": "T"},
+  ...   "d": {"mjd": 5., "exptime": 60., "telescope": "U"}})
+  >>> [path for path, _ in idx.nearest("T", 6., 60., 2)]
+  ['b', 'a']
+  """
+  def __init__(self, frames):
+    self.frames = frames
+    self.by_telescope = {}
+    for path, entry in frames.items():
+      if entry["mjd"] is not None:
+        self.by_telescope.setdefault(entry["telescope"], []).append(
+          (entry["mjd"], path))
+    for group in self.by_telescope.values():
+      group.sort()
+    self.dates = dict((telescope, [mjd for mjd, _ in group])
+      for telescope, group in self.by_telescope.items())
+
+  def nearest(self, telescope, mjd, exptime, n=N_LINKS, window=WINDOW):
+    """
+    returns up to n (path, mismatch) pairs of the best frames of
+    telescope for an observation at mjd with exptime.
+    """
+    group = self.by_telescope.get(telescope)
+    if not group or mjd is None:
+      return []
+    pos = bisect.bisect_left(self.dates[telescope], mjd)
+    candidates = group[max(pos-window, 0):pos+window]
+    ranked = sorted((mismatch(self.frames[path], mjd, exptime), path)
+      for _, path in candidates)
+    return [(path, score) for score, path in ranked[:n]]
+
+
+def update_index(index_path, frame_paths):
+  """
+  returns the frames dict for frame_paths, reusing entries of the index
+  at index_path whose content key is unchanged, and saves it.
+  """
+  frames = {}
+  if os.path.exists(index_path):
+    with open(index_path) as f:
+      frames = json.load(f)
+  new_frames = {}
+  for path in frame_paths:
+    previous = frames.get(path)
+    key = plate_io.content_key(path)
+    new_frames[path] = previous if previous and previous["key"]==key \
+      else frame_entry(path)
+  with open(index_path+".tmp", "w") as f:
+    json.dump(new_frames, f)
+  os.replace(index_path+".tmp", index_path)
+  return new_frames
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Link science plates to their nearest calibration frames")
+  parser.add_argument("plates", nargs="+", help="science plate FITS files")
+  parser.add_argument("--calib", default=
+    import_manifest.SOURCE_PATTERNS["import_calibration"],
+    help="glob pattern of the calibration frames")
+  parser.add_argument("--index", default=INDEX_PATH,
+    help="where the frame index is kept")
+  parser.add_argument("--links", default=LINKS_PATH,
+    help="CSV file of links for the calib_links table")
+  parser.add_argument("--n-links", type=int, default=N_LINKS,
+    help="calibration frames linked per plate")
+  parser.add_argument("--stack", type=int, default=0, metavar="N",
+    help="also combine the N best frames of each plate into a master")
+  parser.add_argument("--method", choices=sorted(calib_stack.METHODS),
+    default="median", help="combination method for --stack")
+  args = parser.parse_args()
+
+  index = CalibIndex(update_index(args.index, glob.glob(args.calib)))
+  n_stacks = 0
+  with open(args.links, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["plate", "calib", "rank", "date_diff", "exptime_ratio"])
+    for path in args.plates:
+      entry = frame_entry(path)
+      matches = index.nearest(entry["telescope"], entry["mjd"],
+        entry["exptime"], max(args.n_links, args.stack))
+      for rank, (calib, _) in enumerate(matches[:args.n_links]):
+        calib_entry = index.frames[calib]
+        ratio = (entry["exptime"]/calib_entry["exptime"]
+          if entry["exptime"] and calib_entry["exptime"] else "")
+        writer.writerow([import_manifest.accref_for(path),
+          import_manifest.accref_for(calib), rank+1,
+          round(calib_entry["mjd"]-entry["mjd"], 4), ratio])
+      if args.stack and len(matches)>1:
+        print(path, calib_stack.cached_stack(
+          [calib for calib, _ in matches[:args.stack]], args.method))
+        n_stacks += 1
+  print(f"{len(index.frames)} calibration frames indexed, links for"
+    f" {len(args.plates)} plates in {args.links}"
+    +(f", {n_stacks} masters" if args.stack else ""))
+
+
+if __name__=="__main__":
+  main()
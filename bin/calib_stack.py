@@ -0,0 +1,118 @@
+"""
+Master calibration frames from stacks of calibration plates.
+
+The frames are combined band by band: a band of rows is read from each
+frame through its HDU section (so frames are memory-mapped, or only the
+needed tiles decompressed), combined with a median or mean, and
+streamed into the output file.  The band height follows from --memory,
+so stacks of any number of plates need no more than that.
+
+Masters are cached in calib_stacks/ under a hash of the inputs' content
+keys (DATAHASH) and the method; asking for the same stack again returns
+the existing file.
+
+  python bin/calib_stack.py calib_frames/*.fit [--method mean]
+"""
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import plate_io
+
+STACK_DIR = "calib_stacks"
+# memory budget for one band of all frames (bytes)
+BAND_MEMORY = 512*1024*1024
+METHODS = {
+  "median": lambda band: np.median(band, axis=0),
+  "mean": lambda band: np.mean(band, axis=0),
+}
+
+
+def stack_key(paths, method):
+  """
+  returns the cache key of the stack of the frames at paths; the order
+  of the frames does not matter.
+  """
+  keys = sorted(plate_io.content_key(path) for path in paths)
+  return hashlib.sha256("\n".join([method]+keys).encode("ascii")
+    ).hexdigest()[:32]
+
+
+def band_rows(n_frames, width, memory=BAND_MEMORY):
+  """
+  returns how many rows of each of n_frames frames fit into memory as
+  float32 (at least 1).
+
+  >>> band_rows(100, 10000, 512*1024*1024)
+  134
+  """
+  return max(1, memory//(n_frames*width*4))
+
+
+def combine(paths, dest, method="median", memory=BAND_MEMORY):
+  """
+  writes the combination of the equally sized frames at paths to dest
+  as float32.
+  """
+  hduls = [fits.open(path) for path in paths]
+  try:
+    hdus = [plate_io.plate_hdu(hdul) for hdul in hduls]
+    shapes = set(hdu.shape for hdu in hdus)
+    if len(shapes)!=1:
+      raise ValueError(f"Frames of different sizes: {sorted(shapes)}")
+    height, width = shapes.pop()
+
+    header = fits.Header([("SIMPLE", True), ("BITPIX", -32), ("NAXIS", 2),
+      ("NAXIS1", width), ("NAXIS2", height)])
+    header["NCOMBINE"] = (len(paths), "Number of frames combined")
+    header["STACKMTH"] = (method, "Combination method")
+    for index, path in enumerate(paths):
+      header[f"IMCMB{index+1:03d}"] = os.path.basename(path)
+
+    out = fits.StreamingHDU(dest+".tmp", header)
+    rows = band_rows(len(paths), width, memory)
+    for row0 in range(0, height, rows):
+      band = np.stack([np.asarray(hdu.section[row0:row0+rows],
+        dtype=np.float32) for hdu in hdus])
+      out.write(METHODS[method](band).astype(np.float32))
+    out.close()
+  finally:
+    for hdul in hduls:
+      hdul.close()
+  os.replace(dest+".tmp", dest)
+
+
+def cached_stack(paths, method="median", stack_dir=STACK_DIR,
+    memory=BAND_MEMORY):
+  """
+  returns the path of the master combining the frames at paths,
+  building it unless the cache already has it.
+  """
+  dest = os.path.join(stack_dir, f"{stack_key(paths, method)}.fits")
+  if not os.path.exists(dest):
+    os.makedirs(stack_dir, exist_ok=True)
+    combine(sorted(paths), dest, method, memory)
+  return dest
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Combine calibration plates into a master frame")
+  parser.add_argument("frames", nargs="+", help="calibration FITS files")
+  parser.add_argument("--method", choices=sorted(METHODS), default="median")
+  parser.add_argument("--stack-dir", default=STACK_DIR,
+    help="cache directory of the masters")
+  parser.add_argument("--memory", type=int, default=BAND_MEMORY//2**20,
+    help="memory for one band of all frames in MiB")
+  args = parser.parse_args()
+
+  print(cached_stack(args.frames, args.method, args.stack_dir,
+    args.memory*2**20))
+
+
+if __name__=="__main__":
+  main()
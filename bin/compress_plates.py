@@ -0,0 +1,113 @@
+"""
+Lossless tile compression of the archived plates.
+
+Each plate is rewritten as an empty primary HDU and a Rice (or
+lossless HCOMPRESS) tile-compressed image extension, keeping its file
+name and mtime.  Before the compressed file replaces the original, its
+decompressed pixels are hashed and compared with the plate's DATAHASH
+(or the hash of the original pixels), so a plate is never replaced by
+something that does not decompress to exactly the same data.
+
+The tools reading plates find the image through plate_io.plate_hdu;
+sections of compressed HDUs only decompress the tiles they touch, which
+is what the previews, the SODA cutouts of q.rd and the quality and
+extraction code use.  Compress plates after they are annotated and
+refined (refine_sip.py and crossmatch_plates.py update the primary
+header in place).
+
+  python bin/compress_plates.py data/*.fit [--workers 8]
+"""
+
+import argparse
+import concurrent.futures
+import os
+
+from astropy.io import fits
+
+import plate_io
+
+TILE_SIZE = 256
+# cards that describe the uncompressed file and that astropy recomputes
+_FILE_CARDS = ("CHECKSUM", "DATASUM")
+
+
+def compressed_hdu(hdu, compression="RICE_1", tile_size=TILE_SIZE):
+  """
+  returns a losslessly tile-compressed copy of the image HDU hdu.
+  """
+  header = hdu.header.copy()
+  for key in _FILE_CARDS:
+    header.remove(key, ignore_missing=True)
+  return fits.CompImageHDU(data=hdu.data, header=header,
+    compression_type=compression, tile_shape=(tile_size, tile_size),
+    hcomp_scale=0)
+
+
+def compress_plate(path, dest=None, compression="RICE_1",
+    tile_size=TILE_SIZE):
+  """
+  replaces the plate at path (or writes dest) with a tile-compressed
+  version after checking it decompresses to the original pixels.
+
+  Returns a short report line.
+  """
+  dest = dest or path
+  st = os.stat(path)
+  with fits.open(path) as hdul:
+    hdu = plate_io.plate_hdu(hdul)
+    if isinstance(hdu, fits.CompImageHDU):
+      return f"{path}: already compressed"
+    expected = plate_io.data_hash(hdu)
+    if hdu.header.get("DATAHASH", expected)!=expected:
+      raise ValueError(f"{path}: pixels do not match DATAHASH, not touched")
+
+    tmp_name = dest+".tmp"
+    fits.HDUList([fits.PrimaryHDU(), compressed_hdu(hdu, compression,
+      tile_size)]).writeto(tmp_name, overwrite=True, checksum=True)
+
+  try:
+    with fits.open(tmp_name) as hdul:
+      if plate_io.data_hash(plate_io.plate_hdu(hdul))!=expected:
+        raise ValueError(f"{path}: compressed plate does not round-trip")
+  except Exception:
+    os.unlink(tmp_name)
+    raise
+
+  os.replace(tmp_name, dest)
+  # keep the mtime so header sidecars of the plate stay valid
+  os.utime(dest, (st.st_atime, st.st_mtime))
+  new_size = os.path.getsize(dest)
+  return f"{path}: {st.st_size} -> {new_size} bytes" \
+    f" ({new_size/st.st_size:.2f})"
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Tile-compress plates losslessly, verifying each")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--compression", choices=["RICE_1", "HCOMPRESS_1"],
+    default="RICE_1", help="compression algorithm (both lossless here)")
+  parser.add_argument("--tile-size", type=int, default=TILE_SIZE,
+    help="edge of the square compression tiles in pixels")
+  parser.add_argument("--dest-dir", default=None,
+    help="write compressed plates here rather than replacing the originals")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of plates compressed in parallel")
+  args = parser.parse_args()
+
+  if args.dest_dir:
+    os.makedirs(args.dest_dir, exist_ok=True)
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    jobs = [pool.submit(compress_plate, path,
+        args.dest_dir and os.path.join(args.dest_dir, os.path.basename(path)),
+        args.compression, args.tile_size)
+      for path in args.plates]
+    for job in concurrent.futures.as_completed(jobs):
+      try:
+        print(job.result())
+      except Exception as ex:
+        print(ex)
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,120 @@
+"""
+Cross-matching plate sources against a local reference catalog.
+
+The reference catalog is indexed once (refcat.RefIndex); each plate's
+source table (see plate_catalogs.py) is then matched in bulk, and the
+match statistics go into the plate header as XM_* cards, from where the
+import data of q.rd puts them into the main table:
+
+  XM_NMAT   number of matched sources
+  XM_RMS    astrometric residual RMS in arcsec
+  XM_ZP     photometric zero point (reference mag - MAG_ISO)
+  XM_ZPERR  robust scatter of the zero point
+  XM_LIM    limiting magnitude (turnover of the source counts)
+
+annotate_fits.py --refcat does this while annotating; for plates
+annotated earlier:
+
+  python bin/crossmatch_plates.py --refcat tycho2.fits data/*.fit
+"""
+
+import argparse
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import plate_catalogs
+import plate_io
+import refcat
+
+# maximal distance (arcsec) of a match
+MATCH_RADIUS = 5.
+# bin width (mag) for the source counts giving the limiting magnitude
+LIMIT_BIN = 0.25
+MIN_MATCHES = 5
+
+
+def limiting_magnitude(mags, bin_width=LIMIT_BIN):
+  """
+  returns the magnitude at which the source counts turn over (the
+  centre of the most populated bin), or None without sources.
+
+  >>> limiting_magnitude(np.array([10., 11., 11.1, 11.2, 11.3, 12.]))
+  11.125
+  """
+  mags = mags[np.isfinite(mags)]
+  if not len(mags):
+    return None
+  bins = np.floor(mags/bin_width).astype(int)
+  values, counts = np.unique(bins, return_counts=True)
+  return float((values[np.argmax(counts)]+0.5)*bin_width)
+
+
+def match_stats(sources, index, radius=MATCH_RADIUS):
+  """
+  returns a dict of XM_* header values for the sources (a table from
+  plate_catalogs.make_source_table) matched against index (a
+  refcat.RefIndex); it is empty if there are too few matches.
+  """
+  src_index, ref_index, sep = index.match(sources["ra"], sources["dec"],
+    radius)
+  if len(src_index)<MIN_MATCHES:
+    return {}
+
+  stats = {
+    "XM_NMAT": (len(src_index), "Sources matched with the reference catalog"),
+    "XM_RMS": (round(float(np.sqrt(np.mean(sep**2))), 3),
+      "[arcsec] RMS of the match residuals"),
+  }
+
+  delta = (index.cat["mag"][ref_index]
+    -sources["mag_iso"][src_index]).astype(np.float64)
+  delta = delta[np.isfinite(delta)]
+  if len(delta)>=MIN_MATCHES:
+    zero_point = float(np.median(delta))
+    stats["XM_ZP"] = (round(zero_point, 3),
+      "[mag] Zero point, reference mag - MAG_ISO")
+    stats["XM_ZPERR"] = (
+      round(1.4826*float(np.median(np.abs(delta-zero_point))), 3),
+      "[mag] Robust scatter of the zero point")
+    limit = limiting_magnitude(sources["mag_iso"]+zero_point)
+    if limit is not None:
+      stats["XM_LIM"] = (round(limit, 2), "[mag] Limiting magnitude")
+  return stats
+
+
+def crossmatch_plate(path, sources_dir, index):
+  """
+  adds XM_* cards to the header of the plate at path; returns a message
+  for the log.
+  """
+  sources_path = plate_catalogs.source_path(sources_dir, path)
+  if not os.path.exists(sources_path):
+    return f"{path}: no source table"
+  stats = match_stats(fits.getdata(sources_path, 1), index)
+  if not stats:
+    return f"{path}: too few matches"
+  with fits.open(path, mode="update") as hdul:
+    plate_io.plate_hdu(hdul).header.update(stats)
+  return f"{path}: " + ", ".join(f"{k}={v[0]}" for k, v in stats.items())
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Match plate sources against a reference catalog and"
+      " add the match statistics to the plate headers")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--refcat", required=True,
+    help="reference catalog (FITS table or CSV with RA, DEC, MAG)")
+  parser.add_argument("--sources-dir", default="sources",
+    help="where the source tables of the plates are")
+  args = parser.parse_args()
+
+  index = refcat.RefIndex.from_file(args.refcat)
+  for path in args.plates:
+    print(crossmatch_plate(path, args.sources_dir, index))
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,228 @@
+"""
+Density to intensity calibration of the plates.
+
+The characteristic curve of a plate (or of all plates of a night) is
+fitted from its calibration plates as linked in calib_links.csv (see
+calib_index.py): each calibration plate gives one point, the median
+density of its central part against the logarithm of its exposure
+time.  The curve, log relative exposure as a monotonic piecewise
+linear function of density, is turned into a lookup table over all
+65536 pixel values, which is applied to the plate in row chunks read
+through its HDU section.  The result is a float32 companion file
+intensity/<plate>.fits with the plate's WCS.
+
+Archive plates are positives (see neg2pos.py), so the scanner's
+transmission is 65535 minus the pixel value; use --negative for plates
+not converted.  Reciprocity failure is ignored: exposure times are
+taken as relative exposures.
+
+  python bin/density_calib.py data/*.fit [--per-night] [--workers 4]
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import import_manifest
+import plate_io
+
+INTENSITY_DIR = "intensity"
+CHUNK_ROWS = 512
+# the part of a calibration plate whose median density is used
+CENTRAL_FRACTION = 0.5
+# cards not carried over from the plate to its intensity file
+_DATA_CARDS = ("BITPIX", "BZERO", "BSCALE", "BLANK", "CHECKSUM", "DATASUM",
+  "DATAHASH", "BUNIT")
+
+
+def density(values, positive=True):
+  """
+  returns the photographic density for scanner pixel values.
+
+  >>> density(np.array([65535, 6553]), positive=False).round(3).tolist()
+  [0.0, 1.0]
+  >>> density(np.array([0, 65535-6553])).round(3).tolist()
+  [0.0, 1.0]
+  """
+  values = np.asarray(values, dtype=np.float64)
+  transmission = 65536-values if positive else values+1
+  return np.log10(65536/transmission)
+
+
+def frame_point(path, positive=True):
+  """
+  returns (log10 exposure time, median density of the central part) of
+  the calibration plate at path, or None without a usable EXPTIME.
+  """
+  with fits.open(path) as hdul:
+    hdu = plate_io.plate_hdu(hdul)
+    try:
+      exptime = float(hdu.header.get("EXPTIME"))
+    except (TypeError, ValueError):
+      return None
+    if exptime<=0:
+      return None
+    height, width = hdu.shape
+    margin_y = int(height*(1-CENTRAL_FRACTION)/2)
+    margin_x = int(width*(1-CENTRAL_FRACTION)/2)
+    central = hdu.section[margin_y:height-margin_y, margin_x:width-margin_x]
+  return (float(np.log10(exptime)),
+    float(np.median(density(central[::4, ::4], positive))))
+
+
+def fit_curve(points):
+  """
+  returns the characteristic curve through points ((log E, D) pairs)
+  as knots (densities, log exposures), with log E made non-decreasing
+  in density.
+
+  Several points at one exposure are averaged; at least two distinct
+  exposures are needed.
+
+  >>> fit_curve([(0., 0.5), (1., 1.2), (1., 1.0), (2., 1.6)])
+  ([0.5, 1.1, 1.6], [0.0, 1.0, 2.0])
+  """
+  by_exposure = {}
+  for log_e, dens in points:
+    by_exposure.setdefault(log_e, []).append(dens)
+  if len(by_exposure)<2:
+    raise ValueError("Need calibration plates with two or more exposure"
+      " times")
+  knots = sorted((float(np.mean(dens)), log_e)
+    for log_e, dens in by_exposure.items())
+  densities = [d for d, _ in knots]
+  log_es = np.maximum.accumulate([e for _, e in knots]).tolist()
+  return densities, log_es
+
+
+def curve_lut(curve, positive=True):
+  """
+  returns the float32 relative intensities for all 16-bit pixel values
+  on the characteristic curve, 1 at the lowest calibration exposure.
+
+  Beyond the calibrated densities, the curve is continued with the
+  slope of its end segments.
+
+  >>> lut = curve_lut(([0.5, 1.5], [0., 1.]), positive=False)
+  >>> lut.shape, round(float(lut[20724]), 3), round(float(lut[2072]), 3)
+  ((65536,), 1.0, 9.997)
+  """
+  densities, log_es = np.asarray(curve[0]), np.asarray(curve[1])
+  dens = density(np.arange(65536), positive)
+  log_e = np.interp(dens, densities, log_es)
+  if len(densities)>1:
+    low_slope = (log_es[1]-log_es[0])/((densities[1]-densities[0]) or 1)
+    high_slope = (log_es[-1]-log_es[-2])/((densities[-1]-densities[-2]) or 1)
+    log_e = np.where(dens<densities[0],
+      log_es[0]+(dens-densities[0])*low_slope, log_e)
+    log_e = np.where(dens>densities[-1],
+      log_es[-1]+(dens-densities[-1])*high_slope, log_e)
+  return (10**(log_e-log_es[0])).astype(np.float32)
+
+
+def apply_lut(src, dest, lut, cards, chunk_rows=CHUNK_ROWS):
+  """
+  writes the intensity file for the plate at src to dest, mapping its
+  pixels through lut chunk by chunk.
+  """
+  with fits.open(src) as hdul:
+    hdu = plate_io.plate_hdu(hdul)
+    height, width = hdu.shape
+    header = fits.Header([("SIMPLE", True), ("BITPIX", -32), ("NAXIS", 2),
+      ("NAXIS1", width), ("NAXIS2", height)])
+    for card in hdu.header.cards:
+      if (card.keyword not in header and card.keyword not in _DATA_CARDS
+          and card.keyword not in ("SIMPLE", "EXTEND", "XTENSION", "PCOUNT",
+            "GCOUNT") and not card.keyword.startswith("NAXIS")):
+        header.append(card)
+    header["BUNIT"] = ("", "Relative intensity")
+    header.extend(cards)
+
+    out = fits.StreamingHDU(dest+".tmp", header)
+    for row0 in range(0, height, chunk_rows):
+      chunk = np.asarray(hdu.section[row0:row0+chunk_rows])
+      if chunk.dtype!=np.uint16:
+        chunk = np.clip(np.nan_to_num(chunk), 0, 65535).astype(np.uint16)
+      out.write(lut[chunk])
+    out.close()
+  os.replace(dest+".tmp", dest)
+
+
+def read_links(links_path):
+  """
+  returns a dict mapping plate accrefs to their calibration accrefs,
+  best first.
+  """
+  links = {}
+  with open(links_path, newline="") as f:
+    for row in csv.DictReader(f):
+      links.setdefault(row["plate"], []).append((int(row["rank"]),
+        row["calib"]))
+  return dict((plate, [calib for _, calib in sorted(calibs)])
+    for plate, calibs in links.items())
+
+
+def calibrate_plate(path, calib_paths, out_dir, positive=True):
+  points = [p for p in (frame_point(calib, positive) for calib in calib_paths)
+    if p is not None]
+  try:
+    curve = fit_curve(points)
+  except ValueError as ex:
+    return f"{path}: {ex}"
+  cards = [("ICALNPT", len(curve[0]), "Knots of the characteristic curve")]
+  for index, (dens, log_e) in enumerate(zip(*curve)):
+    cards.append((f"ICALD{index+1}", round(dens, 4), "Knot density"))
+    cards.append((f"ICALE{index+1}", round(log_e, 4), "Knot log exposure"))
+  dest = os.path.join(out_dir, os.path.basename(path))
+  apply_lut(path, dest, curve_lut(curve, positive), cards)
+  return f"{path}: {dest} ({len(points)} calibration plates)"
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Convert plate densities to relative intensities")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--links", default="calib_links.csv",
+    help="calibration links written by calib_index.py")
+  parser.add_argument("--inputs-dir", default=import_manifest.INPUTS_DIR,
+    help="the directory the accrefs in the links are relative to")
+  parser.add_argument("--out-dir", default=INTENSITY_DIR,
+    help="where the intensity files go")
+  parser.add_argument("--per-night", action="store_true",
+    help="fit one curve per night (DATEORIG) from the calibration plates"
+      " of all its plates")
+  parser.add_argument("--negative", action="store_true",
+    help="plates are negatives (not converted by neg2pos.py)")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of plates calibrated in parallel")
+  args = parser.parse_args()
+
+  links = read_links(args.links)
+  calibs = dict((path, [os.path.join(args.inputs_dir, accref)
+      for accref in links.get(
+        import_manifest.accref_for(path, args.inputs_dir), [])])
+    for path in args.plates)
+  if args.per_night:
+    nights = {}
+    for path in args.plates:
+      night = plate_io.read_plate_header(path).get("DATEORIG")
+      nights.setdefault(night, set()).update(calibs[path])
+    calibs = dict((path, sorted(nights[
+        plate_io.read_plate_header(path).get("DATEORIG")]))
+      for path in args.plates)
+
+  os.makedirs(args.out_dir, exist_ok=True)
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    for msg in pool.map(calibrate_plate, args.plates,
+        [calibs[path] for path in args.plates],
+        [args.out_dir]*len(args.plates),
+        [not args.negative]*len(args.plates)):
+      print(msg)
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,67 @@
+"""
+Header sidecars for a fast metadata import.
+
+annotate_fits.py writes the final primary header of every plate to
+headers/<plate file name>.hdr next to writing the plate.  The import
+data in q.rd reads these small files rather than opening the plates,
+and only falls back to reading the primary header of plates without an
+up-to-date sidecar.
+
+To write sidecars for plates annotated before:
+
+  python bin/header_sidecars.py data/*.fit
+"""
+
+import argparse
+import os
+
+from astropy.io import fits
+
+import plate_io
+
+
+def sidecar_path(headers_dir, plate_path):
+  """
+  returns the sidecar file name for the plate at plate_path.
+
+  >>> sidecar_path("headers", "/data/11-1964.fit")
+  'headers/11-1964.fit.hdr'
+  """
+  return os.path.join(headers_dir, os.path.basename(plate_path)+".hdr")
+
+
+def write_sidecar(header, headers_dir, plate_path):
+  header.tofile(sidecar_path(headers_dir, plate_path), overwrite=True)
+
+
+def read_header(plate_path, headers_dir):
+  """
+  returns the primary header of the plate at plate_path, from its
+  sidecar if that is at least as new as the plate.
+
+  Without a sidecar, only the header of the plate image is read.
+  (q.rd has an inline copy of this for the import grammar.)
+  """
+  sidecar = sidecar_path(headers_dir, plate_path)
+  if (os.path.exists(sidecar)
+      and os.path.getmtime(sidecar)>=os.path.getmtime(plate_path)):
+    return fits.Header.fromfile(sidecar)
+  return plate_io.read_plate_header(plate_path)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Write header sidecars for plates")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--headers-dir", default="headers",
+    help="where to put the sidecars")
+  args = parser.parse_args()
+
+  os.makedirs(args.headers_dir, exist_ok=True)
+  for path in args.plates:
+    write_sidecar(plate_io.read_plate_header(path), args.headers_dir, path)
+  print(f"{len(args.plates)} sidecars written to {args.headers_dir}")
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,188 @@
+"""
+The parts of HEALPix (nested scheme) the HiPS and MOC tools need, in
+plain numpy, and the footprints of solved plates on it.
+
+Pixels are addressed by order (nside = 2**order) and nested index;
+within one of the 12 base faces, a pixel has integer coordinates
+(ix, iy), ix growing towards the east corner of the face and iy
+towards its west corner, whose bits are interleaved to give the nested
+index.  The formulae follow healpix_base (Gorski et al. 2005).
+"""
+
+import functools
+import math
+import warnings
+
+import numpy as np
+from astropy import wcs
+
+import plate_io
+
+# ring and longitude offsets of the south corners of the base faces
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+# spacing (plate pixels) of the grid used to find the tiles of a plate
+FOOTPRINT_STEP = 64
+
+
+def n_pixels(order):
+  return 12*4**order
+
+
+def pixel_size(order):
+  """
+  returns the mean size (square root of the area) of pixels of order
+  in arcsec.
+
+  >>> round(pixel_size(9), 1)
+  412.3
+  """
+  return math.degrees(math.sqrt(4*math.pi/n_pixels(order)))*3600
+
+
+def spread_bits(v):
+  """
+  returns v with its bits moved to the even bit positions.
+
+  >>> spread_bits(np.array([0b11, 0b101])).tolist()
+  [5, 17]
+  """
+  v = np.asarray(v, dtype=np.int64)
+  result = np.zeros_like(v)
+  for bit in range(30):
+    result |= ((v>>bit)&1)<<(2*bit)
+  return result
+
+
+def compact_bits(v):
+  """
+  returns the even bits of v packed together (inverse of spread_bits).
+
+  >>> compact_bits(spread_bits(np.array([12345]))).tolist()
+  [12345]
+  """
+  v = np.asarray(v, dtype=np.int64)
+  result = np.zeros_like(v)
+  for bit in range(30):
+    result |= ((v>>(2*bit))&1)<<bit
+  return result
+
+
+def xyf_to_nest(order, ix, iy, face):
+  return (np.asarray(face, dtype=np.int64)<<(2*order)) \
+    +spread_bits(ix)+(spread_bits(iy)<<1)
+
+
+def nest_to_xyf(order, ipix):
+  """
+  returns ix, iy, face of the nested pixels ipix of order.
+  """
+  ipix = np.asarray(ipix, dtype=np.int64)
+  within = ipix&((1<<(2*order))-1)
+  return compact_bits(within), compact_bits(within>>1), ipix>>(2*order)
+
+
+def face_to_radec(x, y, face):
+  """
+  returns RA and Dec (degrees) of the continuous face coordinates
+  x, y in [0, 1] on the base faces face.
+
+  >>> ra, dec = face_to_radec(np.array([0.5]), np.array([0.5]),
+  ...   np.array([4]))
+  >>> round(float(ra[0]), 6), round(float(dec[0]), 6)
+  (0.0, 0.0)
+  """
+  x, y, face = np.broadcast_arrays(np.asarray(x, dtype=np.float64),
+    np.asarray(y, dtype=np.float64), np.asarray(face))
+  ring = _JRLL[face]-x-y
+  north, south = ring<1, ring>3
+  nr = np.where(north, ring, np.where(south, 4-ring, 1.))
+  z = np.where(north, 1-nr**2/3, np.where(south, nr**2/3-1, (2-ring)*2/3))
+  with np.errstate(divide="ignore", invalid="ignore"):
+    phi = math.pi/4*(_JPLL[face]+(x-y)/nr)
+  return np.degrees(phi)%360, np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+
+def pix_to_radec(order, ipix):
+  """
+  returns RA and Dec (degrees) of the centres of the nested pixels ipix.
+
+  >>> ra, dec = pix_to_radec(0, np.arange(12))
+  >>> np.round(dec, 2).tolist()[::4]
+  [41.81, 0.0, -41.81]
+  """
+  ix, iy, face = nest_to_xyf(order, ipix)
+  nside = 1<<order
+  return face_to_radec((ix+0.5)/nside, (iy+0.5)/nside, face)
+
+
+def radec_to_pix(order, ra, dec):
+  """
+  returns the nested pixels of order containing the positions ra, dec
+  (degrees).
+
+  >>> radec_to_pix(0, [0, 45, 180], [0, 80, -80]).tolist()
+  [4, 0, 10]
+  >>> p = np.arange(n_pixels(3))
+  >>> bool((radec_to_pix(3, *pix_to_radec(3, p))==p).all())
+  True
+  """
+  nside = 1<<order
+  z = np.sin(np.radians(np.asarray(dec, dtype=np.float64)))
+  tt = np.radians(np.asarray(ra, dtype=np.float64))%(2*math.pi)/(math.pi/2)
+  z, tt = np.broadcast_arrays(z, tt)
+  za = np.abs(z)
+
+  # equatorial region
+  temp1, temp2 = nside*(0.5+tt), nside*z*0.75
+  jp = (temp1-temp2).astype(np.int64)
+  jm = (temp1+temp2).astype(np.int64)
+  ifp, ifm = jp>>order, jm>>order
+  eq_face = np.where(ifp==ifm, ifp|4, np.where(ifp<ifm, ifp, ifm+8))
+  eq_ix = jm&(nside-1)
+  eq_iy = nside-(jp&(nside-1))-1
+
+  # polar caps
+  ntt = np.minimum(tt.astype(np.int64), 3)
+  tp = tt-ntt
+  tmp = nside*np.sqrt(3*(1-za))
+  pjp = np.minimum((tp*tmp).astype(np.int64), nside-1)
+  pjm = np.minimum(((1-tp)*tmp).astype(np.int64), nside-1)
+  north = z>=0
+  pol_face = np.where(north, ntt, ntt+8)
+  pol_ix = np.where(north, nside-pjm-1, pjp)
+  pol_iy = np.where(north, nside-pjp-1, pjm)
+
+  equatorial = za<=2/3
+  return xyf_to_nest(order,
+    np.where(equatorial, eq_ix, pol_ix),
+    np.where(equatorial, eq_iy, pol_iy),
+    np.where(equatorial, eq_face, pol_face))
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~PLATE FOOTPRINTS~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@functools.lru_cache(maxsize=32)
+def plate_wcs(path):
+  """
+  returns the WCS, width and height of the solved plate at path.
+  """
+  header = plate_io.read_plate_header(path)
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore", wcs.FITSFixedWarning)
+    return wcs.WCS(header), header["NAXIS1"], header["NAXIS2"]
+
+
+def plate_tiles(path, order, step=FOOTPRINT_STEP):
+  """
+  returns the pixels of order the solved plate at path covers, sampling
+  the plate on a grid with a spacing of step plate pixels.
+  """
+  plate, width, height = plate_wcs(path)
+  xs = np.unique(np.append(np.arange(0, width, step), width-1))
+  ys = np.unique(np.append(np.arange(0, height, step), height-1))
+  x, y = np.meshgrid(xs, ys)
+  ra, dec = plate.all_pix2world(x.ravel(), y.ravel(), 0)
+  return sorted(set(radec_to_pix(order, ra, dec).tolist()))
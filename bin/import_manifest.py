@@ -0,0 +1,203 @@
+"""
+Incremental DaCHS imports driven by a manifest of the imported plates.
+
+The manifest records size, mtime and DATAHASH of every file a data
+element of q.rd has imported.  Before an import, "scan" compares the
+files matching the data's sources pattern with it and writes, into
+import_state/:
+
+  <data>.unchanged  paths of plates to skip (ignoreSources fromfile)
+  <data>.stale      accrefs of changed and removed plates, whose rows
+                    the preImport script of the data deletes
+
+After a successful import, "commit" makes the scanned state the new
+manifest and empties the file lists again, so a plain "dachs imp q"
+without a scan imports everything.  A nightly ingest is thus
+
+  python bin/import_manifest.py scan import
+  dachs imp q import
+  python bin/import_manifest.py commit import
+
+After "dachs drop q", run "reset" to forget the manifests before the
+next import.
+
+Plates whose size and mtime are unchanged are not opened at all; for
+the others, only the header of the plate image is read.  If its
+DATAHASH and the rest of the header are as recorded (e.g., a plate
+restored from a backup with a new mtime), the plate still counts as
+unchanged.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import plate_io
+
+INPUTS_DIR = "/var/gavo/inputs"
+
+# the sources patterns of the data elements in q.rd
+SOURCE_PATTERNS = {
+  "import": os.path.join(INPUTS_DIR,
+    "astroplates/maksutov_50_telescope/data/*.fit"),
+  "import_calibration": os.path.join(INPUTS_DIR,
+    "astroplates/maksutov_50_telescope/calib_frames/*.fit"),
+}
+
+
+def state_path(state_dir, data_id, kind):
+  return os.path.join(state_dir, f"{data_id}.{kind}")
+
+
+def load_manifest(path):
+  if not os.path.exists(path):
+    return {}
+  with open(path, encoding="utf-8") as f:
+    return json.load(f)
+
+
+def file_state(path, previous=None):
+  """
+  returns the manifest entry for the file at path, reusing previous if
+  size and mtime are unchanged.
+  """
+  st = os.stat(path)
+  if (previous and previous["size"]==st.st_size
+      and previous["mtime"]==st.st_mtime):
+    return previous
+  header = plate_io.read_plate_header(path)
+  return {"size": st.st_size, "mtime": st.st_mtime,
+    "datahash": header.get("DATAHASH"),
+    "headerhash": hashlib.sha256(header.tostring().encode("ascii")
+      ).hexdigest()}
+
+
+def same_content(entry, previous):
+  """
+  returns True if the manifest entries describe the same file content,
+  i.e., equal size, DATAHASH and header hash (mtimes may differ).
+
+  >>> same_content({"size": 1, "mtime": 2, "datahash": "x", "headerhash": "h"},
+  ...   {"size": 1, "mtime": 1, "datahash": "x", "headerhash": "h"})
+  True
+  >>> same_content({"size": 1, "mtime": 2, "datahash": None, "headerhash": "h"},
+  ...   {"size": 1, "mtime": 1, "datahash": None, "headerhash": "h"})
+  False
+  """
+  return (previous is not None and entry["datahash"] is not None
+    and all(entry.get(key)==previous.get(key)
+      for key in ("size", "datahash", "headerhash")))
+
+
+def compare(manifest, paths, state_of=file_state):
+  """
+  returns (new_manifest, unchanged, stale) for the files paths against
+  manifest; stale contains changed and removed paths.
+
+  >>> old = {"a": {"size": 1, "mtime": 1, "datahash": "x"},
+  ...   "b": {"size": 1, "mtime": 1, "datahash": "y"},
+  ...   "c": {"size": 1, "mtime": 1, "datahash": "z"},
+  ...   "e": {"size": 1, "mtime": 1, "datahash": "w", "headerhash": "h"}}
+  >>> def fake_state(path, previous):
+  ...   if path=="a":
+  ...     return previous
+  ...   if path=="e":
+  ...     return dict(previous, mtime=2)
+  ...   return {"size": 2, "mtime": 2, "datahash": None}
+  >>> new, unchanged, stale = compare(old, ["a", "b", "d", "e"], fake_state)
+  >>> sorted(new), unchanged, stale, new["e"]["mtime"]
+  (['a', 'b', 'd', 'e'], ['a', 'e'], ['b', 'c'], 2)
+  """
+  new_manifest, unchanged, stale = {}, [], []
+  for path in sorted(paths):
+    previous = manifest.get(path)
+    entry = state_of(path, previous)
+    new_manifest[path] = entry
+    if entry==previous or same_content(entry, previous):
+      unchanged.append(path)
+    elif previous is not None:
+      stale.append(path)
+  stale.extend(sorted(set(manifest)-set(new_manifest)))
+  return new_manifest, unchanged, stale
+
+
+def accref_for(path, inputs_dir=INPUTS_DIR):
+  """
+  returns the DaCHS accref of the file at path.
+
+  >>> accref_for("/var/gavo/inputs/astroplates/m/data/a.fit")
+  'astroplates/m/data/a.fit'
+  """
+  return os.path.relpath(path, inputs_dir)
+
+
+def write_lines(path, lines):
+  with open(path, "w", encoding="utf-8") as f:
+    f.write("".join(line+"\n" for line in lines))
+
+
+def scan(data_id, state_dir, pattern=None):
+  pattern = pattern or SOURCE_PATTERNS[data_id]
+  manifest = load_manifest(state_path(state_dir, data_id, "manifest"))
+  new_manifest, unchanged, stale = compare(manifest, glob.glob(pattern))
+
+  write_lines(state_path(state_dir, data_id, "unchanged"), unchanged)
+  write_lines(state_path(state_dir, data_id, "stale"),
+    [accref_for(path) for path in stale])
+  with open(state_path(state_dir, data_id, "pending"), "w",
+      encoding="utf-8") as f:
+    json.dump(new_manifest, f)
+
+  n_removed = len(set(manifest)-set(new_manifest))
+  return (f"{data_id}: {len(new_manifest)-len(unchanged)} to import,"
+    f" {len(unchanged)} unchanged, {n_removed} removed")
+
+
+def commit(data_id, state_dir):
+  pending = state_path(state_dir, data_id, "pending")
+  if not os.path.exists(pending):
+    return f"{data_id}: nothing scanned"
+  os.replace(pending, state_path(state_dir, data_id, "manifest"))
+  write_lines(state_path(state_dir, data_id, "unchanged"), [])
+  write_lines(state_path(state_dir, data_id, "stale"), [])
+  return f"{data_id}: manifest updated"
+
+
+def reset(data_id, state_dir):
+  """
+  forgets everything imported for data_id, so the next import reads all
+  plates (after dropping the tables).
+  """
+  for kind in ("manifest", "pending"):
+    if os.path.exists(state_path(state_dir, data_id, kind)):
+      os.unlink(state_path(state_dir, data_id, kind))
+  write_lines(state_path(state_dir, data_id, "unchanged"), [])
+  write_lines(state_path(state_dir, data_id, "stale"), [])
+  return f"{data_id}: manifest removed"
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Prepare and record incremental imports of q.rd data")
+  parser.add_argument("action", choices=["scan", "commit", "reset"])
+  parser.add_argument("data", nargs="+", choices=sorted(SOURCE_PATTERNS),
+    help="ids of the data elements in q.rd")
+  parser.add_argument("--state-dir", default="import_state",
+    help="where the manifests and file lists are kept (q.rd expects"
+      " import_state in the resource directory)")
+  args = parser.parse_args()
+
+  os.makedirs(args.state_dir, exist_ok=True)
+  for data_id in args.data:
+    if args.action=="scan":
+      print(scan(data_id, args.state_dir))
+    elif args.action=="commit":
+      print(commit(data_id, args.state_dir))
+    else:
+      print(reset(data_id, args.state_dir))
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,180 @@
+"""
+Precomputed previews of the plates for the web and SIAP services.
+
+Each plate is block-averaged down to about --size pixels, band by band
+from the memory-mapped data unit, stretched robustly (percentile clip
+and asinh), and written as an 8 bit JPEG (PNG if --format png) into
+the preview directory, where the products table of q.rd points to it.
+
+The cache is keyed by content: previews/index.json records the
+DATAHASH (or size and mtime for plates without one) each preview was
+made from, and only plates whose content changed are rendered again.
+
+  python bin/make_previews.py data/*.fit [--workers 8]
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+from astropy.io import fits
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+import plate_io
+
+PREVIEW_DIR = "/var/gavo/inputs/astroplates/maksutov_50_telescope/previews"
+PREVIEW_SIZE = 1024
+# percentiles mapped to black and white, and the asinh softening
+STRETCH_LOW, STRETCH_HIGH = 0.5, 99.8
+ASINH_SOFTENING = 10.
+# bump this when the rendering changes so all previews are remade
+RENDER_VERSION = 1
+
+
+def preview_path(preview_dir, plate_path, fmt):
+  """
+  returns where the preview for plate_path goes.
+
+  >>> preview_path("previews", "/data/11-1964.fit", "jpeg")
+  'previews/11-1964.jpeg'
+  """
+  return os.path.join(preview_dir,
+    os.path.splitext(os.path.basename(plate_path))[0]+"."+fmt)
+
+
+def block_average(data, size=PREVIEW_SIZE, band_blocks=64):
+  """
+  returns data block-averaged so that its larger side is at most size.
+
+  data is read in bands of band_blocks rows of blocks (use an HDU
+  section so only one band is in memory); edge pixels that do not fill
+  a block are dropped.
+
+  >>> block_average(np.arange(16).reshape(4, 4), 2).tolist()
+  [[2.5, 4.5], [10.5, 12.5]]
+  """
+  height, width = data.shape
+  factor = max(1, math.ceil(max(height, width)/size))
+  out_height, out_width = height//factor, width//factor
+  out = np.empty((out_height, out_width), dtype=np.float32)
+  band = band_blocks*factor
+  for row0 in range(0, out_height*factor, band):
+    row1 = min(row0+band, out_height*factor)
+    chunk = np.asarray(data[row0:row1, :out_width*factor], dtype=np.float32)
+    out[row0//factor:row1//factor] = chunk.reshape(
+      (row1-row0)//factor, factor, out_width, factor).mean(axis=(1, 3))
+  return out
+
+
+def stretch(image):
+  """
+  returns image scaled to uint8 with a percentile clip and an asinh
+  stretch; FITS rows go bottom-up, so the result is flipped.
+
+  >>> stretch(np.array([[0., 1.], [2., 1000.]])).tolist()
+  [[2, 255], [0, 1]]
+  """
+  low, high = np.percentile(image, [STRETCH_LOW, STRETCH_HIGH])
+  scaled = np.clip((image-low)/((high-low) or 1.), 0, 1)
+  scaled = np.arcsinh(scaled*ASINH_SOFTENING)/np.arcsinh(ASINH_SOFTENING)
+  return (scaled[::-1]*255+0.5).astype(np.uint8)
+
+
+def write_png(pixels, dest):
+  """
+  writes a grayscale uint8 array as a PNG without needing PIL.
+  """
+  height, width = pixels.shape
+  raw = b"".join(b"\0"+pixels[row].tobytes() for row in range(height))
+  def chunk(tag, payload):
+    return (struct.pack(">I", len(payload))+tag+payload
+      +struct.pack(">I", zlib.crc32(tag+payload)&0xffffffff))
+  with open(dest, "wb") as f:
+    f.write(b"\x89PNG\r\n\x1a\n"
+      +chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+      +chunk(b"IDAT", zlib.compress(raw, 6))
+      +chunk(b"IEND", b""))
+
+
+def write_preview(pixels, dest, fmt):
+  if fmt=="png" and Image is None:
+    write_png(pixels, dest)
+  else:
+    Image.fromarray(pixels).save(dest, format=fmt.upper(), quality=85)
+
+
+def preview_key(path):
+  """
+  returns the key of the preview of the plate at path in index.json:
+  plate_io.content_key with the version of the rendering.
+  """
+  return f"{plate_io.content_key(path)}/{RENDER_VERSION}"
+
+
+def render(path, dest, fmt, size):
+  with fits.open(path) as hdul:
+    pixels = stretch(block_average(plate_io.plate_hdu(hdul).section, size))
+  write_preview(pixels, dest, fmt)
+  return path
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Render cached previews of plates")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--preview-dir", default=PREVIEW_DIR,
+    help="where the previews go (the products table points there)")
+  parser.add_argument("--size", type=int, default=PREVIEW_SIZE,
+    help="maximal preview size in pixels")
+  parser.add_argument("--format", choices=["jpeg", "png"], default="jpeg",
+    help="preview format (q.rd declares image/jpeg)")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of previews rendered in parallel")
+  parser.add_argument("--force", action="store_true",
+    help="render all previews, not only those of changed plates")
+  args = parser.parse_args()
+
+  if args.format=="jpeg" and Image is None:
+    parser.error("JPEG previews need PIL (pillow); use --format png")
+  os.makedirs(args.preview_dir, exist_ok=True)
+  index_path = os.path.join(args.preview_dir, "index.json")
+  index = {}
+  if os.path.exists(index_path) and not args.force:
+    with open(index_path) as f:
+      index = json.load(f)
+
+  todo = {}
+  for path in args.plates:
+    key = preview_key(path)
+    dest = preview_path(args.preview_dir, path, args.format)
+    if index.get(os.path.basename(dest))!=key or not os.path.exists(dest):
+      todo[path] = (dest, key)
+
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    jobs = dict((pool.submit(render, path, dest, args.format, args.size),
+      (dest, key)) for path, (dest, key) in todo.items())
+    for job in concurrent.futures.as_completed(jobs):
+      dest, key = jobs[job]
+      try:
+        print(job.result())
+        index[os.path.basename(dest)] = key
+      except Exception as ex:
+        print(f"{dest}: {ex}")
+
+  with open(index_path+".tmp", "w") as f:
+    json.dump(index, f)
+  os.replace(index_path+".tmp", index_path)
+  print(f"{len(todo)} of {len(args.plates)} previews rendered")
+
+
+if __name__=="__main__":
+  main()
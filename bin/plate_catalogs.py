@@ -0,0 +1,108 @@
+"""
+Per-plate source catalogs with world coordinates.
+
+annotate_fits.py keeps the SExtractor catalog (pixel coordinates) of
+every plate it solves.  This turns such a catalog into a compact FITS
+table with the solved positions, one file per plate in sources/, which
+the import_sources data of q.rd bulk-loads into the sources table.
+
+For plates annotated before the catalogs were converted on the fly:
+
+  python bin/plate_catalogs.py data/*.fit
+"""
+
+import argparse
+import concurrent.futures
+import os
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+
+import plate_io
+
+
+def source_path(sources_dir, src_name):
+  """
+  returns the path of the source table for the plate src_name.
+
+  >>> source_path("sources", "/data/11-1964.fit")
+  'sources/11-1964.fits'
+  """
+  return os.path.join(sources_dir,
+    os.path.splitext(os.path.basename(src_name))[0]+".fits")
+
+
+def make_source_table(catalog, header, plate):
+  """
+  returns a BinTableHDU with the sources of catalog (a SExtractor
+  catalog with the default.param columns) located using the WCS in
+  header.
+
+  Column names are those of the sources table in q.rd.
+  """
+  x = np.asarray(catalog["X_IMAGE"], dtype=np.float64)
+  y = np.asarray(catalog["Y_IMAGE"], dtype=np.float64)
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    ra, dec = wcs.WCS(header).all_pix2world(x, y, 1)
+
+  plate = plate.encode("utf-8")
+  return fits.BinTableHDU.from_columns([
+    fits.Column("plate", f"{len(plate)}A", array=[plate]*len(x)),
+    fits.Column("ra", "D", unit="deg", array=ra%360),
+    fits.Column("dec", "D", unit="deg", array=dec),
+    fits.Column("x_image", "E", unit="pix", array=x),
+    fits.Column("y_image", "E", unit="pix", array=y),
+    fits.Column("mag_iso", "E", unit="mag", array=catalog["MAG_ISO"]),
+    fits.Column("flux_auto", "E", array=catalog["FLUX_AUTO"]),
+    fits.Column("elongation", "E", array=catalog["ELONGATION"]),
+  ])
+
+
+def write_sources(catalog_path, header, plate, dest):
+  """
+  writes the source table for the catalog at catalog_path to dest and
+  returns it (a BinTableHDU).
+  """
+  table = make_source_table(fits.getdata(catalog_path, 1), header, plate)
+  table.writeto(dest, overwrite=True)
+  return table
+
+
+def convert_plate(path, catalog_dir, sources_dir):
+  header = plate_io.read_plate_header(path)
+  catalog = plate_io.catalog_path(catalog_dir, path)
+  if "CRVAL1" not in header or not os.path.exists(catalog):
+    return f"{path}: no WCS or no catalog"
+  plate = header.get("FILENAME") or os.path.splitext(
+    os.path.basename(path))[0]
+  table = write_sources(catalog, header, plate,
+    source_path(sources_dir, path))
+  return f"{path}: {len(table.data)} sources"
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Write source tables with world coordinates for solved"
+      " plates")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--catalog-dir", default="catalogs",
+    help="where annotate_fits.py put the extraction catalogs")
+  parser.add_argument("--sources-dir", default="sources",
+    help="where to write the source tables")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of plates processed in parallel")
+  args = parser.parse_args()
+
+  os.makedirs(args.sources_dir, exist_ok=True)
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    for msg in pool.map(convert_plate, args.plates,
+        [args.catalog_dir]*len(args.plates),
+        [args.sources_dir]*len(args.plates)):
+      print(msg)
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,579 @@
+"""
+File handling helpers for moving plates between the archive and the
+tools working on them.
+"""
+
+import collections
+import contextlib
+import hashlib
+import io
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import types
+
+import numpy as np
+from astropy.io import fits
+
+# bytes read at a time when pulling plates into the page cache
+READ_AHEAD_BLOCK = 8*1024*1024
+
+
+def link_or_copy(src, dest):
+  """
+  makes dest refer to the contents of src as cheaply as possible and
+  returns how it did it ("symlink", "hardlink", or "copy").
+
+  A symlink works across file systems (e.g., from the archive disk into
+  a tmpfs); hard links are the fallback where symlinks are not
+  supported, and a real copy is the last resort.
+
+  >>> import tempfile, os
+  >>> d = tempfile.mkdtemp()
+  >>> with open(os.path.join(d, "a"), "w") as f: _ = f.write("x")
+  >>> link_or_copy(os.path.join(d, "a"), os.path.join(d, "b"))
+  'symlink'
+  >>> open(os.path.join(d, "b")).read()
+  'x'
+  >>> shutil.rmtree(d)
+  """
+  if os.path.isdir(dest):
+    dest = os.path.join(dest, os.path.basename(src))
+  if os.path.lexists(dest):
+    os.unlink(dest)
+  src = os.path.abspath(src)
+
+  try:
+    os.symlink(src, dest)
+    return "symlink"
+  except OSError:
+    pass
+  try:
+    os.link(src, dest)
+    return "hardlink"
+  except OSError:
+    pass
+  shutil.copy(src, dest)
+  return "copy"
+
+
+class ZeroCopyHandoff:
+  """
+  records what zero_copy_handoff did while it was active.
+  """
+  def __init__(self):
+    self.methods = []
+
+  @property
+  def method(self):
+    return ",".join(sorted(set(self.methods))) or None
+
+
+@contextlib.contextmanager
+def zero_copy_handoff(module, src_name, tmp_dir=None, enabled=True):
+  """
+  makes module (gavo.helpers.anet) link rather than copy its input
+  image src_name into its working directory and puts that directory
+  into tmp_dir while the context is active.
+
+  This replaces the shutil and tempfile names in module by thin
+  wrappers and restores them on exit.  Only copies of src_name become
+  links; everything else module copies (files it may modify or write
+  back later) is really copied.  The plate itself is then only read by
+  SExtractor and the solver, and the working files go to a tmpfs if
+  tmp_dir points to one.
+
+  >>> d = tempfile.mkdtemp()
+  >>> for name in "ab":
+  ...   with open(os.path.join(d, name), "w") as f: _ = f.write(name)
+  >>> mod = types.SimpleNamespace(shutil=shutil)
+  >>> with zero_copy_handoff(mod, os.path.join(d, "a")) as handoff:
+  ...   _ = mod.shutil.copy(os.path.join(d, "a"), os.path.join(d, "a2"))
+  ...   _ = mod.shutil.copy(os.path.join(d, "b"), os.path.join(d, "b2"))
+  >>> handoff.method, os.path.islink(os.path.join(d, "b2"))
+  ('symlink', False)
+  >>> mod.shutil is shutil
+  True
+  >>> shutil.rmtree(d)
+  """
+  handoff = ZeroCopyHandoff()
+  if not enabled:
+    yield handoff
+    return
+
+  src_path = os.path.abspath(src_name)
+
+  def linking(copy):
+    def linking_copy(src, dest, *args, **kwargs):
+      if os.path.abspath(src)!=src_path:
+        return copy(src, dest, *args, **kwargs)
+      handoff.methods.append(link_or_copy(src, dest))
+      if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+      return dest
+    return linking_copy
+
+  def mkdtemp(suffix=None, prefix=None, dir=None):
+    return tempfile.mkdtemp(suffix, prefix, tmp_dir or dir)
+
+  def mkstemp(suffix=None, prefix=None, dir=None, text=False):
+    return tempfile.mkstemp(suffix, prefix, tmp_dir or dir, text)
+
+  shutil_proxy = types.SimpleNamespace(**vars(shutil))
+  for name in ["copy", "copyfile", "copy2"]:
+    setattr(shutil_proxy, name, linking(getattr(shutil, name)))
+  tempfile_proxy = types.SimpleNamespace(**vars(tempfile))
+  tempfile_proxy.mkdtemp, tempfile_proxy.mkstemp = mkdtemp, mkstemp
+
+  saved = dict((name, getattr(module, name))
+    for name in ["shutil", "tempfile"] if hasattr(module, name))
+  module.shutil, module.tempfile = shutil_proxy, tempfile_proxy
+  try:
+    yield handoff
+  finally:
+    for name in ["shutil", "tempfile"]:
+      if name in saved:
+        setattr(module, name, saved[name])
+      else:
+        delattr(module, name)
+
+
+def catalog_path(catalog_dir, src_name):
+  """
+  returns the path of the cached extraction catalog for the plate
+  src_name.
+
+  >>> catalog_path("catalogs", "/data/plates/11-1964.fit")
+  'catalogs/11-1964.xyls'
+  """
+  return os.path.join(catalog_dir,
+    os.path.splitext(os.path.basename(src_name))[0]+".xyls")
+
+
+def _warm_page_cache(path, stop):
+  """
+  reads path sequentially so the plate is in the page cache when it is
+  processed; gives up early when stop is set.
+  """
+  try:
+    with open(path, "rb", buffering=0) as f:
+      if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      buf = bytearray(READ_AHEAD_BLOCK)
+      while not stop.is_set() and f.readinto(buf):
+        pass
+  except OSError:
+    # the processor will report unreadable files itself
+    pass
+
+
+def read_ahead(identifiers, depth=2):
+  """
+  iterates over identifiers (file names), having a background thread
+  read the next depth files into the page cache meanwhile.
+
+  The files are read one after the other, so a spinning disk sees
+  sequential reads while the CPU works on the current plate.
+
+  >>> list(read_ahead(iter(["/nonexistent/a", "/nonexistent/b"]), 1))
+  ['/nonexistent/a', '/nonexistent/b']
+  """
+  if depth<1:
+    yield from identifiers
+    return
+
+  todo, stop = queue.Queue(), threading.Event()
+  def work():
+    while True:
+      path = todo.get()
+      if path is None:
+        return
+      _warm_page_cache(path, stop)
+  reader = threading.Thread(target=work, daemon=True)
+  reader.start()
+
+  pending = collections.deque()
+  try:
+    for ident in identifiers:
+      pending.append(ident)
+      todo.put(ident)
+      if len(pending)>depth:
+        yield pending.popleft()
+    while pending:
+      yield pending.popleft()
+  finally:
+    stop.set()
+    todo.put(None)
+
+
+class WriteBehind:
+  """
+  runs output functions in a background thread.
+
+  At most depth jobs wait in the queue; submit blocks beyond that, so
+  at most depth plates are held in memory.  Errors in the jobs are
+  raised from close().  With depth=0, jobs run right away.
+
+  >>> done = []
+  >>> writer = WriteBehind(2)
+  >>> for i in range(3): writer.submit(done.append, i)
+  >>> writer.close()
+  >>> done
+  [0, 1, 2]
+  """
+  def __init__(self, depth=2):
+    self.depth = depth
+    self.errors = []
+    if depth>0:
+      self.jobs = queue.Queue(maxsize=depth)
+      self.thread = threading.Thread(target=self._work, daemon=True)
+      self.thread.start()
+
+  def _work(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      func, args = job
+      try:
+        func(*args)
+      except Exception as ex:
+        self.errors.append(ex)
+
+  def submit(self, func, *args):
+    if self.depth>0:
+      self.jobs.put((func, args))
+    else:
+      func(*args)
+
+  def close(self):
+    if self.depth>0 and self.thread.is_alive():
+      self.jobs.put(None)
+      self.thread.join()
+    if self.errors:
+      raise IOError(f"{len(self.errors)} background writes failed,"
+        f" the first with: {self.errors[0]}")
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~CHECKSUMS~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+FITS_BLOCK = 2880
+# characters the FITS checksum encoding must avoid (between "9" and "A"
+# and between "Z" and "a")
+_CHECKSUM_EXCLUDE = set(range(0x3a, 0x41))|set(range(0x5b, 0x61))
+
+
+def ones_complement_add(a, b):
+  """
+  returns the 32 bit ones' complement sum of a and b.
+
+  >>> ones_complement_add(0xffffffff, 2)
+  2
+  """
+  total = a+b
+  while total>>32:
+    total = (total&0xffffffff)+(total>>32)
+  return total
+
+
+def fits_sum(data):
+  """
+  returns the FITS (32 bit ones' complement) sum of data, whose length
+  must be a multiple of 4.
+
+  >>> fits_sum(b"\\x00\\x00\\x00\\x01"*3)
+  3
+  """
+  words = np.frombuffer(data, dtype=">u4")
+  total = int(words.sum(dtype=np.uint64))
+  return ones_complement_add(total&0xffffffff, total>>32)
+
+
+def encode_checksum(value):
+  """
+  returns the 16 character ASCII encoding of the ones' complement of
+  value for the CHECKSUM card (FITS standard, appendix J).
+
+  >>> encode_checksum(0)
+  'orrrrooooooooooo'
+  """
+  value = ~value&0xffffffff
+  asc = [0]*16
+  for i in range(4):
+    byte = (value>>(24-8*i))&0xff
+    quotient, remainder = byte//4+0x30, byte%4
+    ch = [quotient+remainder, quotient, quotient, quotient]
+    check = True
+    while check:
+      check = False
+      for j in (0, 2):
+        if ch[j] in _CHECKSUM_EXCLUDE or ch[j+1] in _CHECKSUM_EXCLUDE:
+          ch[j] += 1
+          ch[j+1] -= 1
+          check = True
+    for j in range(4):
+      asc[4*j+i] = ch[j]
+  return "".join(chr(asc[(i+15)%16]) for i in range(16))
+
+
+class _ChecksumWriter(io.RawIOBase):
+  """
+  passes through what astropy writes for a single HDU to dest while
+  keeping the header and summing and hashing the data.
+  """
+  def __init__(self, dest):
+    self.dest = dest
+    self.header_bytes = bytearray()
+    self.in_header = True
+    self.datasum = 0
+    self.hash = hashlib.sha256()
+    self.data_size = None
+    self.data_seen = 0
+    self.pending = b""
+
+  def writable(self):
+    return True
+
+  def _header_complete(self):
+    block = self.header_bytes[-FITS_BLOCK:]
+    return any(block[i:i+80].rstrip()==b"END"
+      for i in range(0, FITS_BLOCK, 80))
+
+  def _start_data(self):
+    header = fits.Header.fromstring(self.header_bytes.decode("ascii"))
+    self.data_size = abs(header.get("BITPIX", 8))//8*int(np.prod(
+      [header.get(f"NAXIS{i+1}", 0) for i in range(header.get("NAXIS", 0))]
+      or [0]))
+
+  def _add_data(self, chunk):
+    hashed = chunk[:max(self.data_size-self.data_seen, 0)]
+    self.hash.update(hashed)
+    self.data_seen += len(chunk)
+    chunk = self.pending+chunk
+    usable = len(chunk)//4*4
+    self.datasum = ones_complement_add(self.datasum,
+      fits_sum(chunk[:usable]))
+    self.pending = chunk[usable:]
+
+  def write(self, b):
+    chunk = memoryview(b).cast("B")
+    n_bytes = len(chunk)
+    while self.in_header and len(chunk):
+      missing = FITS_BLOCK-len(self.header_bytes)%FITS_BLOCK
+      self.header_bytes.extend(chunk[:missing])
+      chunk = chunk[missing:]
+      if len(self.header_bytes)%FITS_BLOCK==0 and self._header_complete():
+        self.in_header = False
+        self._start_data()
+    if len(chunk):
+      self._add_data(bytes(chunk) if self.pending else chunk)
+    self.dest.write(b)
+    return n_bytes
+
+
+def _write_single(hdul, f, **kwargs):
+  header = hdul[0].header
+  # placeholders of the final size, so the header keeps its length
+  header["DATAHASH"] = "0"*64
+  header["DATASUM"] = ("0"*10, "Data unit checksum")
+  header["CHECKSUM"] = ("0"*16, "HDU checksum")
+
+  writer = _ChecksumWriter(f)
+  hdul.writeto(writer, **kwargs)
+
+  written = fits.Header.fromstring(writer.header_bytes.decode("ascii"))
+  datahash = writer.hash.hexdigest()
+  written["DATAHASH"] = datahash
+  written["DATASUM"] = str(writer.datasum)
+  written["CHECKSUM"] = "0"*16
+  header_bytes = written.tostring().encode("ascii")
+  if len(header_bytes)!=len(writer.header_bytes):
+    raise AssertionError("Header size changed while adding checksums")
+  written["CHECKSUM"] = encode_checksum(
+    ones_complement_add(fits_sum(header_bytes), writer.datasum))
+  f.seek(0)
+  f.write(written.tostring().encode("ascii"))
+
+  for key in ["DATAHASH", "DATASUM", "CHECKSUM"]:
+    header[key] = written[key]
+  return datahash
+
+
+def _write_compressed(hdul, f, **kwargs):
+  hdu = plate_hdu(hdul)
+  # the hash of the uncompressed pixels, as compress_plates.py checks it
+  datahash = data_hash(hdu)
+  hdu.header["DATAHASH"] = datahash
+  hdul.writeto(f, checksum=True, **kwargs)
+  return datahash
+
+
+def write_with_checksums(hdul, dest, **kwargs):
+  """
+  writes the plate hdul to dest with CHECKSUM, DATASUM and DATAHASH
+  (the sha256 of the data unit without padding) and returns DATAHASH.
+
+  For single-HDU plates, the checksums are computed while writing;
+  only the header is rewritten afterwards, the data is not read back.
+  For tile-compressed plates (see compress_plates.py), DATAHASH is the
+  hash of the decompressed pixels, and astropy puts CHECKSUM and
+  DATASUM on the compressed HDU.
+
+  The file is written next to dest and then moved into place, so hdul
+  may be a memory-mapped view of dest itself.  kwargs are passed on to
+  hdul.writeto.
+
+  >>> d = tempfile.mkdtemp()
+  >>> path = os.path.join(d, "p.fit")
+  >>> fits.PrimaryHDU(np.arange(6, dtype=np.uint16).reshape(2, 3)
+  ...   ).writeto(path)
+  >>> with fits.open(path) as hdul:
+  ...   datahash = write_with_checksums(hdul, path, overwrite=True)
+  >>> with fits.open(path, checksum=True) as hdul:
+  ...   hdul[0].data.tolist(), hdul[0].header["DATAHASH"]==datahash
+  ([[0, 1, 2], [3, 4, 5]], True)
+  >>> fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(
+  ...   np.arange(6, dtype=np.uint16).reshape(2, 3))]).writeto(path,
+  ...   overwrite=True)
+  >>> with fits.open(path) as hdul:
+  ...   write_with_checksums(hdul, path, overwrite=True)==datahash
+  True
+  >>> with fits.open(path, checksum=True) as hdul:
+  ...   hdu = plate_hdu(hdul)
+  ...   hdu.data.tolist(), hdu.header["DATAHASH"]==datahash
+  ([[0, 1, 2], [3, 4, 5]], True)
+  >>> shutil.rmtree(d)
+  """
+  overwrite = kwargs.pop("overwrite", False)
+  if os.path.exists(dest) and not overwrite:
+    raise OSError(f"File {dest} already exists")
+  compressed = isinstance(plate_hdu(hdul), fits.CompImageHDU)
+  if len(hdul)!=1 and not compressed:
+    raise ValueError("write_with_checksums only handles single-HDU"
+      " and tile-compressed plates")
+
+  try:
+    with open(dest+".tmp", "wb") as f:
+      if compressed:
+        datahash = _write_compressed(hdul, f, **kwargs)
+      else:
+        datahash = _write_single(hdul, f, **kwargs)
+  except BaseException:
+    if os.path.exists(dest+".tmp"):
+      os.unlink(dest+".tmp")
+    raise
+  os.replace(dest+".tmp", dest)
+  return datahash
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~COMPRESSED PLATES~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def plate_hdu(hdul):
+  """
+  returns the HDU holding the plate image: the primary HDU, or the first
+  extension for tile-compressed plates (see compress_plates.py), whose
+  primary HDU is empty.
+
+  Sections of compressed HDUs only decompress the tiles they touch.
+  """
+  if hdul[0].header.get("NAXIS", 0)==0:
+    return hdul[1]
+  return hdul[0]
+
+
+def read_plate_header(path):
+  """
+  returns the header of the plate image in the file at path, reading no
+  more than the headers of the first two HDUs.
+  """
+  header = fits.Header.fromfile(path)
+  if header.get("NAXIS", 0)==0:
+    with fits.open(path) as hdul:
+      header = hdul[1].header.copy()
+  return header
+
+
+def _is_structural(keyword):
+  return keyword in ("SIMPLE", "XTENSION", "BITPIX", "EXTEND", "PCOUNT",
+    "GCOUNT") or keyword.startswith("NAXIS")
+
+
+def set_plate_header(hdul, header):
+  """
+  makes header the header of the plate image in hdul.
+
+  Assigning to the header of a tile-compressed HDU does not reach the
+  file, so there the cards are replaced in place, keeping the ones
+  describing the image structure.
+
+  >>> hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(
+  ...   np.zeros((2, 3), dtype=np.int16))])
+  >>> header = plate_hdu(hdul).header.copy()
+  >>> header["OBJECT"] = "M 42"
+  >>> set_plate_header(hdul, header)
+  >>> f = io.BytesIO(); hdul.writeto(f); _ = f.seek(0)
+  >>> plate_hdu(fits.open(f)).header["OBJECT"]
+  'M 42'
+  """
+  hdu = plate_hdu(hdul)
+  if not isinstance(hdu, fits.CompImageHDU):
+    hdu.header = header
+    return
+  for keyword in set(hdu.header.keys()):
+    if not _is_structural(keyword):
+      del hdu.header[keyword]
+  hdu.header.extend(card for card in header.cards
+    if not _is_structural(card.keyword))
+
+
+def content_key(path):
+  """
+  returns what identifies the content of the plate at path: DATAHASH
+  if the header has it, size and mtime otherwise.
+
+  The incremental tools (previews, HiPS, MOCs, calibration index and
+  stacks) keep these to tell which plates changed since their last run.
+  """
+  header = read_plate_header(path)
+  if "DATAHASH" in header:
+    return header["DATAHASH"]
+  st = os.stat(path)
+  return f"{st.st_size}-{st.st_mtime}"
+
+
+def data_hash(hdu, chunk_rows=512):
+  """
+  returns the sha256 of the (big-endian, unscaled) data unit of the
+  image HDU hdu, i.e., DATAHASH as written by write_with_checksums.
+
+  hdu may be compressed; the data is read in chunks of rows.
+
+  >>> d = tempfile.mkdtemp()
+  >>> path = os.path.join(d, "p.fit")
+  >>> hdul = fits.HDUList([fits.PrimaryHDU(
+  ...   np.arange(6, dtype=np.uint16).reshape(2, 3))])
+  >>> datahash = write_with_checksums(hdul, path)
+  >>> with fits.open(path) as hdul:
+  ...   data_hash(plate_hdu(hdul))==datahash
+  True
+  >>> shutil.rmtree(d)
+  """
+  header = hdu.header
+  bitpix = header["BITPIX"]
+  raw_type = np.dtype({8: "u1", 16: ">i2", 32: ">i4", 64: ">i8",
+    -32: ">f4", -64: ">f8"}[bitpix])
+  bzero, bscale = header.get("BZERO", 0), header.get("BSCALE", 1)
+  digest = hashlib.sha256()
+  section = hdu.section
+  for row0 in range(0, hdu.shape[0], chunk_rows):
+    chunk = np.asarray(section[row0:row0+chunk_rows])
+    if bitpix>0 and (bzero or bscale!=1):
+      chunk = np.round((chunk-bzero)/bscale)
+    digest.update(np.ascontiguousarray(chunk, dtype=raw_type).tobytes())
+  return digest.hexdigest()
@@ -0,0 +1,227 @@
+"""
+Per-plate MOCs, the collection MOC and a HEALPix cell to plate index.
+
+For every solved plate, the HEALPix cells (order --order) its WCS
+footprint touches are found by sampling the plate on a grid finer than
+the cells (in a process pool).  The cells go into moc_index.sqlite,
+where a cell to plate table makes "which plates cover this position" a
+single index lookup (--lookup RA DEC), and, as normalized ASCII MOCs,
+into mocs/<plate>.moc, from where the import data of q.rd fills the moc
+column of the main table.
+
+The union of all plates, degraded to --registry-order, is written to
+mocs/collection.moc.  The coverage of q.rd is not taken from there but
+computed by "dachs limits q" from the main table, whose moc column
+holds the plate MOCs.  Only new and changed plates are processed
+again.
+
+  python bin/plate_mocs.py data/*.fit
+  python bin/plate_mocs.py --lookup 83.78 9.93
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sqlite3
+
+import numpy as np
+
+import healpix
+import plate_io
+import platesolve
+
+MOC_ORDER = 10
+REGISTRY_ORDER = 6
+MOC_DIR = "mocs"
+INDEX_PATH = "moc_index.sqlite"
+
+
+def normalize(cells, order):
+  """
+  returns the MOC of cells (nested pixels of order) as a dict mapping
+  orders to sorted pixel lists, with complete groups of four siblings
+  replaced by their parent.
+
+  >>> normalize([4, 5, 6, 7, 9], 1)
+  {0: [1], 1: [9]}
+  """
+  moc = {}
+  current = set(int(c) for c in cells)
+  for level in range(order, 0, -1):
+    parents = {}
+    for cell in current:
+      parents.setdefault(cell>>2, []).append(cell)
+    complete = set(parent for parent, children in parents.items()
+      if len(children)==4)
+    rest = sorted(cell for cell in current if cell>>2 not in complete)
+    if rest:
+      moc[level] = rest
+    current = complete
+  if current:
+    moc[0] = sorted(current)
+  return dict(sorted(moc.items()))
+
+
+def to_ascii(moc):
+  """
+  returns the IVOA ASCII serialization of a MOC from normalize.
+
+  >>> to_ascii({0: [1], 3: [5, 6, 7, 9]})
+  '0/1 3/5-7,9'
+  """
+  parts = []
+  for order, cells in moc.items():
+    ranges = []
+    for cell in cells:
+      if ranges and ranges[-1][1]==cell-1:
+        ranges[-1][1] = cell
+      else:
+        ranges.append([cell, cell])
+    parts.append(f"{order}/"+",".join(f"{a}-{b}" if a!=b else f"{a}"
+      for a, b in ranges))
+  return " ".join(parts)
+
+
+def degrade(cells, order, to_order):
+  """
+  returns the sorted cells of to_order containing cells of order.
+
+  >>> degrade([16, 17, 40], 2, 1)
+  [4, 10]
+  """
+  return sorted(set(int(c)>>(2*(order-to_order)) for c in cells))
+
+
+def plate_cells(path, order=MOC_ORDER):
+  """
+  returns the cells of order the footprint of the solved plate at path
+  touches, sampling the plate at less than half the cell size.
+  """
+  scale = platesolve.pixel_scale(plate_io.read_plate_header(path))
+  step = max(1, int(healpix.pixel_size(order)/scale/2))
+  return healpix.plate_tiles(path, order, step)
+
+
+class MocIndex:
+  """
+  the cells of the solved plates in an sqlite database.
+  """
+  def __init__(self, path):
+    self.conn = sqlite3.connect(path)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS plates ("
+      " plate TEXT PRIMARY KEY, key TEXT, moc_order INTEGER)")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS cells ("
+      " cell INTEGER, plate TEXT)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS cells_cell ON cells (cell)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS cells_plate"
+      " ON cells (plate)")
+    self.conn.commit()
+
+  def keys(self):
+    return dict(self.conn.execute("SELECT plate, key FROM plates"))
+
+  def record(self, plate, key, order, cells):
+    self.remove(plate)
+    self.conn.execute("INSERT INTO plates VALUES (?, ?, ?)",
+      (plate, key, order))
+    self.conn.executemany("INSERT INTO cells VALUES (?, ?)",
+      ((int(cell), plate) for cell in cells))
+
+  def remove(self, plate):
+    self.conn.execute("DELETE FROM plates WHERE plate=?", (plate,))
+    self.conn.execute("DELETE FROM cells WHERE plate=?", (plate,))
+
+  def commit(self):
+    self.conn.commit()
+
+  def order(self):
+    row = self.conn.execute("SELECT MAX(moc_order) FROM plates").fetchone()
+    return row[0]
+
+  def plates_at(self, ra, dec, order=MOC_ORDER):
+    """
+    returns the plates whose footprint touches the cell containing
+    ra, dec.
+    """
+    cell = int(healpix.radec_to_pix(order, ra, dec))
+    return [row[0] for row in self.conn.execute(
+      "SELECT plate FROM cells WHERE cell=? ORDER BY plate", (cell,))]
+
+  def all_cells(self):
+    return np.array([row[0] for row in self.conn.execute(
+      "SELECT DISTINCT cell FROM cells")], dtype=np.int64)
+
+  def close(self):
+    self.conn.close()
+
+
+def plate_moc_path(moc_dir, path):
+  """
+  returns where the MOC of the plate at path goes.
+
+  >>> plate_moc_path("mocs", "/data/11-1964.fit")
+  'mocs/11-1964.fit.moc'
+  """
+  return os.path.join(moc_dir, os.path.basename(path)+".moc")
+
+
+def compute_plate(path, order):
+  return path, plate_cells(path, order)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Compute plate MOCs, the collection MOC and a cell index")
+  parser.add_argument("plates", nargs="*",
+    help="all plate FITS files of the collection (unsolved ones are skipped)")
+  parser.add_argument("--order", type=int, default=MOC_ORDER,
+    help="HEALPix order of the plate MOCs and the cell index")
+  parser.add_argument("--registry-order", type=int, default=REGISTRY_ORDER,
+    help="HEALPix order of the collection MOC")
+  parser.add_argument("--moc-dir", default=MOC_DIR,
+    help="where the MOC files go")
+  parser.add_argument("--index", default=INDEX_PATH,
+    help="the cell index database")
+  parser.add_argument("--lookup", type=float, nargs=2, metavar=("RA", "DEC"),
+    help="only list the plates covering this position")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of plates processed in parallel")
+  args = parser.parse_args()
+
+  index = MocIndex(args.index)
+  if args.lookup:
+    print("\n".join(index.plates_at(*args.lookup,
+      order=index.order() or args.order)))
+    return
+
+  os.makedirs(args.moc_dir, exist_ok=True)
+  known = index.keys()
+  solved = [path for path in args.plates
+    if "CRVAL1" in plate_io.read_plate_header(path)]
+  keys = dict((path, plate_io.content_key(path)) for path in solved)
+  todo = [path for path in solved if known.get(path)!=keys[path]
+    or not os.path.exists(plate_moc_path(args.moc_dir, path))]
+
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    for path, cells in pool.map(compute_plate, todo,
+        [args.order]*len(todo)):
+      index.record(path, keys[path], args.order, cells)
+      with open(plate_moc_path(args.moc_dir, path), "w") as f:
+        f.write(to_ascii(normalize(cells, args.order))+"\n")
+  for path in set(known)-set(keys):
+    index.remove(path)
+    if os.path.exists(plate_moc_path(args.moc_dir, path)):
+      os.unlink(plate_moc_path(args.moc_dir, path))
+  index.commit()
+
+  collection = to_ascii(normalize(degrade(index.all_cells(), args.order,
+    args.registry_order), args.registry_order))
+  with open(os.path.join(args.moc_dir, "collection.moc"), "w") as f:
+    f.write(collection+"\n")
+  index.close()
+  print(f"{len(todo)} plate MOCs computed, {len(solved)} solved plates,"
+    f" collection MOC: {collection[:60]}")
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,188 @@
+"""
+Plate quality metrics from a single pass over the pixels.
+
+The image is read in row chunks; each chunk goes into a 16-bit value
+histogram (np.bincount) and contributes a few isolated stars for the
+FWHM estimate.  Background, noise, saturation, dynamic range and the
+coarse histogram all come out of the accumulated histogram, so nothing
+but the histogram and one chunk is held in memory.
+
+The metrics go into the header as Q* cards (see quality_cards), from
+where the import data of q.rd puts them into the main table.
+
+  python bin/plate_quality.py plate.fit [...]
+"""
+
+import argparse
+import math
+
+import numpy as np
+from astropy.io import fits
+
+import plate_io
+
+CHUNK_ROWS = 256
+# bins of the coarse histogram (QHIST1 ... QHISTn)
+COARSE_BINS = 16
+# stars per chunk used for the FWHM and the half size of their cutouts
+PEAKS_PER_CHUNK = 5
+PEAK_BOX = 7
+# minimal peak height above background in units of the noise
+MIN_PEAK_SNR = 20
+
+
+def _histogram_values(chunk):
+  """
+  returns chunk as non-negative integers below 65536 and the offset to
+  add to get back the pixel values.
+  """
+  if chunk.dtype.kind=="u" and chunk.dtype.itemsize<=2:
+    return chunk, 0
+  if chunk.dtype.kind=="i" and chunk.dtype.itemsize<=2:
+    return chunk.astype(np.int32)+32768, -32768
+  # float plates, as left by some converters, are in the 16 bit range
+  return np.clip(np.nan_to_num(chunk), 0, 65535).astype(np.uint16), 0
+
+
+def _percentile(cumulative, fraction):
+  return int(np.searchsorted(cumulative, fraction*cumulative[-1]))
+
+
+def peak_fwhms(chunk, n_peaks=PEAKS_PER_CHUNK, box=PEAK_BOX):
+  """
+  returns FWHM estimates (pixels) from up to n_peaks bright, isolated,
+  unsaturated local maxima in chunk.
+
+  The FWHM is the diameter of a circle with the area above half the
+  peak height.
+
+  >>> y, x = np.mgrid[:40, :40]
+  >>> chunk = 100+1000*np.exp(-((x-20)**2+(y-20)**2)/(2*(4/2.3548)**2))
+  >>> [round(f, 1) for f in peak_fwhms(chunk)]
+  [4.1]
+  """
+  height, width = chunk.shape
+  if height<2*box+1 or width<2*box+1:
+    return []
+  sample = chunk[::4, ::4].astype(np.float32)
+  background = float(np.median(sample))
+  noise = 1.4826*float(np.median(np.abs(sample-background))) or 1.
+
+  flat = chunk.ravel()
+  n_candidates = min(n_peaks*40, flat.size)
+  candidates = np.argpartition(flat, -n_candidates)[-n_candidates:]
+  candidates = candidates[np.argsort(flat[candidates])[::-1]]
+
+  fwhms = []
+  for index in candidates:
+    y, x = divmod(int(index), width)
+    if y<box or y>=height-box or x<box or x>=width-box:
+      continue
+    cutout = chunk[y-box:y+box+1, x-box:x+box+1].astype(np.float32)
+    peak = cutout[box, box]
+    # not a local maximum, or flat-topped (saturated)
+    if peak<cutout.max() or np.count_nonzero(cutout==peak)>1:
+      continue
+    height_above = peak-background
+    if height_above<MIN_PEAK_SNR*noise:
+      break
+    area = np.count_nonzero(cutout-background>=height_above/2)
+    fwhms.append(2*math.sqrt(area/math.pi))
+    if len(fwhms)>=n_peaks:
+      break
+  return fwhms
+
+
+def measure(data, chunk_rows=CHUNK_ROWS):
+  """
+  returns a dict of quality metrics for a 2D image.
+
+  data can be anything sliceable by rows, in particular an HDU's data
+  (a memory map for unscaled images) or section.
+
+  >>> rng = np.random.default_rng(1)
+  >>> img = rng.normal(3000, 50, (300, 200)).astype(np.uint16)
+  >>> img[:30] = 65535
+  >>> m = measure(img, 64)
+  >>> m["background"], round(m["noise"]), m["saturated"]
+  (2999.0, 50, 0.1)
+  >>> m["histogram"][:2], m["histogram"][-1]
+  ([0.9, 0.0], 0.1)
+  """
+  hist = np.zeros(65536, dtype=np.int64)
+  offset = 0
+  fwhms = []
+  for row0 in range(0, data.shape[0], chunk_rows):
+    chunk = np.asarray(data[row0:row0+chunk_rows])
+    values, offset = _histogram_values(chunk)
+    hist += np.bincount(values.ravel(), minlength=65536)
+    fwhms.extend(peak_fwhms(chunk))
+
+  cumulative = np.cumsum(hist)
+  total = cumulative[-1]
+  maximum = int(np.nonzero(hist)[0][-1])
+  saturated = hist[maximum] if hist[maximum]>1 else 0
+
+  # saturated pixels are not background, and since stars only add to
+  # the bright side, the noise comes from the faint half
+  background_cumulative = cumulative.copy()
+  background_cumulative[maximum:] -= saturated
+  low, median = (_percentile(background_cumulative, f)
+    for f in (0.158655, 0.5))
+  coarse = hist.reshape(COARSE_BINS, -1).sum(axis=1)/total
+
+  return {
+    "background": float(median+offset),
+    "noise": float(median-low),
+    "saturated": float(saturated/total),
+    "dynamic_range": float(_percentile(cumulative, 0.999)
+      -_percentile(cumulative, 0.001)),
+    "fwhm": float(np.median(fwhms)) if fwhms else None,
+    "histogram": [round(float(f), 5) for f in coarse],
+  }
+
+
+def quality_cards(metrics):
+  """
+  returns header cards for metrics from measure.
+
+  >>> [c[0] for c in quality_cards({"background": 1., "noise": 1.,
+  ...   "saturated": 0., "dynamic_range": 1., "fwhm": None,
+  ...   "histogram": [1., 0.]})]
+  ['QBACK', 'QNOISE', 'QSATFRAC', 'QDYNRNG', 'QHIST1', 'QHIST2']
+  """
+  cards = [
+    ("QBACK", metrics["background"], "[adu] Median pixel value"),
+    ("QNOISE", metrics["noise"], "[adu] Pixel value spread (16-50%)"),
+    ("QSATFRAC", round(metrics["saturated"], 6),
+      "Fraction of pixels at the maximum value"),
+    ("QDYNRNG", metrics["dynamic_range"], "[adu] 0.1 to 99.9% pixel range")]
+  if metrics["fwhm"] is not None:
+    cards.append(("QFWHM", round(metrics["fwhm"], 2),
+      "[pix] Approximate stellar FWHM"))
+  cards.extend((f"QHIST{i+1}", frac, "Fraction of pixels in 16-bit range bin")
+    for i, frac in enumerate(metrics["histogram"]))
+  return cards
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Compute quality metrics of plates and add them to their"
+      " headers")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--dry-run", action="store_true",
+    help="only print the metrics")
+  args = parser.parse_args()
+
+  for path in args.plates:
+    with fits.open(path, mode="readonly" if args.dry_run else "update"
+        ) as hdul:
+      hdu = plate_io.plate_hdu(hdul)
+      cards = quality_cards(measure(hdu.section))
+      print(path, " ".join(f"{c[0]}={c[1]}" for c in cards[:5]))
+      if not args.dry_run:
+        hdu.header.update(cards)
+
+
+if __name__=="__main__":
+  main()
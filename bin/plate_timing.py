@@ -0,0 +1,318 @@
+"""
+Per-plate stage timing for the annotation pipeline.
+
+The processor in annotate_fits.py wraps its stages (opening the FITS,
+Simbad queries, sunset/sunrise, the UT delta, SExtractor, the solve,
+header building, writing) in PlateTimer.stage; each plate ends up as
+one JSON line in the timing log.  This is a perf_counter call per stage
+and one short write per plate, so it can stay on in production.
+
+To see where the time goes, run
+
+  python bin/plate_timing.py timing.jsonl [--top 5] [--csv]
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+
+
+# the timer of the plate currently being processed (if any); this is
+# what the timed decorator reports to.
+current = None
+
+
+def percentile(values, q):
+  """
+  returns the q-th percentile (0..100) of values with linear interpolation.
+
+  >>> percentile([1, 2, 3, 4], 50)
+  2.5
+  >>> percentile([5], 90)
+  5
+  >>> percentile([1, 2, 3, 4, 5], 90)
+  4.6
+  """
+  values = sorted(values)
+  if len(values)==1:
+    return values[0]
+  pos = (len(values)-1)*q/100.
+  lower = int(pos)
+  upper = min(lower+1, len(values)-1)
+  return values[lower]+(values[upper]-values[lower])*(pos-lower)
+
+
+class PlateTimer:
+  """
+  collects stage durations for one plate after another and writes them
+  to a JSON lines log.
+
+  Stages entered more than once for a plate (e.g., get_delta_real) are
+  summed up.  Stages may nest; the summary then reports the inner stage
+  both on its own and as part of the outer one.
+
+  A plate's record can be taken with plate_record and written later
+  with write_record, from another thread if necessary (annotate_fits.py
+  does this for plates written in the background).
+  """
+  def __init__(self, log_path):
+    self.log_path = log_path
+    self.log = None
+    if log_path:
+      self.log = open(log_path, "a", encoding="utf-8", buffering=1)
+    self.plate = None
+    self._starts = []
+    self._lock = threading.Lock()
+
+  def start_plate(self, plate):
+    global current
+    self.plate = plate
+    self.stages = {}
+    self.notes = {}
+    self._starts = []
+    self.started = time.time()
+    self.t0 = time.perf_counter()
+    current = self
+
+  def add(self, name, seconds):
+    self.stages[name] = self.stages.get(name, 0)+seconds
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """
+    a context manager timing the enclosed code as the stage name.
+
+    Within the stage, mark(other_name) books the time elapsed so far
+    as other_name; only the rest goes to name then.
+    """
+    self._starts.append(time.perf_counter())
+    try:
+      yield self
+    finally:
+      self.add(name, time.perf_counter()-self._starts.pop())
+
+  def mark(self, name):
+    if not self._starts:
+      return
+    now = time.perf_counter()
+    self.add(name, now-self._starts[-1])
+    self._starts[-1] = now
+
+  def note(self, **kwargs):
+    """
+    adds free-form fields (e.g., why a solve was skipped) to the
+    current plate's record.
+    """
+    self.notes.update(kwargs)
+
+  def plate_record(self, status="ok"):
+    """
+    returns the record of the current plate (None without one) and
+    ends the plate without writing the record.
+    """
+    global current
+    if self.plate is None:
+      return None
+    rec = {
+      "plate": self.plate,
+      "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+        time.gmtime(self.started)),
+      "status": status,
+      "total": round(time.perf_counter()-self.t0, 6),
+      "stages": dict((k, round(v, 6)) for k, v in self.stages.items())}
+    rec.update(self.notes)
+    self.plate = None
+    current = None
+    return rec
+
+  def write_record(self, rec):
+    if self.log and rec is not None:
+      with self._lock:
+        self.log.write(json.dumps(rec, ensure_ascii=False)+"\n")
+
+  def finish_plate(self, status="ok"):
+    self.write_record(self.plate_record(status))
+
+  def close(self):
+    if self.log:
+      self.log.close()
+      self.log = None
+
+
+def timed(stage_name):
+  """
+  a decorator booking the run time of the decorated function as stage_name
+  on the current plate timer.
+
+  Without an active timer, the function is called as is.
+  """
+  def deco(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if current is None or current.plate is None:
+        return func(*args, **kwargs)
+      t0 = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        current.add(stage_name, time.perf_counter()-t0)
+    return wrapper
+  return deco
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~SUMMARY~~~~~~~~~~~~~~~~~~~~~~
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def read_records(paths):
+  for path in paths:
+    with open(path, encoding="utf-8") as f:
+      for line in f:
+        line = line.strip()
+        if line:
+          yield json.loads(line)
+
+
+def summarize(records, top=5):
+  """
+  returns a list of per-stage summary dicts, sorted by total time.
+
+  >>> recs = [{"plate": "a", "total": 3, "stages": {"solve": 2, "write": 1}},
+  ...   {"plate": "b", "total": 5, "stages": {"solve": 4}}]
+  >>> [(s["stage"], s["count"], s["total"], s["slowest"][0][0])
+  ...   for s in summarize(recs)]
+  [('(plate)', 2, 8, 'b'), ('solve', 2, 6, 'b'), ('write', 1, 1, 'a')]
+  """
+  by_stage = {}
+  for rec in records:
+    by_stage.setdefault("(plate)", []).append((rec["total"], rec["plate"]))
+    for stage, secs in rec["stages"].items():
+      by_stage.setdefault(stage, []).append((secs, rec["plate"]))
+
+  res = []
+  for stage, timings in by_stage.items():
+    secs = [t for t, _ in timings]
+    res.append({
+      "stage": stage,
+      "count": len(secs),
+      "total": sum(secs),
+      "mean": sum(secs)/len(secs),
+      "p50": percentile(secs, 50),
+      "p90": percentile(secs, 90),
+      "p99": percentile(secs, 99),
+      "max": max(secs),
+      "slowest": [(plate, t) for t, plate in sorted(timings, reverse=True)[:top]]})
+  res.sort(key=lambda s: -s["total"])
+  return res
+
+
+def count_statuses(records):
+  counts = {}
+  for rec in records:
+    counts[rec.get("status", "ok")] = counts.get(rec.get("status", "ok"), 0)+1
+  return counts
+
+
+def summarize_policy(records):
+  """
+  returns a list of (action, count, solve seconds) for the solve policy
+  decisions in records and an estimate of the solve time saved by the
+  skipped plates.
+
+  The estimate uses the mean solve time of failed plates (which is what
+  the skipped ones would most likely have cost) or, if there are none,
+  of all solved plates.
+
+  >>> recs = [{"status": "failed", "solve_policy": "solve",
+  ...     "stages": {"solve": 180}},
+  ...   {"status": "ok", "solve_policy": "solve", "stages": {"solve": 20}},
+  ...   {"status": "ok", "solve_policy": "skip", "stages": {}}]
+  >>> summarize_policy(recs)
+  ([('skip', 1, 0), ('solve', 2, 200)], 180.0)
+  """
+  by_action, failed_solves, all_solves = {}, [], []
+  for rec in records:
+    action = rec.get("solve_policy")
+    if action is None:
+      continue
+    solve = rec["stages"].get("solve", 0)
+    count, secs = by_action.get(action, (0, 0))
+    by_action[action] = (count+1, secs+solve)
+    if "solve" in rec["stages"]:
+      all_solves.append(solve)
+      if rec.get("status")=="failed":
+        failed_solves.append(solve)
+
+  reference = failed_solves or all_solves
+  saved = 0
+  if reference:
+    saved = by_action.get("skip", (0, 0))[0]*sum(reference)/len(reference)
+  return sorted((a, c, s) for a, (c, s) in by_action.items()), saved
+
+
+def format_summary(summary, statuses, policy=None):
+  lines = ["plates: "+", ".join(f"{k}={v}" for k, v in sorted(statuses.items())),
+    f"{'stage':<16}{'n':>7}{'total':>11}{'mean':>9}{'p50':>9}"
+    f"{'p90':>9}{'p99':>9}{'max':>9}"]
+  for s in summary:
+    lines.append(f"{s['stage']:<16}{s['count']:>7}{s['total']:>11.2f}"
+      f"{s['mean']:>9.3f}{s['p50']:>9.3f}{s['p90']:>9.3f}{s['p99']:>9.3f}"
+      f"{s['max']:>9.3f}")
+  if policy and policy[0]:
+    lines.append("")
+    lines.append("solve policy:")
+    for action, count, secs in policy[0]:
+      lines.append(f"  {action:<8}{count:>7} plates, {secs:>10.1f} s solving")
+    lines.append(f"  estimated solve time saved by skipping: {policy[1]:.1f} s")
+  lines.append("")
+  lines.append("slowest plates per stage:")
+  for s in summary:
+    lines.append(f"  {s['stage']}: "+", ".join(
+      f"{plate} ({t:.2f}s)" for plate, t in s["slowest"]))
+  return "\n".join(lines)
+
+
+def write_csv(summary, dest):
+  import csv
+  wr = csv.writer(dest)
+  wr.writerow(["stage", "count", "total", "mean", "p50", "p90", "p99", "max"])
+  for s in summary:
+    wr.writerow([s["stage"], s["count"]]+["%.6f"%s[k]
+      for k in ["total", "mean", "p50", "p90", "p99", "max"]])
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Summarize per-plate stage timings of annotate_fits.py")
+  parser.add_argument("logs", nargs="+", help="timing log(s) (JSON lines)")
+  parser.add_argument("--top", type=int, default=5,
+    help="number of slowest plates to list per stage")
+  parser.add_argument("--status", help="only use plates with this status"
+    " (ok, failed or skipped; by default, the stage timings leave out the"
+    " skipped plates, which were already processed)")
+  parser.add_argument("--csv", action="store_true",
+    help="write the per-stage table as CSV to stdout")
+  args = parser.parse_args()
+
+  records = list(read_records(args.logs))
+  if args.status:
+    records = [r for r in records if r.get("status")==args.status]
+  timed_records = records
+  if not args.status:
+    timed_records = [r for r in records if r.get("status")!="skipped"]
+  if not timed_records:
+    sys.exit("No timing records found.")
+  summary = summarize(timed_records, args.top)
+  if args.csv:
+    write_csv(summary, sys.stdout)
+  else:
+    print(format_summary(summary, count_statuses(records),
+      summarize_policy(timed_records)))
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,118 @@
+"""
+Running astrometry.net's solve-field on source lists we extracted
+ourselves.
+
+gavo.helpers.anet always runs its own SExtractor pass over the image.
+When we already have a catalog (e.g., from tiled_extract.py), this
+solves it directly, with the same index and scale settings as
+PAHeaderAdder, and returns the resulting WCS header.
+"""
+
+import glob
+import math
+import os
+import subprocess
+
+from astropy.io import fits
+from astropy import wcs
+
+# search radius (degrees) around a seed's field centre
+SEED_RADIUS = 2.
+# relative tolerance on a seed's pixel scale
+SEED_SCALE_TOLERANCE = 0.05
+# time limit (seconds) for seeded solves
+SEED_TIMELIMIT = 20
+
+
+def write_backend_config(dest, index_path, index_patterns):
+  """
+  writes an astrometry.net backend configuration using the index files
+  matching index_patterns in index_path.
+  """
+  index_files = sorted(set(f for pat in index_patterns
+    for f in glob.glob(os.path.join(index_path, pat))))
+  if not index_files:
+    raise EnvironmentError(f"No anet indexes matching {index_patterns}"
+      f" in {index_path}")
+  with open(dest, "w") as f:
+    f.write("inparallel\n")
+    f.write(f"add_path {index_path}\n")
+    for name in index_files:
+      f.write(f"index {name}\n")
+  return dest
+
+
+def solve_xyls(xyls, width, height, work_dir, index_path, index_patterns,
+    lower_pix, upper_pix, timelimit, objs=None, sort_column="MAG_ISO",
+    extra_args=()):
+  """
+  returns the WCS header solve-field finds for the source list xyls
+  (a FITS table with X_IMAGE and Y_IMAGE), or None if there is no solution.
+
+  Scales are in arcsec per pixel; objs limits the number of sources
+  used (like anet's endob).
+  """
+  base = os.path.join(work_dir, "solve")
+  config = write_backend_config(os.path.join(work_dir, "backend.cfg"),
+    index_path, index_patterns)
+  args = ["solve-field", xyls,
+    "--config", config,
+    "--width", str(width), "--height", str(height),
+    "--x-column", "X_IMAGE", "--y-column", "Y_IMAGE",
+    "--sort-column", sort_column, "--sort-ascending",
+    "--scale-units", "arcsecperpix",
+    "--scale-low", str(lower_pix), "--scale-high", str(upper_pix),
+    "--cpulimit", str(timelimit),
+    "--dir", work_dir,
+    "--wcs", base+".wcs", "--solved", base+".solved",
+    "--new-fits", "none", "--index-xyls", "none", "--rdls", "none",
+    "--corr", "none", "--match", "none", "--axy", base+".axy",
+    "--no-plots", "--overwrite"]
+  if objs:
+    args.extend(["--objs", str(objs)])
+  args.extend(extra_args)
+
+  subprocess.run(args, cwd=work_dir, stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL)
+  if not os.path.exists(base+".solved") or not os.path.exists(base+".wcs"):
+    return None
+  return fits.getheader(base+".wcs")
+
+
+def pixel_scale(header):
+  """
+  returns the pixel scale in arcsec per pixel of a WCS header.
+
+  >>> pixel_scale(fits.Header([("CD1_1", -0.001), ("CD1_2", 0.),
+  ...   ("CD2_1", 0.), ("CD2_2", 0.001)]))
+  3.6
+  """
+  if "CD1_1" in header:
+    det = (header["CD1_1"]*header["CD2_2"]
+      -header.get("CD1_2", 0)*header.get("CD2_1", 0))
+  else:
+    det = header["CDELT1"]*header["CDELT2"]
+  return round(math.sqrt(abs(det))*3600, 9)
+
+
+def verify_xyls(xyls, width, height, work_dir, index_path, index_patterns,
+    seed_header, radius=SEED_RADIUS, timelimit=SEED_TIMELIMIT, objs=None):
+  """
+  returns the WCS header for the source list xyls starting from the
+  WCS of a neighbouring plate (seed_header), or None.
+
+  solve-field first verifies the seed WCS; if that fails, it searches
+  only within radius degrees of the seed's field centre and close to
+  its pixel scale, which is a lot faster than a blind solve.
+  """
+  seed_path = os.path.join(work_dir, "seed.wcs")
+  fits.PrimaryHDU(header=seed_header).writeto(seed_path, overwrite=True)
+  ra, dec = wcs.WCS(seed_header).all_pix2world(
+    [[width/2., height/2.]], 1)[0]
+  scale = pixel_scale(seed_header)
+
+  return solve_xyls(xyls, width, height, work_dir, index_path,
+    index_patterns, scale*(1-SEED_SCALE_TOLERANCE),
+    scale*(1+SEED_SCALE_TOLERANCE), timelimit, objs=objs,
+    extra_args=["--verify", seed_path,
+      "--ra", str(ra), "--dec", str(dec), "--radius", str(radius)])
@@ -0,0 +1,114 @@
+"""
+Access to a local astrometric reference catalog (e.g., a Tycho-2 or
+Gaia extract) as a FITS table or a CSV file with RA, DEC (degrees) and
+a magnitude column.
+
+RefIndex builds a KD-tree over the whole catalog once; positional
+matches are then tree queries on 3D unit vectors, which have no
+trouble at the poles or at RA=0.
+"""
+
+import numpy as np
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+
+def load(path, ra_col="RA", dec_col="DEC", mag_col="MAG"):
+  """
+  returns the reference catalog at path as a structured array with
+  ra, dec and mag columns (mag is NaN if the catalog has no mag_col).
+  """
+  if path.endswith((".csv", ".txt")):
+    raw = np.genfromtxt(path, delimiter=",", names=True, dtype=None,
+      encoding="utf-8")
+  else:
+    raw = fits.getdata(path, 1)
+  names = raw.dtype.names
+
+  cat = np.empty(len(raw), dtype=[("ra", "f8"), ("dec", "f8"),
+    ("mag", "f4")])
+  cat["ra"] = raw[ra_col]
+  cat["dec"] = raw[dec_col]
+  cat["mag"] = raw[mag_col] if mag_col in names else np.nan
+  return cat
+
+
+def unit_vectors(ra, dec):
+  """
+  returns an (n, 3) array of unit vectors for positions in degrees.
+
+  >>> unit_vectors(np.array([90.]), np.array([0.])).round(6).tolist()
+  [[0.0, 1.0, 0.0]]
+  """
+  ra, dec = np.radians(ra), np.radians(dec)
+  return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+    np.sin(dec)])
+
+
+def cone(cat, ra, dec, radius, mag_limit=None):
+  """
+  returns the objects of cat within radius degrees of (ra, dec),
+  optionally only those brighter than mag_limit.
+
+  >>> cat = np.array([(10., 0., 5.), (10.5, 0., 9.), (30., 0., 5.)],
+  ...   dtype=[("ra", "f8"), ("dec", "f8"), ("mag", "f4")])
+  >>> cone(cat, 10, 0, 1)["ra"].tolist()
+  [10.0, 10.5]
+  >>> cone(cat, 10, 0, 1, mag_limit=8)["ra"].tolist()
+  [10.0]
+  """
+  # cheap pre-selection in declination before the exact test
+  sel = np.abs(cat["dec"]-dec)<=radius
+  if mag_limit is not None:
+    sel &= ~(cat["mag"]>mag_limit)
+  cat = cat[sel]
+  centre = unit_vectors(np.array([ra]), np.array([dec]))[0]
+  cos_dist = unit_vectors(cat["ra"], cat["dec"]).dot(centre)
+  return cat[cos_dist>=np.cos(np.radians(radius))]
+
+
+def arcsec_to_chord(arcsec):
+  """
+  returns the unit-sphere chord length for an angle in arcsec.
+
+  >>> round(float(arcsec_to_chord(3600*60)), 12)
+  1.0
+  """
+  return 2*np.sin(np.radians(np.asarray(arcsec)/3600.)/2)
+
+
+def chord_to_arcsec(chord):
+  return np.degrees(2*np.arcsin(np.asarray(chord)/2))*3600.
+
+
+class RefIndex:
+  """
+  a KD-tree over the unit vectors of a reference catalog.
+
+  >>> cat = np.array([(10., 0., 5.), (10.01, 0., 9.), (350., -89.9, 7.)],
+  ...   dtype=[("ra", "f8"), ("dec", "f8"), ("mag", "f4")])
+  >>> idx = RefIndex(cat)
+  >>> src, ref, sep = idx.match(np.array([10.0002, 170., 349.9]),
+  ...   np.array([0., 0., -89.9]), 3)
+  >>> src.tolist(), ref.tolist(), sep.round(2).tolist()
+  ([0, 2], [0, 2], [0.72, 0.63])
+  """
+  def __init__(self, cat):
+    self.cat = cat
+    self.tree = cKDTree(unit_vectors(cat["ra"], cat["dec"]))
+
+  @classmethod
+  def from_file(cls, path, **kwargs):
+    return cls(load(path, **kwargs))
+
+  def match(self, ra, dec, radius):
+    """
+    returns index arrays (source, reference) and separations in arcsec
+    of the nearest reference object within radius arcsec of each of
+    the positions ra, dec.
+    """
+    dist, ref_index = self.tree.query(unit_vectors(ra, dec),
+      distance_upper_bound=float(arcsec_to_chord(radius)))
+    src_index = np.nonzero(np.isfinite(dist))[0]
+    return (src_index, ref_index[src_index],
+      chord_to_arcsec(dist[src_index]))
@@ -0,0 +1,289 @@
+"""
+Re-fitting the SIP distortion of solved plates without re-running anet.
+
+annotate_fits.py keeps each plate's extraction catalog (see
+--catalog-dir).  This matches such a catalog against a local reference
+catalog (see refcat.py) through the plate's current WCS, fits CRPIX,
+the CD matrix and SIP polynomials of the requested order by linear
+least squares, computes the inverse (AP, BP) polynomials, and writes
+the result into the plate header in place.
+
+  python bin/refine_sip.py --refcat tycho2.fits --order 4 data/*.fit
+"""
+
+import argparse
+import concurrent.futures
+import os
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+from scipy.spatial import cKDTree
+
+import plate_io
+import refcat
+
+# distance (pixels) within which a source matches a predicted
+# reference position
+MATCH_RADIUS = 5.
+# outliers beyond this many sigmas are dropped from the fit
+CLIP_SIGMA = 3.
+MIN_MATCHES_PER_TERM = 3
+
+# the reference catalog; set in main before the worker pool forks
+REFCAT = None
+
+
+def monomial_exponents(min_order, max_order):
+  """
+  returns the (p, q) exponent pairs with min_order<=p+q<=max_order.
+
+  >>> monomial_exponents(2, 3)
+  [(2, 0), (1, 1), (0, 2), (3, 0), (2, 1), (1, 2), (0, 3)]
+  """
+  return [(order-q, q) for order in range(min_order, max_order+1)
+    for q in range(order+1)]
+
+
+def design_matrix(u, v, exponents):
+  return np.column_stack([u**p*v**q for p, q in exponents])
+
+
+def tangent_project(ra, dec, ra0, dec0):
+  """
+  returns the gnomonic (TAN) standard coordinates in degrees of
+  positions ra, dec around the tangent point ra0, dec0.
+
+  >>> xi, eta = tangent_project(np.array([10.]), np.array([1.]), 10., 0.)
+  >>> round(float(xi[0]), 9), round(float(eta[0]), 6)
+  (0.0, 1.000102)
+  """
+  ra, dec = np.radians(ra), np.radians(dec)
+  ra0, dec0 = np.radians(ra0), np.radians(dec0)
+  cos_c = (np.sin(dec0)*np.sin(dec)
+    +np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0))
+  xi = np.cos(dec)*np.sin(ra-ra0)/cos_c
+  eta = (np.cos(dec0)*np.sin(dec)
+    -np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/cos_c
+  return np.degrees(xi), np.degrees(eta)
+
+
+def match_sources(header, sources, refs, radius=MATCH_RADIUS):
+  """
+  returns index arrays (source, reference) of unique nearest pairs
+  closer than radius pixels, using the current WCS of header.
+  """
+  with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    predicted = wcs.WCS(header).all_world2pix(
+      np.column_stack([refs["ra"], refs["dec"]]), 1)
+  tree = cKDTree(np.column_stack([sources["X_IMAGE"], sources["Y_IMAGE"]]))
+  dist, src_index = tree.query(predicted, distance_upper_bound=radius)
+  ref_index = np.nonzero(np.isfinite(dist))[0]
+  src_index = src_index[ref_index]
+
+  # keep only the closest reference for sources matched more than once
+  order = np.argsort(dist[ref_index])
+  _, first = np.unique(src_index[order], return_index=True)
+  keep = order[first]
+  return src_index[keep], ref_index[keep]
+
+
+def fit_sip(x, y, ra, dec, crval, crpix, order, iterations=3):
+  """
+  returns (crpix, cd, a, b, residuals) for pixel positions x, y
+  (1-based) of objects at ra, dec.
+
+  a and b are dicts (p, q) -> coefficient for 2<=p+q<=order, residuals
+  the per-object distances in pixels.  CRPIX absorbs the constant terms
+  of the fit, so a few iterations are run.
+  """
+  xi, eta = tangent_project(ra, dec, crval[0], crval[1])
+  linear = monomial_exponents(0, 1)
+  higher = monomial_exponents(2, order)
+  crpix = np.array(crpix, dtype=float)
+
+  for _ in range(iterations):
+    u, v = x-crpix[0], y-crpix[1]
+    # scale the pixel offsets to keep the design matrix well-conditioned
+    norm = max(np.abs(u).max(), np.abs(v).max(), 1.)
+    design = design_matrix(u/norm, v/norm, linear+higher)
+    coeffs = np.linalg.lstsq(design, np.column_stack([xi, eta]),
+      rcond=None)[0]
+    scales = np.array([norm**-(p+q) for p, q in linear+higher])
+    coeffs = coeffs*scales[:,None]
+
+    cd = coeffs[1:3].T
+    cd_inv = np.linalg.inv(cd)
+    offset = cd_inv.dot(coeffs[0])
+    crpix = crpix-offset
+    if np.abs(offset).max()<1e-4:
+      break
+
+  sip = cd_inv.dot(coeffs[3:].T)
+  a = dict(zip(higher, sip[0]))
+  b = dict(zip(higher, sip[1]))
+  residuals = np.hypot(*cd_inv.dot(
+    np.column_stack([xi, eta]).T-design.dot(coeffs/scales[:,None]).T))
+  return crpix, cd, a, b, residuals
+
+
+def fit_inverse(a, b, order, width, height, crpix, grid=50):
+  """
+  returns the inverse SIP polynomials (ap, bp) for the forward
+  polynomials a, b, fitted on a grid over the plate.
+  """
+  u, v = np.meshgrid(np.linspace(1, width, grid)-crpix[0],
+    np.linspace(1, height, grid)-crpix[1])
+  u, v = u.ravel(), v.ravel()
+  big_u = u+sum(c*u**p*v**q for (p, q), c in a.items())
+  big_v = v+sum(c*u**p*v**q for (p, q), c in b.items())
+
+  exponents = monomial_exponents(1, order)
+  norm = max(np.abs(big_u).max(), np.abs(big_v).max(), 1.)
+  design = design_matrix(big_u/norm, big_v/norm, exponents)
+  coeffs = np.linalg.lstsq(design, np.column_stack([u-big_u, v-big_v]),
+    rcond=None)[0]
+  coeffs = coeffs*np.array([norm**-(p+q) for p, q in exponents])[:,None]
+  return dict(zip(exponents, coeffs[:,0])), dict(zip(exponents, coeffs[:,1]))
+
+
+def _fit_matched(header, sources, refs, order, min_matches):
+  src_index, ref_index = match_sources(header, sources, refs)
+  if len(src_index)<min_matches:
+    return None
+
+  x = sources["X_IMAGE"][src_index].astype(float)
+  y = sources["Y_IMAGE"][src_index].astype(float)
+  ra, dec = refs["ra"][ref_index], refs["dec"][ref_index]
+  crval = (header["CRVAL1"], header["CRVAL2"])
+  keep = np.ones(len(x), dtype=bool)
+  for _ in range(3):
+    crpix, cd, a, b, residuals = fit_sip(x[keep], y[keep], ra[keep],
+      dec[keep], crval, (header["CRPIX1"], header["CRPIX2"]), order)
+    rms = np.sqrt(np.mean(residuals**2))
+    clipped = np.zeros(len(x), dtype=bool)
+    clipped[np.nonzero(keep)[0]] = residuals<=CLIP_SIGMA*rms
+    if clipped.sum()<min_matches or (clipped==keep).all():
+      break
+    keep = clipped
+  return crpix, cd, a, b, rms, int(keep.sum())
+
+
+def refine(header, sources, refs, order, width, height, rounds=3):
+  """
+  returns header cards for a refined SIP WCS from sources (an extraction
+  catalog) and refs (reference objects around the plate), or None if
+  there are too few matches.
+
+  Matching uses the WCS from the previous round, so objects in the
+  plate corners, where the old distortion model is worst, are picked
+  up as the fit improves; each fit clips outliers.
+  """
+  min_matches = MIN_MATCHES_PER_TERM*len(monomial_exponents(0, order))
+  current = header.copy()
+  cards = None
+  for _ in range(rounds):
+    fit = _fit_matched(current, sources, refs, order, min_matches)
+    if fit is None:
+      break
+    crpix, cd, a, b, rms, n_used = fit
+    ap, bp = fit_inverse(a, b, order+1, width, height, crpix)
+    cards = [
+      ("CTYPE1", "RA---TAN-SIP"), ("CTYPE2", "DEC--TAN-SIP"),
+      ("CRPIX1", crpix[0]), ("CRPIX2", crpix[1]),
+      ("CD1_1", cd[0,0]), ("CD1_2", cd[0,1]),
+      ("CD2_1", cd[1,0]), ("CD2_2", cd[1,1]),
+      ("A_ORDER", order), ("B_ORDER", order),
+      ("AP_ORDER", order+1), ("BP_ORDER", order+1)]
+    for prefix, coeffs in [("A", a), ("B", b), ("AP", ap), ("BP", bp)]:
+      cards.extend((f"{prefix}_{p}_{q}", float(c))
+        for (p, q), c in coeffs.items())
+    cards.extend([("SIP_RMS", round(float(rms), 4),
+        "[pix] RMS residual of the SIP refit"),
+      ("SIP_NREF", n_used, "Reference objects used in the SIP refit")])
+    patch_header(current, cards)
+  return cards
+
+
+def patch_header(header, cards):
+  """
+  replaces the distortion in header by cards.
+
+  >>> h = fits.Header([("A_ORDER", 2), ("A_0_2", 1.), ("A_1_1", 1.),
+  ...   ("OBJECT", "M42")])
+  >>> patch_header(h, [("A_ORDER", 3), ("A_0_3", 2.)])
+  >>> list(h.items())
+  [('OBJECT', 'M42'), ('A_ORDER', 3), ('A_0_3', 2.0)]
+  """
+  for key in list(header.keys()):
+    if key.split("_")[0] in ("A", "B", "AP", "BP"):
+      del header[key]
+  for card in cards:
+    header[card[0]] = card[1:] if len(card)>2 else card[1]
+
+
+def refine_plate(path, catalog_dir, order, mag_limit=None):
+  """
+  refits the SIP distortion of the plate at path in place; returns a
+  message for the log.
+  """
+  catalog = plate_io.catalog_path(catalog_dir, path)
+  if not os.path.exists(catalog):
+    return f"{path}: no catalog {catalog}"
+  sources = fits.getdata(catalog, 1)
+
+  with fits.open(path, mode="update") as hdul:
+    hdu = plate_io.plate_hdu(hdul)
+    header = hdu.header
+    if "CRVAL1" not in header:
+      return f"{path}: no WCS"
+    height, width = hdu.shape
+    with warnings.catch_warnings():
+      warnings.simplefilter("ignore")
+      plate_wcs = wcs.WCS(header)
+      ra, dec = plate_wcs.all_pix2world([[width/2., height/2.]], 1)[0]
+      corner = plate_wcs.all_pix2world([[1, 1]], 1)[0]
+    centre_vec, corner_vec = refcat.unit_vectors(
+      np.array([ra, corner[0]]), np.array([dec, corner[1]]))
+    radius = 1.05*np.degrees(np.arccos(min(centre_vec.dot(corner_vec), 1)))
+    refs = refcat.cone(REFCAT, ra, dec, radius, mag_limit)
+
+    cards = refine(header, sources, refs, order, width, height)
+    if cards is None:
+      return f"{path}: too few matches"
+    patch_header(header, cards)
+    header.add_history(f"SIP distortion refit to order {order}"
+      " by refine_sip.py")
+  return f"{path}: order {order}, rms {header['SIP_RMS']} pix" \
+    f" from {header['SIP_NREF']} objects"
+
+
+def main():
+  global REFCAT
+  parser = argparse.ArgumentParser(
+    description="Refit SIP distortions of solved plates in place")
+  parser.add_argument("plates", nargs="+", help="plate FITS files")
+  parser.add_argument("--refcat", required=True,
+    help="reference catalog (FITS table or CSV with RA, DEC, MAG)")
+  parser.add_argument("--order", type=int, default=3,
+    help="SIP polynomial order")
+  parser.add_argument("--catalog-dir", default="catalogs",
+    help="where annotate_fits.py put the extraction catalogs")
+  parser.add_argument("--mag-limit", type=float, default=None,
+    help="only use reference objects brighter than this")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of plates processed in parallel")
+  args = parser.parse_args()
+
+  REFCAT = refcat.load(args.refcat)
+  with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+    for msg in pool.map(refine_plate, args.plates,
+        [args.catalog_dir]*len(args.plates), [args.order]*len(args.plates),
+        [args.mag_limit]*len(args.plates)):
+      print(msg)
+
+
+if __name__=="__main__":
+  main()
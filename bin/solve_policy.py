@@ -0,0 +1,215 @@
+"""
+Predicting whether astrometry.net has a chance on a plate.
+
+Objective prism plates, polaroid exposures, spectra and plates with
+trailed stars (comets tracked at their own rate, multiple exposures)
+mostly burn the full solve timeout without a result.  The policy here
+looks at the logbook row of a plate and a sparse sample of its pixels
+and returns a SolveDecision:
+
+  solve  -- run anet as usual
+  quick  -- run anet with a short time limit (trails, multiple exposures)
+  skip   -- do not run anet at all
+
+The decision is noted in the timing log (see plate_timing.py), where
+the summary reports the solve time saved.
+"""
+
+import collections
+import re
+
+import numpy as np
+
+
+SolveDecision = collections.namedtuple("SolveDecision",
+  ["action", "reason", "timelimit"])
+
+# time limit (seconds) for the "quick" path
+QUICK_TIMELIMIT = 30
+
+# substrings (after lowercasing and removing blanks) of logbook fields
+# that make a plate unsolvable
+PRISM_FILTERS = ["объективнаяпризма", "objectiveprism", "призм", "prism"]
+POLAROID_FILTERS = ["поляроид", "polaroid"]
+COMET_KEYWORDS = ["комет", "comet"]
+COMET_DESIGNATION = re.compile(r"^(?:\d+[pd]|[cpd]/)", re.I)
+# words in OBJTYPE or METHOD that say the plate is a spectrum
+SPECTRUM_WORDS = re.compile(r"\b(?:спектры?|спектрограмм\w*"
+  r"|spectr(?:um|a|ograms?))\b", re.I)
+# phrases in the free-text notes that do; these mention spectra of
+# other things, too ("spectral class", "spectrum taken later")
+SPECTRUM_NOTES = re.compile(r"\b(?:спектрограмм\w*|spectrograms?"
+  r"|objective\s+prism|объективн\w*\s+призм\w*)\b", re.I)
+
+# comets exposed longer than this (seconds) show trailed stars
+COMET_TRAIL_EXPTIME = 600
+
+# image statistics limits
+MAX_SATURATED_FRACTION = 0.25
+MIN_PEAK_SIGNIFICANCE = 8
+
+
+def _squeeze(val):
+  """
+  returns val lowercased and without blanks, or an empty string for None.
+
+  >>> _squeeze(" Объективная призма ")
+  'объективнаяпризма'
+  >>> _squeeze(None)
+  ''
+  """
+  if not val:
+    return ""
+  return "".join(str(val).split()).lower()
+
+
+def _contains_any(val, keywords):
+  return any(kw in val for kw in keywords)
+
+
+def _is_comet(meta):
+  if _contains_any(_squeeze(meta.get("OBJTYPE")), COMET_KEYWORDS):
+    return True
+  for name in (meta.get("OBJECT") or "").split(";"):
+    name = name.strip()
+    if COMET_DESIGNATION.match(name) or _contains_any(
+        _squeeze(name), COMET_KEYWORDS):
+      return True
+  return False
+
+
+def decide_from_metadata(meta, exptimes=None):
+  """
+  returns a SolveDecision from a logbook row (a dict as in logbook.csv),
+  or None if the metadata do not suggest anything special.
+
+  exptimes is the list of parsed exposure times in seconds (or None).
+
+  >>> decide_from_metadata({"FILTER": "объективная призма"}).action
+  'skip'
+  >>> decide_from_metadata({"FILTER": "ЖС18", "METHOD": None,
+  ...   "OBJTYPE": "спектр"}).reason
+  'spectrum'
+  >>> decide_from_metadata({"OBJECT": "Mizar", "OBJTYPE": "double star",
+  ...   "NOTES_en": "spectral class A2; spectrum of the comet taken later"},
+  ...   [600.]) is None
+  True
+  >>> decide_from_metadata({"PLATNOTE_en": "Spectrogram, slit 0.1 mm"}).action
+  'skip'
+  >>> decide_from_metadata({"OBJECT": "C/1969 Y1", "OBJTYPE": None},
+  ...   [1200.]).action
+  'quick'
+  >>> decide_from_metadata({"OBJECT": "NGC6611", "OBJTYPE": "open cluster"},
+  ...   [600., 600.]).reason
+  'multiple exposures (2)'
+  >>> decide_from_metadata({"OBJECT": "lam Ori"}, [1200.]) is None
+  True
+  """
+  filters = _squeeze(meta.get("FILTER"))
+  if _contains_any(filters, PRISM_FILTERS):
+    return SolveDecision("skip", "objective prism", 0)
+  if _contains_any(filters, POLAROID_FILTERS):
+    return SolveDecision("skip", "polaroid", 0)
+
+  for field, pattern in [("OBJTYPE", SPECTRUM_WORDS),
+      ("METHOD", SPECTRUM_WORDS), ("PLATNOTE_en", SPECTRUM_NOTES),
+      ("NOTES_en", SPECTRUM_NOTES)]:
+    if pattern.search(meta.get(field) or ""):
+      return SolveDecision("skip", "spectrum", 0)
+
+  if _is_comet(meta) and exptimes and max(exptimes)>COMET_TRAIL_EXPTIME:
+    return SolveDecision("quick", "comet, trailed stars", QUICK_TIMELIMIT)
+
+  if exptimes and len(exptimes)>1:
+    return SolveDecision("quick", f"multiple exposures ({len(exptimes)})",
+      QUICK_TIMELIMIT)
+
+  return None
+
+
+def quick_image_stats(data, row_step=64, col_step=8):
+  """
+  returns a dict of rough image statistics from a sparse sample of data.
+
+  data should be an HDU's section rather than its data attribute; for
+  scaled (BZERO) plates, the latter would read and convert the whole
+  image.  Only every row_step-th row is then read from disk.
+
+  The peak significance is that of the brightest sampled pixel, so a
+  sparse field with only a few stars in the sample still counts:
+
+  >>> rnd = np.random.default_rng(1)
+  >>> plate = rnd.normal(3000, 60, (4000, 4000)).astype(np.float32)
+  >>> y, x = np.mgrid[-8:9, -8:9]
+  >>> star = 17000*np.exp(-(x**2+y**2)/(2*1.7**2))
+  >>> for row, col in rnd.integers(10, 3990, (100, 2)):
+  ...   plate[row-8:row+9, col-8:col+9] += star
+  >>> quick_image_stats(plate)["peak_significance"]>MIN_PEAK_SIGNIFICANCE
+  True
+  >>> decide_from_stats(quick_image_stats(plate)) is None
+  True
+  """
+  sample = np.asarray(data[::row_step, ::col_step], dtype=np.float32)
+  median = float(np.median(sample))
+  noise = 1.4826*float(np.median(np.abs(sample-median))) or 1.
+  saturation = float(sample.max())
+  return {
+    "median": median,
+    "noise": noise,
+    "peak_significance": (saturation-median)/noise,
+    "saturated_fraction": float(np.mean(sample>=min(saturation, 65000))),
+  }
+
+
+def decide_from_stats(stats):
+  """
+  returns a SolveDecision for hopeless or doubtful images, None
+  otherwise.
+
+  Images without a significant pixel in the sample only get the quick
+  time limit rather than being skipped, since the sample can miss the
+  few stars of a sparse field.
+
+  >>> decide_from_stats({"median": 30000, "noise": 100,
+  ...   "peak_significance": 50, "saturated_fraction": 0.4}).reason
+  'saturated (40%)'
+  >>> decide_from_stats({"median": 3000, "noise": 60,
+  ...   "peak_significance": 2, "saturated_fraction": 0})
+  SolveDecision(action='quick', reason='no sources above noise in sample', timelimit=30)
+  >>> decide_from_stats({"median": 3000, "noise": 60,
+  ...   "peak_significance": 40, "saturated_fraction": 0.001}) is None
+  True
+  """
+  if stats["saturated_fraction"]>MAX_SATURATED_FRACTION:
+    return SolveDecision("skip",
+      f"saturated ({stats['saturated_fraction']*100:.0f}%)", 0)
+  if stats["peak_significance"]<MIN_PEAK_SIGNIFICANCE:
+    return SolveDecision("quick", "no sources above noise in sample",
+      QUICK_TIMELIMIT)
+  return None
+
+
+def decide(src_name, meta, exptimes=None, data=None,
+    default_timelimit=None):
+  """
+  returns the SolveDecision for the plate src_name.
+
+  meta is the plate's logbook row (or None if unknown), data its
+  pixels (preferably the primary HDU's section); the image statistics
+  are only computed when the metadata leave the plate solvable.
+  """
+  if "-st" in src_name or "Cal" in src_name:
+    return SolveDecision("skip", "calibration frame", 0)
+
+  decision = None
+  if meta:
+    decision = decide_from_metadata(meta, exptimes)
+  if decision and decision.action=="skip":
+    return decision
+
+  if data is not None and len(getattr(data, "shape", ()))==2:
+    stats_decision = decide_from_stats(quick_image_stats(data))
+    if stats_decision:
+      return stats_decision
+
+  return decision or SolveDecision("solve", "", default_timelimit)
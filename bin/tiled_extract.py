@@ -0,0 +1,240 @@
+"""
+Parallel, tiled source extraction for large plate scans.
+
+SExtractor is single-threaded, and on 14k x 14k scans it takes longer
+than the solve.  This splits the plate into overlapping tiles, reads
+each tile through the HDU section of the memory-mapped file (so the
+plate is never loaded as a whole), runs SExtractor on the tiles in a
+process pool and merges the tile catalogs into one with the columns
+from default.param.
+
+Each tile owns the detections whose centres fall into its core (the
+tile without the overlap); the overlap only makes sure objects on the
+seams are measured completely.  Detections from neighbouring tiles that
+still end up closer than the dedup radius are merged, keeping the
+brighter one.
+
+The tiles are extracted with the settings given (PAHeaderAdder passes
+its sourceExtractorControl) on top of SExtractor's defaults, not with
+the configuration anet builds for its own SExtractor run, so the source
+lists differ somewhat from anet's.  annotate_fits.py therefore verifies
+seeds with a narrow scale window but falls back to a solve over the
+full sp_lower_pix..sp_upper_pix range when that fails.  If the
+extraction itself fails (SExtractor missing or crashing on a tile, a
+broken process pool), it solves the plate with anet as usual.
+
+  python bin/tiled_extract.py plate.fit out.xyls [--tile 4096] [--workers 8]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+from numpy.lib import recfunctions as rfn
+from astropy.io import fits
+
+import plate_io
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PARAM_FILE = os.path.join(BIN_DIR, "default.param")
+
+
+def read_param_names(path=PARAM_FILE):
+  with open(path) as f:
+    return [l.strip() for l in f if l.strip() and not l.startswith("#")]
+
+
+def parse_sex_control(control):
+  """
+  returns a dict from a SExtractor configuration snippet as in
+  PAHeaderAdder.sourceExtractorControl.
+
+  >>> parse_sex_control('''
+  ...   DETECT_MINAREA   20
+  ...   DETECT_THRESH    5 # sigma
+  ... ''')
+  {'DETECT_MINAREA': '20', 'DETECT_THRESH': '5'}
+  """
+  res = {}
+  for line in (control or "").split("\n"):
+    line = line.split("#")[0].strip()
+    if line:
+      key, _, val = line.partition(" ")
+      res[key.upper()] = val.strip()
+  return res
+
+
+def find_sextractor():
+  for name in ["source-extractor", "sex"]:
+    path = shutil.which(name)
+    if path:
+      return path
+  raise EnvironmentError("No SExtractor (source-extractor or sex) on PATH")
+
+
+def iter_tiles(height, width, tile, overlap):
+  """
+  yields (core, box) pairs of (y0, y1, x0, x1) tuples covering an image
+  of height x width; box is core grown by overlap and clipped to the image.
+
+  >>> list(iter_tiles(10, 6, 5, 2))
+  [((0, 5, 0, 5), (0, 7, 0, 6)), ((0, 5, 5, 6), (0, 7, 3, 6)), ((5, 10, 0, 5), (3, 10, 0, 6)), ((5, 10, 5, 6), (3, 10, 3, 6))]
+  """
+  for y0 in range(0, height, tile):
+    for x0 in range(0, width, tile):
+      y1, x1 = min(y0+tile, height), min(x0+tile, width)
+      yield ((y0, y1, x0, x1), (max(y0-overlap, 0), min(y1+overlap, height),
+        max(x0-overlap, 0), min(x1+overlap, width)))
+
+
+def extract_tile(plate_path, core, box, sex_args, work_dir, tile_index):
+  """
+  runs SExtractor on one tile of plate_path and returns the detections
+  owned by core as a structured array in full-plate pixel coordinates.
+  """
+  y0, y1, x0, x1 = box
+  with fits.open(plate_path) as hdul:
+    pixels = plate_io.plate_hdu(hdul).section[y0:y1, x0:x1]
+
+  tile_path = os.path.join(work_dir, f"tile{tile_index}.fits")
+  cat_path = os.path.join(work_dir, f"tile{tile_index}.cat")
+  fits.PrimaryHDU(pixels).writeto(tile_path, overwrite=True)
+  del pixels
+  try:
+    subprocess.run([find_sextractor(), tile_path,
+        "-CATALOG_NAME", cat_path,
+        "-CATALOG_TYPE", "FITS_1.0",
+        "-PARAMETERS_NAME", PARAM_FILE,
+        "-VERBOSE_TYPE", "QUIET"]+sex_args,
+      check=True, cwd=work_dir, stdout=subprocess.DEVNULL)
+    cat = np.array(fits.getdata(cat_path, 1))
+  finally:
+    for path in [tile_path, cat_path]:
+      if os.path.exists(path):
+        os.unlink(path)
+
+  # SExtractor pixel coordinates are 1-based
+  cat["X_IMAGE"] += x0
+  cat["Y_IMAGE"] += y0
+  cy0, cy1, cx0, cx1 = core
+  owned = ((cat["X_IMAGE"]-1>=cx0) & (cat["X_IMAGE"]-1<cx1)
+    & (cat["Y_IMAGE"]-1>=cy0) & (cat["Y_IMAGE"]-1<cy1))
+  return cat[owned]
+
+
+def dedup_seams(cat, tile, radius):
+  """
+  removes the fainter of detection pairs closer than radius that sit
+  on different sides of a tile seam.
+
+  >>> cat = np.array([(100.9, 5., 2000.), (101.2, 5.1, 1000.), (50., 5., 1.)],
+  ...   dtype=[("X_IMAGE", "f8"), ("Y_IMAGE", "f8"), ("FLUX_AUTO", "f8")])
+  >>> dedup_seams(cat, 100, 1.5)["FLUX_AUTO"].tolist()
+  [2000.0, 1.0]
+  """
+  x, y = cat["X_IMAGE"]-1, cat["Y_IMAGE"]-1
+  near_seam = ((np.minimum(x%tile, tile-x%tile)<radius)
+    | (np.minimum(y%tile, tile-y%tile)<radius))
+  candidates = np.nonzero(near_seam)[0]
+
+  cells = {}
+  for i in candidates:
+    cells.setdefault((int(x[i]//radius), int(y[i]//radius)), []).append(i)
+
+  drop = set()
+  for (cx, cy), members in cells.items():
+    for i in members:
+      if i in drop:
+        continue
+      for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+          for j in cells.get((cx+dx, cy+dy), ()):
+            if (j==i or j in drop
+                or (int(x[i]//tile), int(y[i]//tile))
+                  ==(int(x[j]//tile), int(y[j]//tile))):
+              continue
+            if (x[i]-x[j])**2+(y[i]-y[j])**2<radius**2:
+              drop.add(j if cat["FLUX_AUTO"][i]>=cat["FLUX_AUTO"][j] else i)
+
+  keep = np.ones(len(cat), dtype=bool)
+  keep[list(drop)] = False
+  return cat[keep]
+
+
+def extract(plate_path, sex_control=None, tile=4096, overlap=128,
+    workers=None, tmp_dir=None, dedup_radius=1.5):
+  """
+  returns the merged SExtractor catalog of plate_path as a structured
+  array with the columns of default.param.
+
+  sex_control is a SExtractor configuration snippet (KEY VALUE lines)
+  passed on to each tile run.
+  """
+  with fits.open(plate_path) as hdul:
+    height, width = plate_io.plate_hdu(hdul).shape
+
+  sex_params = {"FILTER": "N"}
+  sex_params.update(parse_sex_control(sex_control))
+  sex_args = []
+  for key, val in sex_params.items():
+    sex_args.extend(["-"+key, val])
+
+  work_dir = tempfile.mkdtemp(prefix="tiles", dir=tmp_dir)
+  try:
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+      jobs = [pool.submit(extract_tile, plate_path, core, box, sex_args,
+          work_dir, index)
+        for index, (core, box) in enumerate(
+          iter_tiles(height, width, tile, overlap))]
+      parts = [job.result() for job in jobs]
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  names = read_param_names()
+  cat = np.concatenate([rfn.repack_fields(p[names]) for p in parts])
+  return dedup_seams(cat, tile, dedup_radius)
+
+
+def write_catalog(cat, dest, width=None, height=None):
+  """
+  writes cat as a FITS binary table (like SExtractor's FITS_1.0 output
+  that anet reads).
+  """
+  hdu = fits.BinTableHDU(cat)
+  if width and height:
+    hdu.header["IMAGEW"] = width
+    hdu.header["IMAGEH"] = height
+  fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(dest, overwrite=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Tiled, parallel SExtractor run over a large plate")
+  parser.add_argument("plate", help="FITS file to extract sources from")
+  parser.add_argument("catalog", help="output catalog (FITS table)")
+  parser.add_argument("--tile", type=int, default=4096,
+    help="tile size in pixels (without overlap)")
+  parser.add_argument("--overlap", type=int, default=128,
+    help="overlap between tiles in pixels")
+  parser.add_argument("--workers", type=int, default=None,
+    help="number of SExtractor processes (default: number of CPUs)")
+  parser.add_argument("--tmp-dir", default=None,
+    help="where to put the tile images (preferably a tmpfs)")
+  parser.add_argument("--sex-control", default="",
+    help="extra SExtractor settings as 'KEY VALUE;KEY VALUE'")
+  args = parser.parse_args()
+
+  cat = extract(args.plate, args.sex_control.replace(";", "\n"),
+    args.tile, args.overlap, args.workers, args.tmp_dir)
+  with fits.open(args.plate) as hdul:
+    height, width = plate_io.plate_hdu(hdul).shape
+  write_catalog(cat, args.catalog, width, height)
+  print(f"{len(cat)} sources written to {args.catalog}")
+
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,178 @@
+"""
+An index of solved plates for seeding new solves.
+
+Plates from the same night and pointing share nearly the same WCS.
+This keeps the WCS of every solved plate in an sqlite database keyed
+by observation night (DATEORIG), target (OBJECT) and logbook position,
+so PAHeaderAdder can start a new plate from its nearest solved
+neighbour (see platesolve.verify_xyls) rather than solving it blind.
+
+To fill the index from plates annotated earlier:
+
+  python bin/wcs_index.py wcs_index.sqlite data/*.fit
+"""
+
+import argparse
+import math
+import sqlite3
+import time
+
+from astropy.io import fits
+
+import plate_io
+
+# neighbours further away than this (degrees) are not used as seeds
+MAX_SEPARATION = 3.
+
+# header cards (or card prefixes) making up the WCS
+WCS_PREFIXES = ("CTYPE", "CRVAL", "CRPIX", "CD1_", "CD2_", "CDELT", "PC1_",
+  "PC2_", "CUNIT", "A_", "B_", "AP_", "BP_")
+WCS_KEYS = {"EQUINOX", "RADESYS", "LONPOLE", "LATPOLE", "IMAGEW", "IMAGEH"}
+
+
+def normalize_object(name):
+  """
+  returns an object name as a key for comparisons; of several targets
+  (as in the logbook), only the first is used, which is what OBJECT in
+  the plate headers has.
+
+  >>> normalize_object(" NGC 6611; M16")
+  'ngc6611'
+  >>> normalize_object(None)
+  ''
+  """
+  return "".join((name or "").split(";")[0].split()).lower()
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+  """
+  returns the distance between two positions in degrees.
+
+  >>> round(angular_distance(10, 0, 11, 0), 6)
+  1.0
+  >>> round(angular_distance(0, 89, 180, 89), 6)
+  2.0
+  """
+  ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+  cos_dist = (math.sin(dec1)*math.sin(dec2)
+    +math.cos(dec1)*math.cos(dec2)*math.cos(ra1-ra2))
+  return math.degrees(math.acos(max(-1., min(1., cos_dist))))
+
+
+def wcs_cards(header):
+  """
+  returns a header with only the WCS cards of header.
+
+  >>> h = fits.Header([("NAXIS", 2), ("CRVAL1", 83.2), ("A_0_2", 1e-6),
+  ...   ("OBJECT", "M42")])
+  >>> list(wcs_cards(h).keys())
+  ['CRVAL1', 'A_0_2']
+  """
+  return fits.Header([card for card in fits.Header(header).cards
+    if card.keyword in WCS_KEYS or card.keyword.startswith(WCS_PREFIXES)])
+
+
+class WCSIndex:
+  """
+  the sqlite database of solved plates.
+
+  >>> idx = WCSIndex(":memory:")
+  >>> idx.record("a.fit", "13.03.1956", "M42", 83.8, -5.4,
+  ...   fits.Header([("CRVAL1", 83.9), ("CRVAL2", -5.3)]))
+  >>> plate, hdr = idx.find_neighbour("13.03.1956", "m 42", 83.7, -5.5)
+  >>> plate, hdr["CRVAL1"]
+  ('a.fit', 83.9)
+  >>> idx.find_neighbour("14.03.1956", "M42", 83.8, -5.4) is None
+  True
+  >>> idx.find_neighbour("13.03.1956", "M42", 83.8, -5.4, exclude="a.fit")
+  """
+  def __init__(self, path):
+    self.path = path
+    self.conn = sqlite3.connect(path)
+    self.conn.execute("CREATE TABLE IF NOT EXISTS solved ("
+      " plate TEXT PRIMARY KEY, night TEXT, object TEXT,"
+      " ra REAL, dec REAL, header TEXT, solved REAL)")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS solved_night"
+      " ON solved (night)")
+    self.conn.commit()
+
+  def record(self, plate, night, obj, ra, dec, header):
+    """
+    adds (or replaces) the WCS of plate to the index.
+    """
+    self.conn.execute("INSERT OR REPLACE INTO solved"
+      " VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (plate, night, normalize_object(obj), ra, dec,
+        wcs_cards(header).tostring(), time.time()))
+    self.conn.commit()
+
+  def find_neighbour(self, night, obj, ra, dec, exclude=None,
+      max_separation=MAX_SEPARATION):
+    """
+    returns (plate, header) of the best solved plate from the same night,
+    or None.
+
+    Plates pointed within max_separation degrees qualify, the same
+    target is preferred; without logbook positions, only plates with
+    the same target qualify.
+    """
+    if not night:
+      return None
+    obj = normalize_object(obj)
+    candidates = []
+    for plate, other_obj, other_ra, other_dec, header in self.conn.execute(
+        "SELECT plate, object, ra, dec, header FROM solved"
+        " WHERE night=?", (night,)):
+      if plate==exclude:
+        continue
+      # entries written before only the first target was kept
+      other_obj = normalize_object(other_obj)
+      if None in (ra, dec, other_ra, other_dec):
+        if not obj or other_obj!=obj:
+          continue
+        sep = max_separation
+      else:
+        sep = angular_distance(ra, dec, other_ra, other_dec)
+        if sep>max_separation:
+          continue
+      candidates.append((other_obj!=obj, sep, plate, header))
+
+    if not candidates:
+      return None
+    _, _, plate, header = min(candidates)
+    return plate, fits.Header.fromstring(header)
+
+  def close(self):
+    self.conn.close()
+
+
+def record_plate(index, path):
+  """
+  adds the annotated and solved plate at path to index; returns False
+  if its header has no WCS.
+  """
+  header = plate_io.read_plate_header(path)
+  if "CRVAL1" not in header or "DATEORIG" not in header:
+    return False
+  index.record(path.split("/")[-1], header["DATEORIG"],
+    header.get("OBJECT"), header.get("RA_DEG"), header.get("DEC_DEG"),
+    header)
+  return True
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Add annotated, solved plates to the WCS seed index")
+  parser.add_argument("index", help="sqlite file with the index")
+  parser.add_argument("plates", nargs="*", help="FITS files to add")
+  args = parser.parse_args()
+
+  index = WCSIndex(args.index)
+  added = sum(record_plate(index, path) for path in args.plates)
+  total = index.conn.execute("SELECT COUNT(*) FROM solved").fetchone()[0]
+  index.close()
+  print(f"{added} plates added, {total} in the index")
+
+
+if __name__=="__main__":
+  main()
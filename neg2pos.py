@@ -1,32 +1,44 @@
 """
 Converts negative fits images to positive (and vice versa). Works correctly with files which data in range from 0 to 65,536.
+
+While the pixels are in memory anyway, the quality metrics of
+bin/plate_quality.py are computed and written into the header; the
+output gets CHECKSUM, DATASUM and DATAHASH (see bin/plate_io.py).
 """
 
 import numpy as np
 from astropy.io import fits
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin"))
+import plate_io
+import plate_quality
 
 def convert_one(path):
     hdul = fits.open(path)
     hdul[0].data = 65535 - hdul[0].data
+    hdul[0].header.update(plate_quality.quality_cards(
+        plate_quality.measure(hdul[0].data)))
     os.remove(path)
-    hdul.writeto(os.path.basename(path), overwrite=True)
+    plate_io.write_with_checksums(hdul, os.path.basename(path), overwrite=True)
     hdul.close()
 
-os.chdir("converted")
-
-total = len([f_name for f_name in os.listdir() if f_name.endswith(".fit")])
-counter = 1
-
-with open("converted.txt", "w") as file_object:
-    for f_name in os.listdir():
-        if f_name.endswith(".fit"):
-            print(counter, "/", total, f" ({round(counter/total*100, 1)}%)")
-            convert_one(f_name)
-            file_object.write(f_name + "\n")
-            
-            counter += 1
+def main():
+    os.chdir("converted")
 
+    total = len([f_name for f_name in os.listdir() if f_name.endswith(".fit")])
+    counter = 1
 
+    with open("converted.txt", "w") as file_object:
+        for f_name in os.listdir():
+            if f_name.endswith(".fit"):
+                print(counter, "/", total, f" ({round(counter/total*100, 1)}%)")
+                convert_one(f_name)
+                file_object.write(f_name + "\n")
+                
+                counter += 1
 
 
+if __name__ == "__main__":
+    main()